@@ -0,0 +1,190 @@
+"""Фоновая запись сгенерированных эскизов в архив generated_tattoos и другой дисковой работы"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveWriter:
+    """Архив эскизов с отдельным потоком записи.
+
+    submit() только кладет задачу в очередь, кодирование и запись на диск
+    выполняются в потоке архива. Файлы называются по хэшу содержимого
+    и раскладываются по подкаталогам ab/cd/, рядом лежит JSON с промптом
+    и параметрами. Старые файлы удаляются по возрасту, количеству и размеру.
+
+    defer() отдает тому же потоку любую другую запись, которую нельзя
+    терять (кэш результатов, статистика выборов): такие задачи не
+    отбрасываются при переполнении, в отличие от эскизов архива.
+    """
+
+    def __init__(self, directory, max_items=10000, max_bytes=5 * 1024 * 1024 * 1024,
+                 max_age=30 * 24 * 3600, queue_size=200):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.queue_size = queue_size
+
+        self._queue = queue.Queue()
+        self._archive_pending = 0  # эскизы архива в очереди - только они ограничены queue_size
+        self._lock = threading.Lock()
+        self._index = collections.OrderedDict()
+        self._total_bytes = 0
+        self._thread = None
+        self.dropped = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="archive-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, payload, metadata=None, extension="png"):
+        """Ставит изображение в очередь на запись, не блокируя вызывающий поток.
+
+        payload - байты изображения или функция без аргументов, которая их
+        возвращает (тогда кодирование тоже уходит в поток архива).
+        """
+        with self._lock:
+            if self._archive_pending >= self.queue_size:
+                self.dropped += 1
+                logger.warning("⚠️ Очередь архива переполнена, эскиз не будет сохранен")
+                return False
+            self._archive_pending += 1
+        # Текущий спан едет вместе с задачей: запись в архив видна в трассе генерации
+        self._queue.put(("archive", (payload, dict(metadata or {}), extension), tracing.current()))
+        return True
+
+    def defer(self, function, *args, **kwargs):
+        """Выполняет function(*args, **kwargs) в потоке записи. Задача не отбрасывается;
+        пока поток не запущен, она выполняется сразу в вызывающем потоке"""
+        if self._thread is None:
+            function(*args, **kwargs)
+            return
+        self._queue.put(("task", (function, args, kwargs), tracing.current()))
+
+    def stop(self, timeout=10):
+        """Дописывает очередь и останавливает поток"""
+        if not self._thread:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("⚠️ Архив не успел дописать очередь при остановке")
+
+    def pending(self):
+        """Задач в очереди записи (эскизы архива и отложенные записи)"""
+        return self._queue.qsize()
+
+    def _run(self):
+        self._load_index()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            kind, args, parent = item
+            if kind == "task":
+                function, task_args, task_kwargs = args
+                try:
+                    with tracing.use(parent):
+                        function(*task_args, **task_kwargs)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка фоновой записи: {e}")
+                continue
+
+            with self._lock:
+                self._archive_pending -= 1
+            payload, metadata, extension = args
+            try:
+                with tracing.use(parent):
+                    with tracing.span("archive.encode", format=extension):
+                        data = payload() if callable(payload) else payload
+                    with tracing.span("archive.write", bytes=len(data)):
+                        path = self._write(data, metadata, extension)
+                logger.info(f"💾 Изображение сохранено: {path}")
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи в архив: {e}")
+
+    def _shard_dir(self, content_hash):
+        return os.path.join(self.directory, content_hash[:2], content_hash[2:4])
+
+    def _write(self, data, metadata, extension):
+        content_hash = hashlib.sha256(data).hexdigest()
+        shard_dir = self._shard_dir(content_hash)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        path = os.path.join(shard_dir, f"{content_hash}.{extension}")
+        if content_hash in self._index:
+            # Такой же файл уже есть - только освежаем его позицию
+            self._index.move_to_end(content_hash)
+            return path
+
+        with open(path, "wb") as f:
+            f.write(data)
+
+        metadata.setdefault("created_at", time.time())
+        metadata["file"] = os.path.basename(path)
+        metadata["bytes"] = len(data)
+        with open(os.path.join(shard_dir, f"{content_hash}.json"), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+        self._index[content_hash] = (path, len(data), metadata["created_at"])
+        self._total_bytes += len(data)
+        self._enforce_retention()
+        return path
+
+    def _load_index(self):
+        """Сканирует архив при старте, чтобы квоты учитывали уже записанные файлы"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                content_hash, ext = os.path.splitext(name)
+                if ext == ".json" or len(content_hash) != 64:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, content_hash, path, stat.st_size))
+
+        for mtime, content_hash, path, size in sorted(entries):
+            self._index[content_hash] = (path, size, mtime)
+            self._total_bytes += size
+
+        self._enforce_retention()
+        logger.info(f"🗄️ Архив эскизов: {len(self._index)} файлов, {self._total_bytes / 1024 / 1024:.1f} МБ")
+
+    def _enforce_retention(self):
+        now = time.time()
+        while self._index:
+            content_hash, (path, size, created_at) = next(iter(self._index.items()))
+            too_old = self.max_age and now - created_at > self.max_age
+            too_many = len(self._index) > self.max_items
+            too_big = self._total_bytes > self.max_bytes
+            if not (too_old or too_many or too_big):
+                break
+            self._remove(content_hash)
+
+    def _remove(self, content_hash):
+        path, size, _ = self._index.pop(content_hash)
+        self._total_bytes -= size
+        for file_path in (path, os.path.splitext(path)[0] + ".json"):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        try:
+            # Удаляем опустевшие подкаталоги шарда
+            shard_dir = os.path.dirname(path)
+            os.rmdir(shard_dir)
+            os.rmdir(os.path.dirname(shard_dir))
+        except OSError:
+            pass
@@ -0,0 +1,504 @@
+"""Офлайн-бенчмарк бота: фейковый провайдер FLUX и фейковый Telegram Bot API.
+
+Запускает настоящие обработчики и очередь генерации из main.py, но вместо
+Nebius отвечает заглушка с настраиваемой задержкой и долей ошибок, а вместо
+Telegram - локальная функция через apihelper.CUSTOM_REQUEST_SENDER. Сотни
+пользователей одновременно проходят мастер (стиль -> место -> описание ->
+цвет -> качество), в конце печатается пропускная способность, перцентили
+задержек и потребление памяти:
+
+    python benchmark.py --chats 50 --rounds 2 --latency 2 --error-rate 0.05
+    python benchmark.py --chats 200 --latency 0.5 --json > before.json
+
+Ничего не отправляется наружу: токены фиктивные, файлы пишутся во временный каталог.
+"""
+import argparse
+import collections
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+STYLES = ["Минимализм", "Традишнл", "Реализм", "Акварель", "Геометрия", "Блэкворк", "Японский", "Скетч"]
+BODY_PARTS = ["Плечо", "Предплечье", "Запястье", "Спина", "Бедро", "Икра"]
+COLORS = ["Черно-белая", "Цветная", "Монохром", "С акцентами цвета"]
+SUBJECTS = ["wolf with moon light", "lotus flower with roots", "dragon wrapping around a sword",
+            "compass and old map", "phoenix with spread wings"]
+
+# Сообщения бота, по которым видно, чем закончилась генерация
+SUCCESS_MARK = "Использованный промпт"
+FAILURE_MARKS = ("💡 <b>Попробуй", "❌ <b>Произошла ошибка", "🚦")
+
+
+def prepare_environment(workdir, telegram_flood=False):
+    """Фиктивные токены и временные пути - до импорта main"""
+    defaults = {
+        "TOKEN": "123456:BENCHMARK",
+        "HF_TOKEN": "hf_benchmark",
+        "RESULT_CACHE_DIR": os.path.join(workdir, "cache"),
+        "FILE_ID_STORE_PATH": os.path.join(workdir, "file_ids.json"),
+        "SESSION_DB_PATH": os.path.join(workdir, "sessions.db"),
+        "JOB_QUEUE_PATH": os.path.join(workdir, "jobs.db"),
+        "JOB_JOURNAL_PATH": os.path.join(workdir, "jobs_journal.db"),
+        "ARCHIVE_DIR": os.path.join(workdir, "generated_tattoos"),
+        # Бенчмарк меряет конвейер, а не защитные лимиты: их можно вернуть через окружение
+        "USER_RATE_PER_MINUTE": "100000",
+        "USER_BURST": "1000",
+        "GLOBAL_RATE_PER_MINUTE": "1000000",
+        "GLOBAL_BURST": "100000",
+        "PROVIDER_RATE_PER_SECOND": "1000",
+        "PROVIDER_BURST": "1000",
+        "GENERATION_QUEUE_SIZE": "100000",
+        "QUALITY_DOWNGRADE_DEPTH": "0",
+        "RETRY_BASE_DELAY": "0.2",
+        "PROGRESS_INTERVAL": "1",
+    }
+    if not telegram_flood:
+        # Без лимитов фейкового Telegram диспетчеру исходящих запросов незачем притормаживать
+        defaults.update({"TELEGRAM_GLOBAL_RATE": "100000", "TELEGRAM_CHAT_RATE": "100000",
+                         "TELEGRAM_CHAT_BURST": "100000"})
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+class FakeProviderError(Exception):
+    """Ошибка HTTP от провайдера: classify_error смотрит на response.status_code"""
+
+    class Response:
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.headers = {}
+
+    def __init__(self, status_code):
+        super().__init__(f"{status_code} fake provider error")
+        self.response = self.Response(status_code)
+
+
+class FakeInferenceClient:
+    """Заглушка InferenceClient: логнормальная задержка и доля временных ошибок.
+
+    Задержка масштабируется числом шагов относительно 20 - так уровни качества
+    и черновик дают правдоподобную разницу во времени.
+    """
+
+    def __init__(self, latency=2.0, jitter=0.3, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def text_to_image(self, prompt, model=None, num_inference_steps=20, width=1024, height=1024, **params):
+        from PIL import Image
+
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * self._random.lognormvariate(0, self.jitter) * num_inference_steps / 20
+            failed = self._random.random() < self.error_rate
+            status = self._random.choice((429, 503))
+            color = tuple(self._random.randrange(256) for _ in range(3))
+        time.sleep(delay)
+        if failed:
+            raise FakeProviderError(status)
+        return Image.new("RGB", (width, height), color)
+
+
+class FakeTelegram:
+    """Фейковый Bot API: отвечает правдоподобным JSON и записывает все вызовы по чатам"""
+
+    class Response:
+        def __init__(self, payload, status_code=200):
+            self.status_code = status_code
+            self.reason = "OK" if status_code == 200 else "Too Many Requests"
+            self._payload = payload
+            self.text = json.dumps(payload)
+
+        def json(self):
+            return self._payload
+
+    def __init__(self, api_latency=0.0, flood_control=False):
+        self.api_latency = api_latency
+        self.calls = 0
+        self.methods = {}
+        self.rejected = 0
+        # Как у настоящего Telegram: ~30 сообщений в секунду на бота и ~1 в секунду на чат, сверх - 429
+        self._flood = None
+        if flood_control:
+            from ratelimit import TokenBucket
+            self._flood = (TokenBucket(30, 30), collections.defaultdict(lambda: TokenBucket(1, 3)))
+        self._message_ids = itertools.count(1000)
+        self._events = {}
+        self._cond = threading.Condition()
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        params = params or {}
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        if name == "getMe":
+            return self.Response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench",
+                                                         "username": "bench_bot"}})
+
+        chat_id = int(params.get("chat_id", 0))
+        if self._flood is not None and name.startswith(("send", "edit", "delete")):
+            retry_after = self._flood_wait(chat_id)
+            if retry_after:
+                return self.Response({"ok": False, "error_code": 429,
+                                      "description": f"Too Many Requests: retry after {retry_after}",
+                                      "parameters": {"retry_after": retry_after}}, status_code=429)
+        message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}}
+        photo = [{"file_id": f"file{message['message_id']}", "file_unique_id": "u", "width": 1, "height": 1}]
+        if name == "sendPhoto":
+            message["photo"] = photo
+        result = message
+        if name == "sendMediaGroup":
+            count = len(json.loads(params.get("media", "[]")))
+            result = [dict(message, message_id=next(self._message_ids), photo=photo) for _ in range(count)]
+        elif name in ("deleteMessage", "answerCallbackQuery"):
+            result = True
+
+        message_id = int(params.get("message_id") or message["message_id"])
+        with self._cond:
+            self.calls += 1
+            self.methods[name] = self.methods.get(name, 0) + 1
+            self._events.setdefault(chat_id, []).append(
+                (time.monotonic(), name, params.get("text", ""), params.get("reply_markup"), message_id))
+            self._cond.notify_all()
+        return self.Response({"ok": True, "result": result})
+
+    def _flood_wait(self, chat_id):
+        """0, если запрос укладывается в лимиты, иначе Retry-After в секундах"""
+        global_bucket, chat_buckets = self._flood
+        with self._cond:
+            chat_bucket = chat_buckets[chat_id]
+            if chat_bucket.try_acquire():
+                if global_bucket.try_acquire():
+                    return 0
+                wait = global_bucket.time_until_available()
+            else:
+                wait = chat_bucket.time_until_available()
+            self.rejected += 1
+        return max(1, math.ceil(wait))
+
+    def mark(self, chat_id):
+        """Сколько событий уже было в чате - точка отсчета для wait_for"""
+        with self._cond:
+            return len(self._events.get(chat_id, ()))
+
+    def find_button(self, chat_id, label):
+        """Последнее сообщение чата с inline-кнопкой label: (message_id, callback_data) или None"""
+        with self._cond:
+            events = list(self._events.get(chat_id, ()))
+        for _, _, _, markup, message_id in reversed(events):
+            if not markup or "inline_keyboard" not in markup:
+                continue
+            for row in json.loads(markup)["inline_keyboard"]:
+                for button in row:
+                    if button["text"] == label:
+                        return message_id, button["callback_data"]
+        return None
+
+    def wait_for(self, chat_id, since, predicate, timeout):
+        """Ждет событие чата после since, подходящее под predicate(name, text). Возвращает (время, событие)"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for event in self._events.get(chat_id, [])[since:]:
+                    if predicate(event[1], event[2]):
+                        return event
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "mean": statistics.fmean(values) if values else float("nan"),
+    }
+
+
+class Conversation:
+    """Один пользователь: проходит мастер и ждет эскиз"""
+
+    def __init__(self, bench, chat_id, round_index):
+        self.bench = bench
+        self.chat_id = chat_id
+        self.round_index = round_index
+        self.random = random.Random(chat_id * 1000 + round_index)
+
+    def answer(self, text):
+        """Выбор варианта: нажатие inline-кнопки или сообщение с текстом кнопки (режим reply)"""
+        if self.bench.args.wizard == "inline":
+            button = self.bench.telegram.find_button(self.chat_id, text)
+            if button is None:
+                raise TimeoutError(f"нет кнопки {text!r}")
+            self.bench.deliver_callback(self.chat_id, *button)
+        else:
+            self.bench.deliver(self.chat_id, text)
+
+    def step(self, text, button=False):
+        """Отправляет сообщение (или жмет кнопку) и ждет, пока обработчик ответит и перейдет к следующему шагу.
+
+        Возвращает задержку обработчика. Обработчик сначала отвечает, а потом
+        сохраняет состояние, поэтому ждем и смену состояния - иначе следующее
+        сообщение может обогнать его.
+        """
+        telegram = self.bench.telegram
+        sessions = self.bench.main.sessions
+        state_before = sessions.get_state(self.chat_id)
+        since = telegram.mark(self.chat_id)
+        started = time.monotonic()
+        if button:
+            self.answer(text)
+        else:
+            self.bench.deliver(self.chat_id, text)
+        event = telegram.wait_for(self.chat_id, since, lambda name, _: name in ("sendMessage", "editMessageText"),
+                                  self.bench.step_timeout)
+        if event is None:
+            raise TimeoutError(f"нет ответа на {text!r}")
+        deadline = time.monotonic() + self.bench.step_timeout
+        while sessions.get_state(self.chat_id) == state_before:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"обработчик не перешел к следующему шагу после {text!r}")
+            time.sleep(0.001)
+        return time.monotonic() - started
+
+    def run(self):
+        subject = self.random.choice(SUBJECTS)
+        if not self.bench.args.same_subject:
+            subject = f"{subject}, variant {self.chat_id}-{self.round_index}"
+
+        handler_latencies = [
+            self.step("/generate"),
+            self.step(self.random.choice(STYLES), button=True),
+            self.step(self.random.choice(BODY_PARTS), button=True),
+            self.step(subject),
+            self.step(self.random.choice(COLORS), button=True),
+        ]
+
+        # Последний шаг мастера: дальше ждем сам эскиз
+        telegram = self.bench.telegram
+        since = telegram.mark(self.chat_id)
+        started = time.monotonic()
+        self.answer(self.bench.quality_title)
+        event = telegram.wait_for(
+            self.chat_id, since,
+            lambda name, text: SUCCESS_MARK in text or any(mark in text for mark in FAILURE_MARKS),
+            self.bench.generation_timeout,
+        )
+        if event is None:
+            return handler_latencies, None, "timeout"
+        outcome = "ok" if SUCCESS_MARK in event[2] else "failed"
+        photo = telegram.wait_for(self.chat_id, since, lambda name, _: name == "sendPhoto", 0)
+        end_to_end = (photo or event)[0] - started
+        return handler_latencies, end_to_end, outcome
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.step_timeout = args.step_timeout
+        self.generation_timeout = args.generation_timeout
+        self._update_ids = itertools.count(1)
+
+        self.workdir = tempfile.mkdtemp(prefix="tattoo-bench-")
+        prepare_environment(self.workdir, args.telegram_flood)
+        os.environ["WIZARD_MODE"] = args.wizard
+
+        from telebot import apihelper
+
+        self.telegram = FakeTelegram(api_latency=args.telegram_latency, flood_control=args.telegram_flood)
+        apihelper.CUSTOM_REQUEST_SENDER = self.telegram
+
+        import main
+        self.main = main
+        if not args.verbose:
+            # Логи каждой генерации заглушают отчет; ошибки все равно видны
+            logging.getLogger().setLevel(logging.WARNING)
+        self.provider = FakeInferenceClient(args.latency, args.jitter, args.error_rate, seed=args.seed)
+        for provider in main.provider_chain.providers:
+            provider.client = self.provider
+        self.quality_title = main.QUALITY_TIERS[args.quality]["title"]
+
+    def deliver(self, chat_id, text):
+        """Передает боту обновление так же, как polling или webhook"""
+        from telebot import types
+
+        update_id = next(self._update_ids)
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.main.bot.process_new_updates([types.Update.de_json({"update_id": update_id, "message": message})])
+
+    def deliver_callback(self, chat_id, message_id, data):
+        """Нажатие inline-кнопки под сообщением бота"""
+        from telebot import types
+
+        update_id = next(self._update_ids)
+        user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+        call = {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"}, "from": dict(user, id=1, is_bot=True)},
+        }
+        self.main.bot.process_new_updates([types.Update.de_json({"update_id": update_id, "callback_query": call})])
+
+    def run(self):
+        main = self.main
+        main.archive_writer.start()
+        main.generation_queue.start()
+
+        tracemalloc.start()
+        handler_latencies, end_to_end, outcomes = [], [], {}
+        lock = threading.Lock()
+
+        def user(chat_id):
+            for round_index in range(self.args.rounds):
+                try:
+                    handlers, total, outcome = Conversation(self, chat_id, round_index).run()
+                except TimeoutError as e:
+                    handlers, total, outcome = [], None, "timeout"
+                    print(f"⚠️ Чат {chat_id}: {e}", file=sys.stderr)
+                with lock:
+                    handler_latencies.extend(handlers)
+                    if total is not None and outcome == "ok":
+                        end_to_end.append(total)
+                    outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+        started = time.monotonic()
+        threads = []
+        for index in range(self.args.chats):
+            thread = threading.Thread(target=user, args=(100000 + index,), name=f"bench-user-{index}")
+            thread.start()
+            threads.append(thread)
+            if self.args.ramp:
+                time.sleep(self.args.ramp / self.args.chats)
+        for thread in threads:
+            thread.join()
+        wall_time = time.monotonic() - started
+
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        main.generation_queue.stop(timeout=5)
+        main.archive_writer.stop()
+
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            max_rss *= 1024  # в Linux ru_maxrss в килобайтах
+
+        return {
+            "config": {
+                "chats": self.args.chats,
+                "rounds": self.args.rounds,
+                "latency": self.args.latency,
+                "jitter": self.args.jitter,
+                "error_rate": self.args.error_rate,
+                "quality": self.args.quality,
+                "workers": main.GENERATION_WORKERS,
+                "queue_backend": main.JOB_QUEUE_BACKEND,
+                "session_backend": main.SESSION_BACKEND,
+                "preview": main.PREVIEW_ENABLED,
+                "wizard": main.WIZARD_MODE,
+            },
+            "wall_time": wall_time,
+            "outcomes": outcomes,
+            "throughput_per_minute": outcomes.get("ok", 0) / wall_time * 60 if wall_time else 0.0,
+            "end_to_end": summarize(end_to_end),
+            "handler": summarize(handler_latencies),
+            "provider_calls": self.provider.calls,
+            "telegram_calls": self.telegram.calls,
+            "telegram_methods": dict(self.telegram.methods),
+            "telegram_rejected": self.telegram.rejected,
+            "python_peak_mb": traced_peak / 1024 / 1024,
+            "max_rss_mb": max_rss / 1024 / 1024,
+        }
+
+
+def print_report(result):
+    config = result["config"]
+    print("=" * 60)
+    print("📊 Бенчмарк TattooKaterokBot (фейковый провайдер и Telegram)")
+    print("=" * 60)
+    print(f"👥 Чатов: {config['chats']} × {config['rounds']}, качество: {config['quality']}, "
+          f"воркеров: {config['workers']}, очередь: {config['queue_backend']}, сессии: {config['session_backend']}")
+    print(f"🤖 Провайдер: {config['latency']} с ± {config['jitter']}, ошибок {config['error_rate']:.0%}, "
+          f"черновик: {'да' if config['preview'] else 'нет'}, мастер: {config['wizard']}")
+    print(f"⏱️ Общее время: {result['wall_time']:.1f} с")
+    print(f"✅ Результаты: {result['outcomes']}")
+    print(f"🚀 Пропускная способность: {result['throughput_per_minute']:.1f} эскизов/мин")
+    for title, key in (("Конец мастера -> эскиз", "end_to_end"), ("Ответ обработчика", "handler")):
+        stats = result[key]
+        print(f"📈 {title}: p50 {stats['p50']:.3f} с, p95 {stats['p95']:.3f} с, "
+              f"p99 {stats['p99']:.3f} с (n={stats['count']})")
+    print(f"📤 Запросов к провайдеру: {result['provider_calls']}, к Bot API: {result['telegram_calls']}")
+    methods = ", ".join(f"{name} {count}" for name, count in sorted(result["telegram_methods"].items()))
+    print(f"📨 Bot API по методам: {methods}")
+    if result["telegram_rejected"]:
+        print(f"🚦 Отклонено Telegram (429): {result['telegram_rejected']}")
+    print(f"💾 Память: пик Python {result['python_peak_mb']:.1f} МБ, max RSS {result['max_rss_mb']:.1f} МБ")
+
+
+def main_entry():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк TattooKaterokBot")
+    parser.add_argument("--chats", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--rounds", type=int, default=1, help="сколько эскизов заказывает каждый пользователь")
+    parser.add_argument("--latency", type=float, default=1.0, help="медианная задержка провайдера, с (20 шагов)")
+    parser.add_argument("--jitter", type=float, default=0.3, help="разброс задержки (sigma логнормального)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429/503")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка каждого вызова Bot API, с")
+    parser.add_argument("--telegram-flood", action="store_true",
+                        help="фейковый Telegram отвечает 429 сверх 30 сообщений/с на бота и 1/с на чат")
+    parser.add_argument("--quality", default="standard", help="уровень качества: draft, standard, high")
+    parser.add_argument("--wizard", choices=("inline", "reply"), default="reply",
+                        help="мастер на inline-кнопках или на клавиатуре под полем ввода")
+    parser.add_argument("--same-subject", action="store_true", help="одинаковые описания (проверка кэша)")
+    parser.add_argument("--ramp", type=float, default=0.0, help="за сколько секунд подключить всех пользователей")
+    parser.add_argument("--seed", type=int, default=None, help="сид генератора задержек и ошибок")
+    parser.add_argument("--step-timeout", type=float, default=30.0, help="ожидание ответа на шаг мастера, с")
+    parser.add_argument("--generation-timeout", type=float, default=600.0, help="ожидание эскиза, с")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    args = parser.parse_args()
+
+    result = Benchmark(args).run()
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main_entry()
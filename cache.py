@@ -0,0 +1,233 @@
+"""Кэш готовых изображений и file_id уже загруженных в Telegram фото"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(**params):
+    """Стабильный ключ кэша: sha256 от отсортированных параметров генерации"""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Кэш изображений: файлы на диске плюс LRU-индекс в памяти.
+
+    Индекс хранит для каждого ключа путь, размер и время создания; порядок
+    OrderedDict - порядок последнего использования. Записи вытесняются по
+    количеству, суммарному размеру и возрасту.
+    """
+
+    def __init__(self, directory, max_items=500, max_bytes=500 * 1024 * 1024, max_age=7 * 24 * 3600):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self._index = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def _load_index(self):
+        """Восстанавливает индекс по файлам на диске (старые файлы - первыми на вытеснение)"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bin"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name[:-4], stat.st_size))
+
+        for mtime, key, size in sorted(entries):
+            self._index[key] = (size, mtime)
+            self._total_bytes += size
+
+        with self._lock:
+            self._evict()
+        logger.info(f"🗃️ Кэш результатов: {len(self._index)} записей, {self._total_bytes / 1024 / 1024:.1f} МБ")
+
+    def get(self, key):
+        """Возвращает байты изображения или None"""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if self._expired(entry):
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._index.move_to_end(key)
+
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._remove(key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def __contains__(self, key):
+        """Есть ли живая запись: просроченная, как и в get(), считается отсутствующей"""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return False
+            if self._expired(entry):
+                self._remove(key)
+                return False
+            return True
+
+    def _expired(self, entry):
+        return bool(self.max_age) and time.time() - entry[1] > self.max_age
+
+    def put(self, key, data):
+        """Сохраняет изображение в кэш (атомарно через временный файл)"""
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось записать в кэш {key[:12]}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            old = self._index.pop(key, None)
+            if old:
+                self._total_bytes -= old[0]
+            self._index[key] = (len(data), time.time())
+            self._total_bytes += len(data)
+            self._evict()
+
+    def stats(self):
+        """Краткая статистика для /status"""
+        with self._lock:
+            return {
+                "items": len(self._index),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _evict(self):
+        now = time.time()
+        if self.max_age:
+            expired = [key for key, (_, created_at) in self._index.items() if now - created_at > self.max_age]
+            for key in expired:
+                self._remove(key)
+
+        while self._index and (len(self._index) > self.max_items or self._total_bytes > self.max_bytes):
+            key = next(iter(self._index))
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._index.pop(key, None)
+        if entry:
+            self._total_bytes -= entry[0]
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class FileIdStore:
+    """Постоянное соответствие хэш изображения -> file_id в Telegram.
+
+    Telegram хранит загруженные фото, поэтому повторная отправка по file_id
+    не требует загрузки байтов. Хранилище - JSON-файл, старые записи
+    вытесняются при превышении max_items. Снимки пишутся по одному и по
+    номеру версии: запоздавший старый снимок не затирает более новый.
+    """
+
+    def __init__(self, path, max_items=5000):
+        self.path = path
+        self.max_items = max_items
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._version = 0
+        self._saved_version = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._items.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать {self.path}: {e}")
+
+    def get(self, key):
+        with self._lock:
+            return self._items.get(key)
+
+    def set(self, key, file_id):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = file_id
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+            self._version += 1
+            version, snapshot = self._version, dict(self._items)
+        self._save(snapshot, version)
+
+    def discard(self, key):
+        with self._lock:
+            if self._items.pop(key, None) is None:
+                return
+            self._version += 1
+            version, snapshot = self._version, dict(self._items)
+        self._save(snapshot, version)
+
+    def _save(self, items, version):
+        with self._save_lock:
+            if version <= self._saved_version:
+                # Пока ждали, уже записан снимок новее
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(items, f)
+                os.replace(tmp_path, self.path)
+                self._saved_version = version
+            except OSError as e:
+                logger.warning(f"⚠️ Не удалось сохранить {self.path}: {e}")
+
+
+def image_hash(data):
+    """Хэш содержимого изображения"""
+    return hashlib.sha256(data).hexdigest()
@@ -0,0 +1,160 @@
+"""Каталог мастера: стили, части тела и цветовые схемы с фрагментами промптов.
+
+Все варианты описаны здесь один раз. При импорте каталог проверяется и
+превращается в неизменяемые таблицы поиска и готовые клавиатуры, которые
+обработчики переиспользуют, а не собирают заново на каждое сообщение.
+"""
+import collections
+import types as pytypes
+
+from telebot import types
+
+Option = collections.namedtuple("Option", ["title", "prompt"])
+
+# callback_data кнопок мастера: "w" + код раздела + номер варианта, например "wb12".
+# Номер вместо названия - короче лимита Telegram в 64 байта и не зависит от кириллицы
+CALLBACK_PREFIX = "w"
+
+
+class CatalogError(ValueError):
+    """Каталог описан с ошибкой: бот не должен стартовать с такими данными"""
+
+
+class Section:
+    """Варианты одного шага мастера: название -> фрагмент промпта и клавиатура.
+
+    markup (клавиатура под полем ввода) и inline_markup (кнопки под
+    сообщением) общие для всех сообщений - их нельзя изменять после создания.
+    """
+
+    def __init__(self, name, code, options, default=None, row_width=2, fallback_prompt=None):
+        self.name = name
+        self.code = code
+        self.options = tuple(Option(*option) for option in options)
+        self.titles = tuple(option.title for option in self.options)
+        self.prompts = pytypes.MappingProxyType({option.title: option.prompt for option in self.options})
+        self._folded = pytypes.MappingProxyType({title.casefold(): title for title in self.titles})
+        self.default = default
+        self.row_width = row_width
+        self.fallback_prompt = fallback_prompt
+        self._validate()
+        self.markup = self._build_markup()
+        self.inline_markup = self._build_inline_markup()
+
+    def _validate(self):
+        if not self.options:
+            raise CatalogError(f"{self.name}: нет ни одного варианта")
+        if len(self.prompts) != len(self.options):
+            duplicates = sorted({title for title in self.titles if self.titles.count(title) > 1})
+            raise CatalogError(f"{self.name}: повторяются названия {duplicates}")
+        for option in self.options:
+            if not option.title.strip() or not option.prompt.strip():
+                raise CatalogError(f"{self.name}: пустое название или промпт у {option!r}")
+            if len(option.title.encode("utf-8")) > 64:
+                # Текст кнопки приходит обратно сообщением - держим его коротким
+                raise CatalogError(f"{self.name}: слишком длинное название {option.title!r}")
+        if self.default is not None and self.default not in self.prompts:
+            raise CatalogError(f"{self.name}: вариант по умолчанию {self.default!r} не найден")
+        if self.default is None and self.fallback_prompt is None:
+            raise CatalogError(f"{self.name}: нужен вариант по умолчанию или запасной промпт")
+
+    def _build_markup(self):
+        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=self.row_width)
+        for i in range(0, len(self.titles), self.row_width):
+            markup.row(*self.titles[i:i + self.row_width])
+        return markup
+
+    def _build_inline_markup(self):
+        markup = types.InlineKeyboardMarkup(row_width=self.row_width)
+        markup.add(*(types.InlineKeyboardButton(title, callback_data=self.callback_data(index))
+                     for index, title in enumerate(self.titles)))
+        return markup
+
+    def callback_data(self, index):
+        return f"{CALLBACK_PREFIX}{self.code}{index}"
+
+    def from_callback(self, data):
+        """Название варианта по callback_data кнопки или None, если кнопка не из этого раздела"""
+        prefix = CALLBACK_PREFIX + self.code
+        if not data or not data.startswith(prefix) or not data[len(prefix):].isdigit():
+            return None
+        index = int(data[len(prefix):])
+        return self.titles[index] if index < len(self.titles) else None
+
+    def __contains__(self, title):
+        return title in self.prompts
+
+    def __len__(self):
+        return len(self.options)
+
+    def find(self, text):
+        """Название по вводу пользователя: без учета регистра, "_" вместо пробела, можно начало названия"""
+        needle = text.replace("_", " ").strip().casefold()
+        if not needle:
+            return None
+        title = self._folded.get(needle)
+        if title:
+            return title
+        matches = [title for folded, title in self._folded.items() if folded.startswith(needle)]
+        return matches[0] if len(matches) == 1 else None
+
+    def resolve(self, title):
+        """Название из каталога или вариант по умолчанию"""
+        return title if title in self.prompts else self.default
+
+    def prompt(self, title):
+        """Фрагмент промпта; для неизвестного названия - по умолчанию или запасной"""
+        prompt = self.prompts.get(title)
+        if prompt is not None:
+            return prompt
+        if self.default is not None:
+            return self.prompts[self.default]
+        return self.fallback_prompt
+
+
+STYLES = Section("Стили", "s", [
+    ("Минимализм", "minimalist tattoo design, clean thin lines, simple elegant design, single needle style, delicate, subtle"),
+    ("Традишнл", "traditional tattoo, american traditional style, bold black outlines, limited color palette, sailor jerry style, tattoo flash"),
+    ("Реализм", "realistic tattoo, photorealistic, detailed shading, 3D effect, skin texture, hyperrealistic tattoo art"),
+    ("Акварель", "watercolor tattoo, paint splashes effect, soft edges, blended colors, artistic, painterly style"),
+    ("Геометрия", "geometric tattoo, sacred geometry, mandala pattern, symmetrical, precise lines, dotwork, intricate patterns"),
+    ("Блэкворк", "blackwork tattoo, solid black areas, heavy black fill, ornamental patterns, bold contrast"),
+    ("Лайнворк", "linework tattoo, continuous line drawing, single line art, elegant contours, minimalist line art"),
+    ("Трайбл", "tribal tattoo, polynesian tattoo patterns, maori design, cultural motifs, flowing black lines"),
+    ("Биомеханика", "biomechanical tattoo, H.R. Giger style, mechanical parts integrated with flesh, cyborg, industrial"),
+    ("Олдскул", "old school tattoo, vintage flash, classic designs, bold lines, roses, anchors, swallows"),
+    ("Японский", "japanese irezumi tattoo, traditional japanese style, koi fish, dragons, waves, chrysanthemums"),
+    ("Скетч", "sketch style tattoo, pencil drawing style, rough lines, artistic sketch, hand-drawn look"),
+    ("Киберпанк", "cyberpunk tattoo, neon colors, glitch effect, digital art style, futuristic, techwear"),
+], default="Минимализм", row_width=3)
+
+# Часть тела можно ввести и своим текстом - тогда в промпт идет общий фрагмент
+BODY_PARTS = Section("Части тела", "b", [
+    ("Плечо", "shoulder tattoo, upper arm placement"),
+    ("Предплечье", "forearm tattoo, arm placement"),
+    ("Запястье", "wrist tattoo, delicate placement"),
+    ("Кисть", "hand tattoo, knuckle tattoo"),
+    ("Грудь", "chest tattoo, sternum tattoo, chest piece"),
+    ("Ребра", "rib tattoo, side body, underboob tattoo"),
+    ("Спина", "back tattoo, full back piece, back artwork"),
+    ("Живот", "stomach tattoo, abdomen tattoo"),
+    ("Шея", "neck tattoo, nape tattoo, throat tattoo"),
+    ("За ухом", "behind ear tattoo, ear tattoo"),
+    ("Лодыжка", "ankle tattoo, foot tattoo"),
+    ("Бедро", "thigh tattoo, leg tattoo"),
+    ("Икра", "calf tattoo, leg tattoo"),
+    ("Лопатка", "shoulder blade tattoo, scapula"),
+    ("Ключица", "collarbone tattoo, clavicle tattoo"),
+], row_width=2, fallback_prompt="tattoo design")
+
+COLORS = Section("Цветовые схемы", "c", [
+    ("Черно-белая", "black and white, monochrome, grayscale, no color"),
+    ("Цветная", "vibrant colors, colorful, saturated, rich colors"),
+    ("Монохром", "monochromatic, single color, tonal variation"),
+    ("С акцентами цвета", "black and white with color accents, color highlights, mostly monochrome"),
+], default="Черно-белая", row_width=2)
+
+# Общие части промпта - одинаковые для всех эскизов
+PROMPT_SUFFIX = "tattoo design, high quality, detailed, professional tattoo art, 8k resolution"
+NEGATIVE_PROMPT = ("blurry, low quality, ugly, deformed, distorted, watermark, text, signature, "
+                   "bad anatomy, extra limbs, missing limbs")
@@ -0,0 +1,96 @@
+"""Разбор однострочных команд генерации: /gen и /batch.
+
+    /gen style=Японский place=Спина color=Цветная koi fish in waves
+    /gen стиль=реал место=за_ухом q=draft "wolf with moon light"
+
+Параметры - пары ключ=значение с ключами из KEY_ALIASES в любом месте
+строки, все остальное (в том числе слова с "=", например E=mc2) -
+описание изображения. Значения ищутся в каталоге без учета регистра,
+достаточно однозначного начала названия; пробел в значении пишется как "_"
+или значение берется в кавычки.
+"""
+import re
+
+import catalog
+
+# Ключ в команде -> поле запроса на генерацию
+KEY_ALIASES = {
+    "style": "style", "стиль": "style", "s": "style",
+    "place": "body_part", "body": "body_part", "part": "body_part", "место": "body_part", "p": "body_part",
+    "color": "color", "colour": "color", "цвет": "color", "c": "color",
+    "quality": "quality", "качество": "quality", "q": "quality",
+}
+
+# Поле запроса -> раздел каталога и название для сообщений об ошибке
+SECTIONS = {
+    "style": (catalog.STYLES, "стиль"),
+    "body_part": (catalog.BODY_PARTS, "часть тела"),
+    "color": (catalog.COLORS, "цвет"),
+}
+
+# Параметром считается только известный ключ в начале слова
+PARAM_RE = re.compile(
+    r'(?<!\S)(' + "|".join(sorted(map(re.escape, KEY_ALIASES), key=len, reverse=True)) + r')=(?:"([^"]*)"|(\S+))',
+    re.IGNORECASE,
+)
+
+
+class CommandSyntaxError(ValueError):
+    """Команду не удалось разобрать; текст ошибки показывается пользователю"""
+
+
+def parse_generation_request(text, qualities, default_quality):
+    """Разбирает строку параметров в запрос на генерацию.
+
+    qualities - словарь {вариант написания в нижнем регистре: уровень качества}.
+    Возвращает словарь style, body_part, subject, color, quality, как у мастера.
+    """
+    request = {
+        "style": catalog.STYLES.default,
+        "body_part": None,
+        "color": catalog.COLORS.default,
+        "quality": default_quality,
+    }
+    errors = []
+    for match in PARAM_RE.finditer(text):
+        key, value = match.group(1).casefold(), match.group(2) if match.group(2) is not None else match.group(3)
+        field = KEY_ALIASES[key]
+        if field == "quality":
+            quality = qualities.get(value.replace("_", " ").strip().casefold())
+            if quality is None:
+                errors.append(f"неизвестное качество «{value}»")
+            request["quality"] = quality
+        else:
+            section, label = SECTIONS[field]
+            title = section.find(value)
+            if title is None:
+                errors.append(f"{label}: не найдено «{value}»")
+            request[field] = title
+
+    # Кавычки вокруг описания не нужны в промпте
+    subject = " ".join(PARAM_RE.sub(" ", text).split()).strip('"\' ')
+    if not subject:
+        errors.append("нет описания изображения")
+    if errors:
+        raise CommandSyntaxError("; ".join(errors))
+    request["subject"] = subject
+    return request
+
+
+def parse_batch(text, qualities, default_quality, max_items):
+    """Каждая непустая строка - отдельный запрос в формате /gen. Ошибки собираются по номерам строк"""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines:
+        raise CommandSyntaxError("нет ни одной строки с эскизом")
+    if len(lines) > max_items:
+        raise CommandSyntaxError(f"слишком много строк: {len(lines)}, максимум {max_items}")
+
+    requests, errors = [], []
+    for number, line in enumerate(lines, 1):
+        try:
+            requests.append(parse_generation_request(line, qualities, default_quality))
+        except CommandSyntaxError as e:
+            errors.append(f"строка {number}: {e}")
+    if errors:
+        raise CommandSyntaxError("\n".join(errors))
+    return requests
@@ -0,0 +1,174 @@
+"""Конечный автомат мастера: таблица шагов и переходов с одним поиском на сообщение.
+
+Вместо цепочки фильтров func=lambda ... == состояние (каждый - отдельное
+чтение сессии) бот регистрирует один обработчик - WizardRouter.dispatch.
+Он читает сессию один раз, берет шаг из словаря по состоянию и вызывает
+его обработчик. Переходы между шагами описаны явно и проверяются; брошенный
+на середине мастер сбрасывается по таймауту.
+
+Нажатия inline-кнопок (callback query) идут через dispatch_callback по той
+же таблице: у шага может быть отдельный обработчик кнопок.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Ключ в данных сессии: когда пользователь перешел на текущий шаг
+STATE_SINCE_KEY = "state_since"
+# Ключ в данных сессии: сообщение мастера, кнопки которого сейчас активны
+MESSAGE_ID_KEY = "wizard_message_id"
+
+
+class InvalidTransitionError(Exception):
+    """Обработчик шага попытался перейти в состояние, которого нет в таблице"""
+
+
+class Step:
+    """Шаг мастера: обработчики текста и кнопок, разрешенные следующие состояния и таймаут"""
+
+    def __init__(self, state, name, handler, next_states=(), timeout=None):
+        self.state = state
+        self.name = name
+        self.handler = handler
+        self.callback = None
+        self.next_states = frozenset(next_states)
+        self.timeout = timeout
+
+    def __repr__(self):
+        return f"Step({self.name})"
+
+
+class WizardRouter:
+    """Маршрутизатор сообщений по состоянию сессии.
+
+    idle_state - состояние вне мастера: у него нет таймаута, а переход в
+    него разрешен из любого шага. on_timeout(message, step) вызывается,
+    когда пользователь вернулся к брошенному мастеру. on_stale(call) -
+    нажата кнопка не текущего шага или старого сообщения. on_dispatch(step,
+    seconds, error) и on_transition(from_step, to_step) - хуки для метрик.
+    """
+
+    def __init__(self, sessions, idle_state=0, timeout=None, on_timeout=None, on_stale=None,
+                 on_dispatch=None, on_transition=None):
+        self.sessions = sessions
+        self.idle_state = idle_state
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.on_stale = on_stale
+        self.on_dispatch = on_dispatch
+        self.on_transition = on_transition
+        self.steps = {}
+        self._local = threading.local()
+
+    def step(self, state, name, next_states=(), timeout=None):
+        """Декоратор: регистрирует обработчик шага. timeout=None - общий таймаут роутера"""
+        def register(handler):
+            if state in self.steps:
+                raise ValueError(f"Шаг для состояния {state} уже зарегистрирован: {self.steps[state]}")
+            self.steps[state] = Step(state, name, handler, next_states,
+                                     None if state == self.idle_state else timeout or self.timeout)
+            return handler
+        return register
+
+    def callback(self, state):
+        """Декоратор: обработчик нажатий inline-кнопок для уже зарегистрированного шага"""
+        def register(handler):
+            self.steps[state].callback = handler
+            return handler
+        return register
+
+    def validate(self):
+        """Проверяет таблицу при старте: у idle есть обработчик, все переходы ведут к известным шагам"""
+        if self.idle_state not in self.steps:
+            raise ValueError("Нет обработчика для состояния вне мастера")
+        for step in self.steps.values():
+            unknown = [state for state in step.next_states if state not in self.steps]
+            if unknown:
+                raise ValueError(f"{step}: переходы в незарегистрированные состояния {unknown}")
+
+    def dispatch(self, message):
+        """Единственный обработчик сообщений бота: одно чтение сессии и один поиск шага"""
+        chat_id = message.chat.id
+        state, data = self.sessions.get_session(chat_id)
+        step = self.steps.get(state)
+        if step is None:
+            logger.warning(f"⚠️ Неизвестное состояние {state} у {chat_id}, сбрасываю мастер")
+            self.sessions.set_state(chat_id, self.idle_state)
+            step = self.steps[self.idle_state]
+
+        if self._expired(chat_id, step, data):
+            if self.on_timeout:
+                self.on_timeout(message, step)
+            return
+        self._run(chat_id, step, step.handler, message)
+
+    def dispatch_callback(self, call):
+        """Нажатие inline-кнопки: тот же поиск шага, плюс проверка, что кнопка актуальна"""
+        chat_id = call.message.chat.id
+        state, data = self.sessions.get_session(chat_id)
+        step = self.steps.get(state)
+        if (step is None or step.callback is None or data.get(MESSAGE_ID_KEY) != call.message.message_id
+                or self._expired(chat_id, step, data)):
+            if self.on_stale:
+                self.on_stale(call)
+            return
+        self._run(chat_id, step, step.callback, call)
+
+    def is_stale(self, call):
+        """Та же проверка актуальности кнопки, что в dispatch_callback, но без сброса мастера"""
+        state, data = self.sessions.get_session(call.message.chat.id)
+        step = self.steps.get(state)
+        return (step is None or step.callback is None or data.get(MESSAGE_ID_KEY) != call.message.message_id
+                or self._timed_out(step, data))
+
+    @staticmethod
+    def _timed_out(step, data):
+        since = data.get(STATE_SINCE_KEY)
+        return bool(step.timeout and since and time.time() - since > step.timeout)
+
+    def _expired(self, chat_id, step, data):
+        """Сбрасывает мастер, если пользователь слишком долго не отвечал на шаге"""
+        if not self._timed_out(step, data):
+            return False
+        logger.info(f"⌛ Мастер {chat_id} брошен на шаге {step.name}, сбрасываю")
+        self._local.context = (chat_id, step)
+        try:
+            self.transition(chat_id, self.idle_state)
+        finally:
+            self._local.context = None
+        return True
+
+    def _run(self, chat_id, step, handler, update):
+        self._local.context = (chat_id, step)
+        start = time.monotonic()
+        error = None
+        try:
+            handler(update)
+        except Exception as e:
+            error = e
+            logger.error(f"❌ Ошибка на шаге {step.name}: {e}")
+        finally:
+            self._local.context = None
+        if self.on_dispatch:
+            self.on_dispatch(step, time.monotonic() - start, error)
+
+    def transition(self, chat_id, state, **values):
+        """Переводит пользователя в state и сохраняет values той же записью.
+
+        Внутри обработчика шага переход проверяется по таблице; команды
+        (/generate, /start) могут начинать мастер из любого состояния.
+        """
+        if state not in self.steps:
+            raise InvalidTransitionError(f"Неизвестное состояние {state}")
+        context = getattr(self._local, "context", None)
+        from_step = None
+        if context and context[0] == chat_id:
+            from_step = context[1]
+            if state != self.idle_state and state != from_step.state and state not in from_step.next_states:
+                raise InvalidTransitionError(f"Переход {from_step.name} -> {self.steps[state].name} не разрешен")
+        values[STATE_SINCE_KEY] = time.time()
+        self.sessions.set_state(chat_id, state, **values)
+        if self.on_transition:
+            self.on_transition(from_step, self.steps[state])
@@ -0,0 +1,77 @@
+"""Кодирование изображений для отправки в Telegram и архива"""
+import io
+import logging
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Формат -> (имя формата PIL, расширение, MIME)
+IMAGE_FORMATS = {
+    "png": ("PNG", "png", "image/png"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+}
+
+
+class EncodedImage:
+    """Закодированное изображение: байты плюс формат и статистика кодирования.
+
+    source - чем сгенерировано ("модель (провайдер)"), None - неизвестно (например, из кэша).
+    """
+
+    def __init__(self, data, fmt, encode_time=0.0, source=None):
+        self.data = data
+        self.format = fmt
+        self.encode_time = encode_time
+        self.source = source
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def extension(self):
+        return IMAGE_FORMATS[self.format][1]
+
+    @property
+    def mime_type(self):
+        return IMAGE_FORMATS[self.format][2]
+
+    def as_file(self, name="tattoo"):
+        """BytesIO с именем файла - в таком виде его принимает telebot"""
+        buffer = io.BytesIO(self.data)
+        buffer.name = f"{name}.{self.extension}"
+        return buffer
+
+    def __repr__(self):
+        return f"EncodedImage({self.format}, {self.size / 1024:.0f} КБ, {self.encode_time * 1000:.0f} мс)"
+
+
+def encode_image(image, fmt="png", quality=92, png_compress_level=6):
+    """Кодирует PIL-изображение один раз в указанный формат.
+
+    png - без потерь (оригинал для архива и отправки документом),
+    jpeg/webp - компактное превью для отправки фото.
+    """
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Неизвестный формат изображения: {fmt}")
+
+    pil_format = IMAGE_FORMATS[fmt][0]
+    start_time = time.time()
+    buffer = io.BytesIO()
+
+    if fmt == "png":
+        image.save(buffer, format=pil_format, compress_level=png_compress_level)
+    elif fmt == "jpeg":
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(buffer, format=pil_format, quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, format=pil_format, quality=quality, method=4)
+
+    encoded = EncodedImage(buffer.getvalue(), fmt, time.time() - start_time)
+    metrics.ENCODE_SECONDS.observe(encoded.encode_time, format=fmt)
+    logger.info(f"🖼 Кодирование {fmt.upper()}: {encoded.encode_time * 1000:.0f} мс, {encoded.size / 1024:.0f} КБ")
+    return encoded
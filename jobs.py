@@ -0,0 +1,682 @@
+"""Очередь задач генерации эскизов с пулом воркеров"""
+import collections
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from scheduler import FairScheduler, round_robin
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Очередь генерации переполнена"""
+
+
+class JobCancelledError(Exception):
+    """Задача отменена: пользователь вызвал /cancel или начал новый эскиз"""
+
+
+class CancellationToken:
+    """Флаг отмены задачи. Воркер проверяет его между этапами и в паузах ожидания"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="cancel"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def wait(self, timeout):
+        """Пауза, которую прерывает отмена. True - задача отменена"""
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise JobCancelledError(self.reason)
+
+
+class GenerationJob:
+    """Задача генерации: все данные, нужные воркеру, без ссылок на состояние бота"""
+
+    def __init__(self, chat_id, kind, data=None, message_id=None, job_id=None):
+        self.job_id = job_id or uuid.uuid4().hex[:8]
+        self.chat_id = chat_id
+        self.kind = kind
+        self.data = dict(data or {})
+        self.message_id = message_id
+        self.created_at = time.time()
+        self.started_at = None
+        # Не сериализуется: отмену в другой процесс передает очередь
+        self.token = CancellationToken()
+
+    def __repr__(self):
+        return f"GenerationJob({self.job_id}, chat={self.chat_id}, kind={self.kind})"
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "chat_id": self.chat_id,
+            "kind": self.kind,
+            "data": self.data,
+            "message_id": self.message_id,
+            "created_at": self.created_at,
+        }
+
+    @classmethod
+    def from_dict(cls, payload):
+        job = cls(payload["chat_id"], payload["kind"], payload.get("data"),
+                  payload.get("message_id"), payload["job_id"])
+        job.created_at = payload.get("created_at", job.created_at)
+        return job
+
+
+class JobJournal:
+    """Журнал задач очереди в памяти (write-ahead) в SQLite.
+
+    Задача записывается до того, как ее увидят воркеры, отмечается при
+    взятии в работу и удаляется после завершения. После падения или
+    перезапуска незавершенные задачи поднимаются из журнала снова.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "job_id TEXT PRIMARY KEY, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "created_at REAL NOT NULL, started_at REAL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def queued(self, job):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO journal (job_id, payload, status, created_at) VALUES (?, ?, 'queued', ?)",
+            (job.job_id, json.dumps(job.to_dict(), ensure_ascii=False), job.created_at),
+        )
+        conn.commit()
+
+    def running(self, job):
+        """Задача взята в работу: attempts считает запуски, после которых она не завершилась"""
+        conn = self._conn()
+        conn.execute(
+            "UPDATE journal SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE job_id = ?",
+            (job.started_at, job.job_id),
+        )
+        conn.commit()
+
+    def remove(self, job_id):
+        conn = self._conn()
+        conn.execute("DELETE FROM journal WHERE job_id = ?", (job_id,))
+        conn.commit()
+
+    def unfinished(self):
+        """Незавершенные задачи [(задача, статус, запусков)] в порядке постановки"""
+        rows = self._conn().execute("SELECT payload, status, attempts FROM journal ORDER BY created_at").fetchall()
+        return [(GenerationJob.from_dict(json.loads(payload)), status, attempts) for payload, status, attempts in rows]
+
+
+class JobQueue:
+    """Ограниченная очередь задач и пул потоков-воркеров.
+
+    handler(job) выполняется в потоке воркера. on_position(job, position)
+    вызывается, когда у ожидающей задачи меняется место в очереди.
+    Порядок выдачи и лимиты на пользователя определяет FairScheduler.
+    journal - JobJournal: с ним задачи переживают падение и перезапуск
+    (см. resume); max_attempts - сколько раз задачу можно начать заново.
+    """
+
+    def __init__(self, handler, workers=2, max_size=50, on_position=None, scheduler=None, journal=None,
+                 max_attempts=3):
+        if workers < 1:
+            # Без воркеров задачи из очереди в памяти никто бы не выполнил
+            raise ValueError("Очереди в памяти нужен хотя бы один воркер")
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max(1, max_size)
+        self.on_position = on_position
+        self.journal = journal
+        self.max_attempts = max(1, max_attempts)
+
+        self._pending = scheduler if scheduler is not None else FairScheduler()
+        self._active = {}
+        self._released = set()  # отмененные задачи в работе, чей слот пользователя уже освобожден
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._finish_pending = True
+
+    def start(self):
+        """Запускает потоки-воркеры"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"generation-worker-{i + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"🧵 Запущено воркеров генерации: {self.workers}, размер очереди: {self.max_size}")
+
+    def submit(self, job):
+        """Ставит задачу в очередь и возвращает её позицию (1 - следующая).
+
+        Если очередь заполнена, бросает QueueFullError, если пользователь
+        превысил лимиты - RateLimitedError, не блокируя вызывающий поток.
+        """
+        with self._cond:
+            if self._stopping:
+                raise QueueFullError("Очередь остановлена")
+            if len(self._pending) >= self.max_size:
+                raise QueueFullError(f"В очереди уже {len(self._pending)} задач")
+            self._pending.admit(job.chat_id)
+            if self.journal:
+                # Сначала журнал, потом очередь: задача, которую увидел воркер, уже не потеряется
+                self.journal.queued(job)
+            self._pending.push(job)
+            position = self._pending.ordered().index(job) + 1
+            self._cond.notify()
+        logger.info(f"📥 Задача {job.job_id} ({job.kind}) поставлена в очередь, позиция {position}")
+        return position
+
+    def resume(self):
+        """Возвращает в очередь незавершенные задачи из журнала (после падения или перезапуска).
+
+        Вызывается до start(). Задача, которую уже max_attempts раз начинали
+        и не завершили, считается сбойной и убирается из журнала.
+        Возвращает (возобновленные, отброшенные).
+        """
+        if not self.journal:
+            return [], []
+        resumed, dropped = [], []
+        for job, status, attempts in self.journal.unfinished():
+            if attempts >= self.max_attempts:
+                logger.error(f"❌ Задача {job.job_id} не завершилась за {attempts} запусков, убираю из журнала")
+                self.journal.remove(job.job_id)
+                dropped.append(job)
+                continue
+            with self._cond:
+                self._pending.push(job)
+                self._cond.notify()
+            resumed.append(job)
+        if resumed:
+            logger.info(f"♻️ Возобновлено задач из журнала: {len(resumed)}")
+        return resumed, dropped
+
+    def pending_jobs(self):
+        """Ожидающие задачи в порядке выдачи"""
+        with self._cond:
+            return self._pending.ordered()
+
+    def position(self, job_id):
+        """Позиция задачи в очереди, 0 если задача уже выполняется, None если её нет"""
+        with self._cond:
+            if job_id in self._active:
+                return 0
+            for index, job in enumerate(self._pending.ordered()):
+                if job.job_id == job_id:
+                    return index + 1
+        return None
+
+    def depth(self):
+        """Количество задач, ожидающих воркера"""
+        with self._cond:
+            return len(self._pending)
+
+    def active_count(self):
+        """Количество задач, которые сейчас выполняются"""
+        with self._cond:
+            return len(self._active)
+
+    def cancel(self, chat_id, reason="cancel"):
+        """Отменяет задачи пользователя: ожидающие убираются из очереди, у выполняемых
+        срабатывает токен отмены. Возвращает (убранные из очереди, выполняемые)"""
+        with self._cond:
+            removed = self._pending.remove(chat_id)
+            running = [job for job in self._active.values()
+                       if job.chat_id == chat_id and job.job_id not in self._released]
+            for job in removed + running:
+                job.token.cancel(reason)
+            for job in running:
+                # Слот пользователя освобождается сразу, не дожидаясь, пока воркер дойдет до проверки
+                self._pending.done(job)
+                self._released.add(job.job_id)
+            waiting = self._pending.ordered() if removed else []
+            self._cond.notify_all()
+        if self.journal:
+            for job in removed:
+                self.journal.remove(job.job_id)
+        self._notify_positions(waiting)
+        return removed, running
+
+    def stop(self, timeout=None, finish_pending=True):
+        """Останавливает приём задач и ждёт завершения воркеров.
+
+        finish_pending=False - воркеры доделывают только начатые задачи, а
+        ожидающие остаются в журнале до следующего запуска.
+        """
+        with self._cond:
+            self._stopping = True
+            self._finish_pending = finish_pending
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            thread.join(remaining)
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if self._stopping and not self._finish_pending:
+                    return None, []
+                job = self._pending.pop()
+                if job is not None:
+                    break
+                if self._stopping:
+                    return None, []
+                # Пусто или у всех ожидающих пользователей заняты слоты
+                self._cond.wait()
+            job.started_at = time.time()
+            self._active[job.job_id] = job
+            waiting = self._pending.ordered()
+        return job, waiting
+
+    def _worker_loop(self):
+        while True:
+            job, waiting = self._next_job()
+            if job is None:
+                return
+
+            self._notify_positions(waiting)
+            if self.journal:
+                self.journal.running(job)
+
+            wait_time = job.started_at - job.created_at
+            logger.info(f"⚙️ Задача {job.job_id} взята в работу (ожидание {wait_time:.1f} с)")
+            try:
+                self.handler(job)
+            except Exception as e:
+                logger.error(f"❌ Ошибка в задаче {job.job_id}: {e}")
+            finally:
+                if self.journal:
+                    self.journal.remove(job.job_id)
+                with self._cond:
+                    self._active.pop(job.job_id, None)
+                    if job.job_id in self._released:
+                        self._released.discard(job.job_id)
+                    else:
+                        self._pending.done(job)
+                    # Освободился слот пользователя - его следующая задача может стать доступной
+                    self._cond.notify_all()
+
+    def _notify_positions(self, waiting):
+        if not self.on_position:
+            return
+        for index, job in enumerate(waiting):
+            try:
+                self.on_position(job, index + 1)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось обновить позицию задачи {job.job_id}: {e}")
+
+
+class SqliteJobQueue:
+    """Очередь задач в SQLite: переживает перезапуск и разделяется между процессами.
+
+    Бот (или webhook-приемник) только вызывает submit(), а задачи разбирают
+    воркеры в этом или других процессах (см. worker.py). Задача, которую
+    воркер взял и не завершил за lease_timeout секунд, снова становится
+    доступной - так задачи упавшего процесса не теряются. Задачу, которую уже
+    max_attempts раз брали и не завершили, больше не выдают: она убирается из
+    очереди, а on_dropped(job) сообщает об этом пользователю.
+
+    Отмена выполняемой задачи - статус cancelled в таблице: процесс, который
+    ее выполняет, замечает его при опросе и срабатывает токен отмены.
+    """
+
+    def __init__(self, path, handler=None, workers=0, max_size=50, on_position=None,
+                 lease_timeout=600, poll_interval=0.5, scheduler=None, max_attempts=3, on_dropped=None):
+        self.path = path
+        self.handler = handler
+        self.workers = workers if handler else 0
+        self.max_size = max(1, max_size)
+        self.on_position = on_position
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.max_attempts = max(1, max_attempts)
+        self.on_dropped = on_dropped
+        self.worker_name = f"{socket.gethostname()}:{os.getpid()}"
+        # Лимиты на пользователя проверяются при постановке; круговой порядок - в _claim
+        self.scheduler = scheduler if scheduler is not None else FairScheduler()
+
+        self._local = threading.local()
+        self._threads = []
+        self._stopping = threading.Event()
+        self._running = {}  # job_id -> задача, выполняемая в этом процессе
+        self._running_lock = threading.Lock()
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT UNIQUE NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL, created_at REAL NOT NULL, started_at REAL, worker TEXT, chat_id INTEGER, "
+            "attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if "chat_id" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN chat_id INTEGER")
+        if "attempts" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_chat ON jobs (chat_id, status)")
+        # Когда пользователю последний раз выдали задачу - для кругового порядка
+        conn.execute("CREATE TABLE IF NOT EXISTS job_users (chat_id INTEGER PRIMARY KEY, last_claimed REAL NOT NULL)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"generation-worker-{i + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.workers:
+            thread = threading.Thread(target=self._watch_cancelled, name="generation-cancel-watcher", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"🧵 Очередь SQLite {self.path}: воркеров в процессе {self.worker_name}: {self.workers}")
+
+    def submit(self, job):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_size:
+                raise QueueFullError(f"В очереди уже {queued} задач")
+            user_jobs = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE chat_id = ? AND status IN ('queued', 'running')", (job.chat_id,)
+            ).fetchone()[0]
+            self.scheduler.admit(job.chat_id, user_jobs)
+            conn.execute(
+                "INSERT INTO jobs (job_id, payload, status, created_at, chat_id) VALUES (?, ?, 'queued', ?, ?)",
+                (job.job_id, json.dumps(job.to_dict(), ensure_ascii=False), job.created_at, job.chat_id),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        position = self.position(job.job_id)
+        logger.info(f"📥 Задача {job.job_id} ({job.kind}) поставлена в очередь SQLite, позиция {position}")
+        return position
+
+    def _ordered_queued(self, conn):
+        """Ожидающие задачи (seq, chat_id, job_id, payload) в круговом порядке по пользователям.
+
+        Пользователь встает в круг, когда ставит первую задачу, и уходит в конец
+        круга, когда ему выдают задачу - как в FairScheduler.
+        """
+        last_claimed = dict(conn.execute("SELECT chat_id, last_claimed FROM job_users"))
+        queues = {}
+        entered = {}
+        for row in conn.execute(
+            "SELECT seq, chat_id, job_id, payload, created_at FROM jobs WHERE status = 'queued' ORDER BY seq"
+        ):
+            chat_id = row[1]
+            if chat_id not in queues:
+                queues[chat_id] = []
+                entered[chat_id] = max(row[4], last_claimed.get(chat_id, 0.0))
+            queues[chat_id].append(row[:4])
+        return round_robin([queues[chat_id] for chat_id in sorted(queues, key=entered.get)])
+
+    def position(self, job_id):
+        conn = self._conn()
+        row = conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        if row[0] == "running":
+            return 0
+        for index, queued in enumerate(self._ordered_queued(conn)):
+            if queued[2] == job_id:
+                return index + 1
+        return None
+
+    def depth(self):
+        return self._conn().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def active_count(self):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND started_at >= ?",
+            (time.time() - self.lease_timeout,),
+        ).fetchone()[0]
+
+    def cancel(self, chat_id, reason="cancel"):
+        """Отменяет задачи пользователя во всех процессах. Возвращает (убранные из очереди, выполняемые)"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT payload, status FROM jobs WHERE chat_id = ? AND status IN ('queued', 'running')", (chat_id,)
+            ).fetchall()
+            conn.execute("DELETE FROM jobs WHERE chat_id = ? AND status = 'queued'", (chat_id,))
+            conn.execute("UPDATE jobs SET status = 'cancelled' WHERE chat_id = ? AND status = 'running'", (chat_id,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        removed = [GenerationJob.from_dict(json.loads(payload)) for payload, status in rows if status == "queued"]
+        running = [GenerationJob.from_dict(json.loads(payload)) for payload, status in rows if status == "running"]
+        for job in removed:
+            job.token.cancel(reason)
+        self._cancel_local([job.job_id for job in running], reason)
+        return removed, running
+
+    def _cancel_local(self, job_ids, reason):
+        with self._running_lock:
+            jobs = [self._running[job_id] for job_id in job_ids if job_id in self._running]
+        for job in jobs:
+            job.token.cancel(reason)
+
+    def _watch_cancelled(self):
+        """Передает отмену из других процессов токенам задач, выполняемых здесь"""
+        while not self._stopping.wait(self.poll_interval):
+            with self._running_lock:
+                job_ids = [job_id for job_id, job in self._running.items() if not job.token.cancelled]
+            if not job_ids:
+                continue
+            try:
+                placeholders = ",".join("?" * len(job_ids))
+                cancelled = [job_id for (job_id,) in self._conn().execute(
+                    f"SELECT job_id FROM jobs WHERE status = 'cancelled' AND job_id IN ({placeholders})", job_ids
+                )]
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Не удалось проверить отмену задач: {e}")
+                continue
+            self._cancel_local(cancelled, "cancel")
+
+    def resume(self):
+        """Задачи и так хранятся в SQLite: брошенные подхватываются по истечении аренды"""
+        return [], []
+
+    def pending_jobs(self):
+        """Ожидающие задачи общей очереди не зависят от этого процесса"""
+        return []
+
+    def stop(self, timeout=None, finish_pending=True):
+        """Останавливает воркеры процесса: новые задачи не берутся, начатые дорабатываются.
+
+        Задачи, которые не успели завершиться за timeout, отменяются (причина
+        shutdown) и сразу возвращаются в очередь, чтобы другие воркеры не ждали
+        истечения аренды. Поток, который еще дорабатывает такую задачу, ее
+        строку уже не удалит: она принадлежит новому воркеру.
+        """
+        self._stopping.set()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            thread.join(remaining)
+        with self._running_lock:
+            unfinished = list(self._running.values())
+        if unfinished:
+            for job in unfinished:
+                job.token.cancel("shutdown")
+            conn = self._conn()
+            conn.executemany(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, worker = NULL "
+                "WHERE job_id = ? AND status = 'running' AND worker = ? AND started_at = ?",
+                [(job.job_id, self.worker_name, job.started_at) for job in unfinished],
+            )
+            conn.commit()
+            logger.warning(f"⚠️ Не дождался задач, возвращены в очередь: {len(unfinished)}")
+
+    def _claim(self):
+        """Атомарно забирает задачу: сначала брошенные (истекла аренда), затем
+        ожидающие по кругу среди пользователей со свободным слотом.
+
+        Брошенные задачи, которые уже max_attempts раз брали в работу, удаляются.
+        """
+        conn = self._conn()
+        now = time.time()
+        lease_cutoff = now - self.lease_timeout
+        dropped = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Отмененные задачи упавших процессов больше никто не завершит
+            conn.execute("DELETE FROM jobs WHERE status = 'cancelled' AND started_at < ?", (lease_cutoff,))
+            row = None
+            for expired in conn.execute(
+                "SELECT seq, chat_id, job_id, payload, attempts FROM jobs WHERE status = 'running' AND started_at < ? "
+                "ORDER BY seq",
+                (lease_cutoff,),
+            ).fetchall():
+                if expired[4] >= self.max_attempts:
+                    dropped.append(expired)
+                elif row is None:
+                    row = expired[:4]
+            conn.executemany("DELETE FROM jobs WHERE seq = ?", [(expired[0],) for expired in dropped])
+
+            ordered = self._ordered_queued(conn)
+            if row is None:
+                running = collections.Counter(chat_id for (chat_id,) in conn.execute(
+                    "SELECT chat_id FROM jobs WHERE status = 'running' AND started_at >= ?", (lease_cutoff,)
+                ))
+                row = next((queued for queued in ordered
+                            if running[queued[1]] < self.scheduler.per_user_concurrency), None)
+            if row is None:
+                conn.commit()
+                self._drop(dropped)
+                return None, []
+
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, worker = ?, attempts = attempts + 1 WHERE seq = ?",
+                (now, self.worker_name, row[0]),
+            )
+            conn.execute("INSERT OR REPLACE INTO job_users (chat_id, last_claimed) VALUES (?, ?)", (row[1], now))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        self._drop(dropped)
+        job = GenerationJob.from_dict(json.loads(row[3]))
+        job.started_at = now
+        waiting = [GenerationJob.from_dict(json.loads(queued[3])) for queued in ordered if queued[0] != row[0]]
+        return job, waiting
+
+    def _drop(self, rows):
+        """Сообщает об удаленных сбойных задачах (строки seq, chat_id, job_id, payload, attempts)"""
+        for row in rows:
+            job = GenerationJob.from_dict(json.loads(row[3]))
+            logger.error(f"❌ Задача {job.job_id} не завершилась за {row[4]} запусков, убираю из очереди")
+            if self.on_dropped:
+                try:
+                    self.on_dropped(job)
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось сообщить о сбойной задаче {job.job_id}: {e}")
+
+    def _finish(self, job):
+        """Удаляет строку задачи, только если она все еще за этим воркером: после возврата
+        в очередь или истечения аренды ее уже выполняет кто-то другой"""
+        conn = self._conn()
+        conn.execute("DELETE FROM jobs WHERE job_id = ? AND worker = ? AND started_at = ?",
+                     (job.job_id, self.worker_name, job.started_at))
+        conn.execute(
+            "DELETE FROM job_users WHERE chat_id = ? AND NOT EXISTS (SELECT 1 FROM jobs WHERE chat_id = ?)",
+            (job.chat_id, job.chat_id),
+        )
+        conn.commit()
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                job, waiting = self._claim()
+            except sqlite3.Error as e:
+                logger.error(f"❌ Ошибка очереди SQLite: {e}")
+                self._stopping.wait(self.poll_interval)
+                continue
+
+            if job is None:
+                self._stopping.wait(self.poll_interval)
+                continue
+
+            if self.on_position:
+                for index, waiting_job in enumerate(waiting):
+                    try:
+                        self.on_position(waiting_job, index + 1)
+                    except Exception as e:
+                        logger.warning(f"⚠️ Не удалось обновить позицию задачи {waiting_job.job_id}: {e}")
+
+            logger.info(f"⚙️ Задача {job.job_id} взята в работу воркером {self.worker_name} "
+                        f"(ожидание {job.started_at - job.created_at:.1f} с)")
+            with self._running_lock:
+                self._running[job.job_id] = job
+            try:
+                self.handler(job)
+            except Exception as e:
+                logger.error(f"❌ Ошибка в задаче {job.job_id}: {e}")
+            finally:
+                with self._running_lock:
+                    self._running.pop(job.job_id, None)
+                self._finish(job)
+
+
+def create_job_queue(backend, handler, workers, max_size, on_position=None, sqlite_path="jobs.db", scheduler=None,
+                     journal_path=None, max_attempts=3, lease_timeout=600, on_dropped=None):
+    """Создает очередь задач по имени бэкенда: memory или sqlite.
+
+    journal_path - журнал для очереди в памяти (у sqlite задачи и так на диске).
+    lease_timeout и on_dropped - аренда задач и уведомление о сбойных для sqlite.
+    """
+    if backend == "memory":
+        if workers < 1:
+            logger.error("❌ GENERATION_WORKERS=0 возможно только с JOB_QUEUE_BACKEND=sqlite и отдельными worker.py")
+            raise ValueError(f"Очередь memory без воркеров: GENERATION_WORKERS={workers}")
+        journal = JobJournal(journal_path) if journal_path else None
+        return JobQueue(handler, workers=workers, max_size=max_size, on_position=on_position, scheduler=scheduler,
+                        journal=journal, max_attempts=max_attempts)
+    if backend == "sqlite":
+        return SqliteJobQueue(sqlite_path, handler, workers=workers, max_size=max_size,
+                              on_position=on_position, scheduler=scheduler, lease_timeout=lease_timeout,
+                              max_attempts=max_attempts, on_dropped=on_dropped)
+    raise ValueError(f"Неизвестный бэкенд очереди: {backend}")
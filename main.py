@@ -1,14 +1,38 @@
 import os
 import warnings
 import io
+import html
 from dotenv import load_dotenv
 import telebot
 from telebot import types
 import time
 import logging
-
-# Импортируем InferenceClient
-from huggingface_hub import InferenceClient
+import random
+import signal
+import threading
+import uuid
+
+from PIL import Image
+
+from archive import ArchiveWriter
+import catalog
+import commands
+from fsm import WizardRouter
+from cache import FileIdStore, ResultCache, image_hash, make_cache_key
+from image_pipeline import IMAGE_FORMATS, EncodedImage, encode_image
+import metrics
+from jobs import GenerationJob, JobCancelledError, QueueFullError, create_job_queue
+from outbound import OutboundDispatcher, deferred_edits
+from progress import LatencyEstimator, ProgressReporter, progress_bar
+from providers import build_provider_chain
+from ratelimit import TokenBucket
+from retry import ErrorKind, RetryError, RetryPolicy, call_with_retry
+from scheduler import FairScheduler, RateLimitedError
+from sessions import create_session_store
+from singleflight import SingleFlight
+from speculation import ChoiceStats, Speculator
+import tracing
+from webhook import WebhookServer
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,6 +51,186 @@ HF_TOKEN = os.getenv("HF_TOKEN")
 if not TOKEN:
     raise RuntimeError("❌ В .env нет TOKEN")
 
+# Настройки очереди генерации
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "2"))
+GENERATION_QUEUE_SIZE = int(os.getenv("GENERATION_QUEUE_SIZE", "30"))
+# memory - очередь в процессе бота, sqlite - общая очередь для отдельных воркеров (worker.py)
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "memory")
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "jobs.db")
+# Журнал очереди в памяти: незавершенные задачи продолжаются после перезапуска (пусто - без журнала)
+JOB_JOURNAL_PATH = os.getenv("JOB_JOURNAL_PATH", "jobs_journal.db")
+# Сколько раз задачу можно начать заново, прежде чем считать ее сбойной
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Аренда задачи в очереди sqlite: задача воркера, не завершенная за это время, выдается заново, секунды
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "600"))
+# Сколько ждать задачи в работе при остановке (SIGTERM), секунды
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "60"))
+
+# Справедливость между пользователями: одновременных генераций и задач (в очереди + в работе) на пользователя
+USER_MAX_CONCURRENT = int(os.getenv("USER_MAX_CONCURRENT", "1"))
+USER_MAX_JOBS = int(os.getenv("USER_MAX_JOBS", "3"))
+# Частота новых задач: от одного пользователя и от всех вместе (в минуту, burst - запас подряд)
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "6"))
+USER_BURST = int(os.getenv("USER_BURST", "3"))
+GLOBAL_RATE_PER_MINUTE = float(os.getenv("GLOBAL_RATE_PER_MINUTE", "60"))
+GLOBAL_BURST = int(os.getenv("GLOBAL_BURST", "20"))
+
+# Исходящие запросы к Telegram: лимиты в сообщениях в секунду на бота и на чат, повторы после 429
+TELEGRAM_DISPATCHER_ENABLED = os.getenv("TELEGRAM_DISPATCHER_ENABLED", "1") == "1"
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+# Сколько процессов отправляют сообщения от имени бота (бот + worker.py): у каждого свой диспетчер,
+# поэтому лимиты выше делятся между ними, чтобы в сумме не превышать лимиты Telegram
+TELEGRAM_PROCESSES = max(1, int(os.getenv("TELEGRAM_PROCESSES", "1")))
+# Потоки обработчиков TeleBot: ответ ждет лимита своего чата (до секунды), поэтому потоков
+# должно хватать на все чаты, которые пишут боту одновременно - иначе ждут и остальные
+TELEGRAM_HANDLER_THREADS = int(os.getenv("TELEGRAM_HANDLER_THREADS", "16"))
+
+# Режим приема обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Параметры FLUX.1-dev
+FLUX_MODEL = "black-forest-labs/FLUX.1-dev"
+FLUX_GUIDANCE_SCALE = 3.5  # Для FLUX лучше 3.5-4.0
+FLUX_STEPS = 20  # FLUX быстрая, 20 шагов достаточно
+FLUX_SIZE = 1024  # FLUX поддерживает высокое разрешение
+
+# Уровни качества: draft - быстрый и дешевый, standard - параметры выше, high - больше шагов
+QUALITY_DEFAULT = os.getenv("QUALITY_DEFAULT", "standard")
+QUALITY_DRAFT_MODEL = os.getenv("QUALITY_DRAFT_MODEL", "black-forest-labs/FLUX.1-schnell")
+QUALITY_DRAFT_STEPS = int(os.getenv("QUALITY_DRAFT_STEPS", "4"))
+QUALITY_DRAFT_SIZE = int(os.getenv("QUALITY_DRAFT_SIZE", "512"))
+QUALITY_HIGH_STEPS = int(os.getenv("QUALITY_HIGH_STEPS", "32"))
+# При такой глубине очереди качество снижается на уровень, чтобы очередь быстрее разошлась (0 - не снижать)
+QUALITY_DOWNGRADE_DEPTH = int(os.getenv("QUALITY_DOWNGRADE_DEPTH", "10"))
+
+# Метрики Prometheus: адрес эндпоинта /metrics (порт 0 - не запускать)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Трассировка задач генерации: спаны этапов пишутся в JSONL и/или коллектор OpenTelemetry
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_FILE = os.getenv("TRACE_FILE", "")  # пусто - не писать файл
+TRACE_FILE_MAX_MB = float(os.getenv("TRACE_FILE_MAX_MB", "50"))  # 0 - без ротации
+TRACE_FILE_BACKUPS = int(os.getenv("TRACE_FILE_BACKUPS", "3"))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")  # например http://localhost:4318
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "tattoo-bot")
+
+# Мастер: inline - одно сообщение с кнопками, которое редактируется на каждом шаге;
+# reply - новое сообщение с клавиатурой под полем ввода на каждом шаге
+WIZARD_MODE = os.getenv("WIZARD_MODE", "reply")
+# Брошенный на середине мастер сбрасывается через столько минут (0 - не сбрасывать)
+WIZARD_TIMEOUT_MINUTES = float(os.getenv("WIZARD_TIMEOUT_MINUTES", "30"))
+
+# Администраторы: chat_id через запятую, им доступна команда /trace
+ADMIN_IDS = {int(chat_id) for chat_id in os.getenv("ADMIN_IDS", "").split(",") if chat_id.strip()}
+
+# Прогресс генерации: как часто обновлять сообщение (Telegram ограничивает частоту правок)
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "4"))
+# Быстрый черновик (мало шагов, меньше разрешение) отправляется, пока рисуется полный эскиз
+PREVIEW_ENABLED = os.getenv("PREVIEW_ENABLED", "1") == "1"
+PREVIEW_STEPS = int(os.getenv("PREVIEW_STEPS", "4"))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "512"))
+
+# Режим вариантов (/variants): сколько эскизов по умолчанию и максимум за одну задачу
+VARIANTS_DEFAULT = int(os.getenv("VARIANTS_DEFAULT", "4"))
+VARIANTS_MAX = min(10, int(os.getenv("VARIANTS_MAX", "4")))  # в альбоме Telegram не больше 10 фото
+
+# Новый мастер (/generate) отменяет незавершенные задачи этого чата
+CANCEL_ON_NEW_WIZARD = os.getenv("CANCEL_ON_NEW_WIZARD", "1") == "1"
+
+# Пакет /batch: сколько строк-эскизов принимается в одном сообщении
+BATCH_MAX_ITEMS = min(10, int(os.getenv("BATCH_MAX_ITEMS", "5")))  # результат - один альбом
+
+# Провайдеры по порядку: "провайдер[:модель][@таймаут]", auto - маршрутизация Hugging Face
+FLUX_PROVIDERS = os.getenv("FLUX_PROVIDERS", "nebius,auto")
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", "90"))
+PROVIDER_FAILURE_THRESHOLD = int(os.getenv("PROVIDER_FAILURE_THRESHOLD", "3"))
+PROVIDER_COOLDOWN = float(os.getenv("PROVIDER_COOLDOWN", "60"))
+
+# Повторы временных ошибок (429/503/таймауты) и общий для воркеров лимит запросов к провайдерам
+GENERATION_MAX_ATTEMPTS = int(os.getenv("GENERATION_MAX_ATTEMPTS", "4"))
+GENERATION_DEADLINE = float(os.getenv("GENERATION_DEADLINE", "180"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+PROVIDER_RATE_PER_SECOND = float(os.getenv("PROVIDER_RATE_PER_SECOND", "1"))
+PROVIDER_BURST = int(os.getenv("PROVIDER_BURST", "4"))
+
+# Кэш готовых изображений
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "cache/results")
+RESULT_CACHE_MAX_ITEMS = int(os.getenv("RESULT_CACHE_MAX_ITEMS", "500"))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "500"))
+RESULT_CACHE_MAX_AGE_HOURS = int(os.getenv("RESULT_CACHE_MAX_AGE_HOURS", "168"))
+FILE_ID_STORE_PATH = os.getenv("FILE_ID_STORE_PATH", "cache/file_ids.json")
+# Одинаковые запросы, пришедшие одновременно, ждут одну генерацию вместо своих
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+# Спекулятивная генерация: пока пользователь выбирает цвет и качество, рисуется самый вероятный вариант
+SPECULATIVE_ENABLED = os.getenv("SPECULATIVE_ENABLED", "0") == "1"
+SPECULATIVE_BUDGET_PER_HOUR = float(os.getenv("SPECULATIVE_BUDGET_PER_HOUR", "30"))
+SPECULATIVE_BURST = int(os.getenv("SPECULATIVE_BURST", "5"))
+SPECULATIVE_WORKERS = int(os.getenv("SPECULATIVE_WORKERS", "1"))
+CHOICE_STATS_PATH = os.getenv("CHOICE_STATS_PATH", "cache/choice_stats.json")
+
+# Формат отправки эскиза в Telegram: png, jpeg или webp. Оригинал всегда хранится в PNG
+IMAGE_DELIVERY_FORMAT = os.getenv("IMAGE_DELIVERY_FORMAT", "jpeg").lower()
+IMAGE_DELIVERY_QUALITY = int(os.getenv("IMAGE_DELIVERY_QUALITY", "92"))
+IMAGE_PNG_COMPRESS_LEVEL = int(os.getenv("IMAGE_PNG_COMPRESS_LEVEL", "6"))
+
+# Хранилище сессий: memory, sqlite (переживает перезапуск) или redis (общий для нескольких процессов)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL_HOURS = int(os.getenv("SESSION_TTL_HOURS", "168"))
+SESSION_MAX_ITEMS = int(os.getenv("SESSION_MAX_ITEMS", "10000"))
+
+# Архив сгенерированных эскизов
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "generated_tattoos")
+ARCHIVE_MAX_ITEMS = int(os.getenv("ARCHIVE_MAX_ITEMS", "10000"))
+ARCHIVE_MAX_MB = int(os.getenv("ARCHIVE_MAX_MB", "5000"))
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "30"))
+
+# Уровни качества по возрастанию: при нагрузке задача переходит на предыдущий
+QUALITY_TIERS = {
+    "draft": {
+        "title": "⚡ Быстро",
+        "model": QUALITY_DRAFT_MODEL,
+        "steps": QUALITY_DRAFT_STEPS,
+        "size": QUALITY_DRAFT_SIZE,
+        "guidance_scale": FLUX_GUIDANCE_SCALE,
+    },
+    "standard": {
+        "title": "✨ Стандарт",
+        "model": FLUX_MODEL,
+        "steps": FLUX_STEPS,
+        "size": FLUX_SIZE,
+        "guidance_scale": FLUX_GUIDANCE_SCALE,
+    },
+    "high": {
+        "title": "💎 Детально",
+        "model": FLUX_MODEL,
+        "steps": QUALITY_HIGH_STEPS,
+        "size": FLUX_SIZE,
+        "guidance_scale": FLUX_GUIDANCE_SCALE,
+    },
+}
+
+if QUALITY_DEFAULT not in QUALITY_TIERS:
+    logger.error(f"❌ Неизвестный QUALITY_DEFAULT={QUALITY_DEFAULT}, использую standard")
+    QUALITY_DEFAULT = "standard"
+
+if IMAGE_DELIVERY_FORMAT not in IMAGE_FORMATS:
+    logger.error(f"❌ Неизвестный IMAGE_DELIVERY_FORMAT={IMAGE_DELIVERY_FORMAT}, использую jpeg")
+    IMAGE_DELIVERY_FORMAT = "jpeg"
+
 if not HF_TOKEN:
     logger.error("❌ HF_TOKEN не найден в .env файле")
     logger.info("ℹ️ Получите бесплатный токен на https://huggingface.co/settings/tokens")
@@ -34,39 +238,82 @@ if not HF_TOKEN:
 else:
     logger.info("✅ Hugging Face токен найден")
 
-# Инициализируем клиент для FLUX.1-dev через Nebius
-try:
-    client = InferenceClient(
-        provider="nebius",  # Используем Nebius как провайдера
-        api_key=HF_TOKEN,
-    )
-    logger.info("✅ InferenceClient инициализирован с провайдером Nebius")
-except Exception as e:
-    logger.error(f"❌ Ошибка инициализации InferenceClient: {e}")
-    client = None
+# Инициализируем клиентов FLUX.1-dev: Nebius основной, маршрутизация Hugging Face - запасная
+provider_chain = build_provider_chain(
+    FLUX_PROVIDERS,
+    api_key=HF_TOKEN,
+    default_model=FLUX_MODEL,
+    default_timeout=PROVIDER_TIMEOUT,
+    failure_threshold=PROVIDER_FAILURE_THRESHOLD,
+    reset_timeout=PROVIDER_COOLDOWN,
+)
+if provider_chain.providers:
+    logger.info(f"✅ InferenceClient инициализирован, провайдеров: {len(provider_chain.providers)}")
+else:
+    logger.error("❌ Ошибка инициализации InferenceClient: нет доступных провайдеров")
+
+retry_policy = RetryPolicy(
+    max_attempts=GENERATION_MAX_ATTEMPTS,
+    base_delay=RETRY_BASE_DELAY,
+    max_delay=RETRY_MAX_DELAY,
+    deadline=GENERATION_DEADLINE,
+)
+provider_bucket = TokenBucket(PROVIDER_RATE_PER_SECOND, PROVIDER_BURST)
+
+# Скользящая оценка времени генерации для ETA в сообщениях
+generation_latency = LatencyEstimator(default=25.0)
+
+# Понятные пользователю причины ошибок генерации
+GENERATION_ERROR_MESSAGES = {
+    ErrorKind.RATE_LIMIT: "Провайдер ограничил частоту запросов, попробуй через пару минут",
+    ErrorKind.OVERLOADED: "Провайдер перегружен или недоступен, попробуй позже",
+    ErrorKind.TIMEOUT: "Провайдер не ответил вовремя, попробуй позже",
+    ErrorKind.BAD_PROMPT: "Провайдер отклонил запрос, попробуй изменить описание",
+    ErrorKind.AUTH: "Ошибка доступа к провайдеру, проверьте HF_TOKEN",
+}
 
-bot = telebot.TeleBot(TOKEN)
+bot = telebot.TeleBot(TOKEN, num_threads=TELEGRAM_HANDLER_THREADS)
+
+result_cache = None
+if RESULT_CACHE_ENABLED:
+    try:
+        result_cache = ResultCache(
+            RESULT_CACHE_DIR,
+            max_items=RESULT_CACHE_MAX_ITEMS,
+            max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024,
+            max_age=RESULT_CACHE_MAX_AGE_HOURS * 3600,
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка инициализации кэша результатов: {e}")
+
+# Архив пишется в отдельном потоке, чтобы диск не задерживал ответ пользователю
+archive_writer = ArchiveWriter(
+    ARCHIVE_DIR,
+    max_items=ARCHIVE_MAX_ITEMS,
+    max_bytes=ARCHIVE_MAX_MB * 1024 * 1024,
+    max_age=ARCHIVE_RETENTION_DAYS * 24 * 3600,
+)
+
+# Готовые эскизы, которые поток записи еще не положил в кэш результатов
+pending_results = {}
+pending_results_lock = threading.Lock()
+
+# Идущие генерации по ключу кэша: одинаковые запросы присоединяются к первой
+# Отмена первой задачи не отменяет остальные - они повторят запрос сами
+generation_flight = SingleFlight(private_errors=(JobCancelledError,)) if SINGLE_FLIGHT_ENABLED else None
+
+# file_id уже загруженных в Telegram эскизов: повторы отправляются без загрузки байтов
+file_id_store = FileIdStore(FILE_ID_STORE_PATH)
 
 # Хранилище состояний пользователей
-user_states = {}
-user_data = {}
-
-# Словарь для маппинга стилей на промпты
-STYLE_PROMPTS = {
-    "Минимализм": "minimalist tattoo design, clean thin lines, simple elegant design, single needle style, delicate, subtle",
-    "Традишнл": "traditional tattoo, american traditional style, bold black outlines, limited color palette, sailor jerry style, tattoo flash",
-    "Реализм": "realistic tattoo, photorealistic, detailed shading, 3D effect, skin texture, hyperrealistic tattoo art",
-    "Акварель": "watercolor tattoo, paint splashes effect, soft edges, blended colors, artistic, painterly style",
-    "Геометрия": "geometric tattoo, sacred geometry, mandala pattern, symmetrical, precise lines, dotwork, intricate patterns",
-    "Блэкворк": "blackwork tattoo, solid black areas, heavy black fill, ornamental patterns, bold contrast",
-    "Лайнворк": "linework tattoo, continuous line drawing, single line art, elegant contours, minimalist line art",
-    "Трайбл": "tribal tattoo, polynesian tattoo patterns, maori design, cultural motifs, flowing black lines",
-    "Биомеханика": "biomechanical tattoo, H.R. Giger style, mechanical parts integrated with flesh, cyborg, industrial",
-    "Олдскул": "old school tattoo, vintage flash, classic designs, bold lines, roses, anchors, swallows",
-    "Японский": "japanese irezumi tattoo, traditional japanese style, koi fish, dragons, waves, chrysanthemums",
-    "Скетч": "sketch style tattoo, pencil drawing style, rough lines, artistic sketch, hand-drawn look",
-    "Киберпанк": "cyberpunk tattoo, neon colors, glitch effect, digital art style, futuristic, techwear"
-}
+sessions = create_session_store(
+    SESSION_BACKEND,
+    ttl=SESSION_TTL_HOURS * 3600,
+    max_items=SESSION_MAX_ITEMS,
+    sqlite_path=SESSION_DB_PATH,
+    redis_url=SESSION_REDIS_URL,
+)
+logger.info(f"✅ Хранилище сессий: {SESSION_BACKEND}")
 
 class UserState:
     NONE = 0
@@ -74,337 +321,932 @@ class UserState:
     WAITING_FOR_BODY_PART = 2
     WAITING_FOR_SUBJECT = 3
     WAITING_FOR_COLOR = 4
+    WAITING_FOR_QUALITY = 5
 
-def ensure_user_data(chat_id):
-    """Проверяет и создает словарь данных для пользователя, если его нет"""
-    if chat_id not in user_data:
-        user_data[chat_id] = {}
+def notify_wizard_timeout(message, step):
+    """Пользователь вернулся к мастеру, который бросил слишком давно"""
+    metrics.WIZARD_TIMEOUTS.inc(step=step.name)
+    cancel_speculation(message.chat.id)
+    bot.send_message(
+        message.chat.id,
+        "⌛ <b>Прошло слишком много времени, создание эскиза сброшено.</b>\n\n"
+        "🔄 Начни заново: /generate",
+        reply_markup=types.ReplyKeyboardRemove(),
+        parse_mode='HTML'
+    )
 
-def reset_user_state(chat_id):
-    """Сброс состояния пользователя"""
-    user_states[chat_id] = UserState.NONE
-    ensure_user_data(chat_id)
+def answer_wizard_button(call, text=None):
+    """Убирает часики на нажатой кнопке. В режиме webhook это уже сделано ответом на сам webhook"""
+    if getattr(call, "answered", False):
+        return
+    try:
+        bot.answer_callback_query(call.id, text=text)
+    except Exception as e:
+        logger.debug(f"Не удалось ответить на нажатие кнопки: {e}")
+
+STALE_BUTTON_TEXT = "⌛ Эти кнопки уже неактивны. Новый эскиз: /generate"
+
+def notify_stale_button(call):
+    """Нажата кнопка старого сообщения или уже пройденного шага"""
+    answer_wizard_button(call, STALE_BUTTON_TEXT)
+
+def stale_button_text(callback_query):
+    """Текст ответа на кнопку прямо в ответе на webhook: отдельный answerCallbackQuery там уже не пройдет"""
+    if callback_query.message is None or not wizard.is_stale(callback_query):
+        return None
+    return STALE_BUTTON_TEXT
+
+def observe_wizard_step(step, seconds, error):
+    metrics.WIZARD_HANDLER_SECONDS.observe(seconds, step=step.name, outcome="error" if error else "ok")
+
+def observe_wizard_transition(from_step, to_step):
+    metrics.WIZARD_TRANSITIONS.inc(from_step=from_step.name if from_step else "command", to_step=to_step.name)
+
+# Шаги мастера: один обработчик сообщений ищет шаг по состоянию сессии
+wizard = WizardRouter(
+    sessions,
+    idle_state=UserState.NONE,
+    timeout=WIZARD_TIMEOUT_MINUTES * 60 or None,
+    on_timeout=notify_wizard_timeout,
+    on_stale=notify_stale_button,
+    on_dispatch=observe_wizard_step,
+    on_transition=observe_wizard_transition,
+)
+
+def reset_user_state(chat_id, **values):
+    """Сброс состояния пользователя; values сохраняются той же записью"""
+    wizard.transition(chat_id, UserState.NONE, **values)
+
+def build_quality_markup():
+    """Клавиатура выбора уровня качества"""
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=3)
+    markup.row(*(tier["title"] for tier in QUALITY_TIERS.values()))
+    return markup
+
+def build_quality_inline_markup():
+    """Inline-кнопки выбора уровня качества"""
+    markup = types.InlineKeyboardMarkup(row_width=3)
+    markup.add(*(types.InlineKeyboardButton(tier["title"], callback_data=f"{catalog.CALLBACK_PREFIX}q{index}")
+                 for index, tier in enumerate(QUALITY_TIERS.values())))
+    return markup
+
+# Клавиатуры собираются один раз и переиспользуются всеми сообщениями
+QUALITY_MARKUP = build_quality_markup()
+QUALITY_INLINE_MARKUP = build_quality_inline_markup()
+QUALITY_BY_TITLE = {tier["title"]: name for name, tier in QUALITY_TIERS.items()}
+QUALITY_BY_CALLBACK = {f"{catalog.CALLBACK_PREFIX}q{index}": name for index, name in enumerate(QUALITY_TIERS)}
+# Написания качества в /gen и /batch: draft, быстро, standard, стандарт...
+QUALITY_ALIASES = {**{name: name for name in QUALITY_TIERS},
+                   **{tier["title"].split(" ", 1)[-1].casefold(): name for name, tier in QUALITY_TIERS.items()}}
+
+def effective_quality(quality):
+    """Уровень качества с учетом нагрузки: при глубокой очереди - на уровень ниже"""
+    if quality not in QUALITY_TIERS:
+        quality = QUALITY_DEFAULT
+    if QUALITY_DOWNGRADE_DEPTH and generation_queue.depth() >= QUALITY_DOWNGRADE_DEPTH:
+        order = list(QUALITY_TIERS)
+        index = order.index(quality)
+        if index > 0:
+            logger.info(f"📉 Очередь {generation_queue.depth()} задач: качество {quality} -> {order[index - 1]}")
+            return order[index - 1]
+    return quality
 
 def generate_prompt(user_data_dict):
     """Создает промпт для FLUX.1-dev на основе данных пользователя"""
-    style = user_data_dict.get('style', 'Минимализм')
     subject = user_data_dict.get('subject', 'abstract design')
-    color = user_data_dict.get('color', 'Черно-белая')
-    body_part = user_data_dict.get('body_part', 'arm')
-
-    # Базовый стиль
-    style_prompt = STYLE_PROMPTS.get(style, STYLE_PROMPTS["Минимализм"])
-
-    # Цветовая схема
-    if color == "Черно-белая":
-        color_prompt = "black and white, monochrome, grayscale, no color"
-    elif color == "Цветная":
-        color_prompt = "vibrant colors, colorful, saturated, rich colors"
-    elif color == "Монохром":
-        color_prompt = "monochromatic, single color, tonal variation"
-    else:  # С акцентами цвета
-        color_prompt = "black and white with color accents, color highlights, mostly monochrome"
-
-    # Описание части тела
-    body_part_mapping = {
-        "Плечо": "shoulder tattoo, upper arm placement",
-        "Предплечье": "forearm tattoo, arm placement",
-        "Запястье": "wrist tattoo, delicate placement",
-        "Кисть": "hand tattoo, knuckle tattoo",
-        "Грудь": "chest tattoo, sternum tattoo, chest piece",
-        "Ребра": "rib tattoo, side body, underboob tattoo",
-        "Спина": "back tattoo, full back piece, back artwork",
-        "Живот": "stomach tattoo, abdomen tattoo",
-        "Шея": "neck tattoo, nape tattoo, throat tattoo",
-        "За ухом": "behind ear tattoo, ear tattoo",
-        "Лодыжка": "ankle tattoo, foot tattoo",
-        "Бедро": "thigh tattoo, leg tattoo",
-        "Икра": "calf tattoo, leg tattoo",
-        "Лопатка": "shoulder blade tattoo, scapula",
-        "Ключица": "collarbone tattoo, clavicle tattoo"
-    }
 
-    body_prompt = body_part_mapping.get(body_part, "tattoo design")
+    # Фрагменты берутся из готовых таблиц каталога
+    style_prompt = catalog.STYLES.prompt(user_data_dict.get('style'))
+    body_prompt = catalog.BODY_PARTS.prompt(user_data_dict.get('body_part'))
+    color_prompt = catalog.COLORS.prompt(user_data_dict.get('color'))
 
     # Собираем промпт для FLUX.1-dev
-    prompt = f"{style_prompt}, {subject}, {body_prompt}, {color_prompt}, tattoo design, high quality, detailed, professional tattoo art, 8k resolution"
-
-    # Негативный промпт
-    negative_prompt = "blurry, low quality, ugly, deformed, distorted, watermark, text, signature, bad anatomy, extra limbs, missing limbs"
-
-    return prompt, negative_prompt
-
-def generate_image_with_flux(prompt, negative_prompt=""):
-    """Генерация изображения через FLUX.1-dev с InferenceClient"""
+    prompt = f"{style_prompt}, {subject}, {body_prompt}, {color_prompt}, {catalog.PROMPT_SUFFIX}"
+
+    return prompt, catalog.NEGATIVE_PROMPT
+
+def flux_cache_key(prompt, negative_prompt="", seed=None, quality=QUALITY_DEFAULT):
+    """Ключ кэша для набора параметров генерации"""
+    tier = QUALITY_TIERS[quality]
+    params = dict(
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        model=tier["model"],
+        steps=tier["steps"],
+        guidance_scale=tier["guidance_scale"],
+        width=tier["size"],
+        height=tier["size"],
+    )
+    if seed is not None:
+        # С фиксированным сидом результат воспроизводим - у каждого варианта свой ключ
+        params["seed"] = seed
+    return make_cache_key(**params)
+
+def delivery_cache_key(cache_key):
+    """Ключ кэша для превью в формате отправки"""
+    return make_cache_key(original=cache_key, format=IMAGE_DELIVERY_FORMAT, quality=IMAGE_DELIVERY_QUALITY)
+
+def process_generated_image(image, cache_key=None, metadata=None):
+    """Кодирует результат генерации один раз для каждого назначения.
+
+    В потоке запроса кодируется только изображение для отправки. PNG-оригинал
+    без потерь, записи в кэш результатов и архив уходят в поток записи:
+    запись в кэш - задачей defer(), которая не отбрасывается, поэтому
+    следующий запрос и /original найдут оригинал, как только она выполнится.
+    Если эскиз отправляется в PNG, тот же буфер уходит в Telegram.
+    """
+    with tracing.span("encode", format=IMAGE_DELIVERY_FORMAT) as span:
+        if IMAGE_DELIVERY_FORMAT == "png":
+            delivery = encode_image(image, "png", png_compress_level=IMAGE_PNG_COMPRESS_LEVEL)
+        else:
+            delivery = encode_image(image, IMAGE_DELIVERY_FORMAT, quality=IMAGE_DELIVERY_QUALITY)
+        span.set(bytes=delivery.size)
+
+    def encode_original():
+        if delivery.format == "png":
+            return delivery.data
+        return encode_image(image, "png", png_compress_level=IMAGE_PNG_COMPRESS_LEVEL).data
+
+    if result_cache and cache_key:
+        with pending_results_lock:
+            pending_results[cache_key] = delivery
+        archive_writer.defer(store_generated_image, encode_original, cache_key, delivery, metadata)
+    else:
+        archive_writer.submit(encode_original, metadata)
+    if metadata and metadata.get("provider"):
+        delivery.source = f"{model_title(metadata['model'])} ({metadata['provider']})"
+    return delivery
+
+def store_generated_image(encode_original, cache_key, delivery, metadata):
+    """Поток записи: оригинал и превью в кэш результатов, тот же оригинал - в архив"""
     try:
-        if not client:
-            logger.error("InferenceClient не инициализирован")
-            return None, "InferenceClient не инициализирован. Проверьте HF_TOKEN."
-
-        if not HF_TOKEN:
-            logger.error("HF_TOKEN не настроен")
-            return None, "HF_TOKEN не настроен"
-
-        logger.info(f"🚀 Генерация изображения через FLUX.1-dev")
-        logger.info(f"📝 Промпт: {prompt[:100]}...")
-
-        start_time = time.time()
-
-        # Генерируем изображение через FLUX.1-dev
-        try:
-            logger.info("📤 Отправка запроса к FLUX.1-dev...")
-
-            # Используем параметры для лучшего качества татуировок
-            image = client.text_to_image(
-                prompt,
-                model="black-forest-labs/FLUX.1-dev",
-                negative_prompt=negative_prompt,
-                guidance_scale=3.5,  # Для FLUX лучше 3.5-4.0
-                num_inference_steps=20,  # FLUX быстрая, 20 шагов достаточно
-                height=1024,  # FLUX поддерживает высокое разрешение
-                width=1024,
-                seed=None  # Случайный сид для разнообразия
-            )
-
-            generation_time = time.time() - start_time
-            logger.info(f"⏱️ Генерация заняла: {generation_time:.1f} секунд")
-
-            if image:
-                # Сохраняем для отладки
-                debug_dir = "generated_tattoos"
-                os.makedirs(debug_dir, exist_ok=True)
-                timestamp = int(time.time())
-                debug_path = os.path.join(debug_dir, f"tattoo_flux_{timestamp}.png")
-                image.save(debug_path)
-                logger.info(f"💾 Изображение сохранено: {debug_path}")
-
-                # Конвертируем в байты
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='PNG', quality=95)
-                img_byte_arr.seek(0)
-
-                return img_byte_arr, None
-            else:
-                logger.error("❌ FLUX.1-dev вернул пустое изображение")
-                return None, "Пустое изображение"
-
-        except Exception as e:
-            logger.error(f"❌ Ошибка FLUX.1-dev: {str(e)}")
+        with tracing.span("cache.write"):
+            original = encode_original()
+            result_cache.put(cache_key, original)
+            if delivery.format != "png":
+                result_cache.put(delivery_cache_key(cache_key), delivery.data)
+    finally:
+        with pending_results_lock:
+            if pending_results.get(cache_key) is delivery:
+                del pending_results[cache_key]
+    archive_writer.submit(original, metadata)
+
+def model_title(model):
+    """Короткое имя модели для сообщений: black-forest-labs/FLUX.1-dev -> FLUX.1-dev"""
+    return model.rsplit("/", 1)[-1]
+
+def generator_label(quality, image=None):
+    """Модель и провайдер эскиза; если эскиз неизвестно откуда (кэш, еще не готов) - модели цепочки"""
+    if image is not None and image.source:
+        return image.source
+    tier_model = QUALITY_TIERS[quality]["model"]
+    models = dict.fromkeys(model_title(provider.model_for(tier_model)) for provider in provider_chain.providers)
+    return ", ".join(models) or model_title(tier_model)
+
+def has_cached_result(cache_key):
+    """Есть ли готовый эскиз: в кэше результатов или еще в очереди на запись в него"""
+    if result_cache is None:
+        return False
+    with pending_results_lock:
+        if cache_key in pending_results:
+            return True
+    return cache_key in result_cache
+
+def load_cached_image(cache_key):
+    """Достает из кэша изображение в формате отправки (или перекодирует оригинал)"""
+    with pending_results_lock:
+        pending = pending_results.get(cache_key)
+    if pending is not None:
+        # Поток записи еще не положил результат в кэш - отдаем его из памяти
+        return pending
+    if IMAGE_DELIVERY_FORMAT == "png":
+        data = result_cache.get(cache_key)
+        return EncodedImage(data, "png") if data else None
+
+    delivery_key = delivery_cache_key(cache_key)
+    data = result_cache.get(delivery_key)
+    if data:
+        return EncodedImage(data, IMAGE_DELIVERY_FORMAT)
+
+    original = result_cache.get(cache_key)
+    if not original:
+        return None
+    delivery = encode_image(Image.open(io.BytesIO(original)), IMAGE_DELIVERY_FORMAT, quality=IMAGE_DELIVERY_QUALITY)
+    result_cache.put(delivery_key, delivery.data)
+    return delivery
+
+def generate_image_with_flux(prompt, negative_prompt="", use_cache=True, seed=None, keyed_by_seed=True,
+                             quality=QUALITY_DEFAULT, cancel=None):
+    """Генерация изображения через FLUX.1-dev с InferenceClient.
+
+    При use_cache=True сначала ищет готовый результат в кэше; use_cache=False
+    всегда запрашивает новый вариант (и обновляет кэш). seed=None - случайный сид.
+    keyed_by_seed=False - сид уходит провайдеру, но не входит в ключ кэша
+    (черновик и полный эскиз с одним сидом для обычного запроса).
+    quality - уровень из QUALITY_TIERS: модель, число шагов и разрешение.
+    cancel - токен отмены задачи: при отмене бросается JobCancelledError.
+    """
+    try:
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+        tier = QUALITY_TIERS[quality]
+        cache_key = flux_cache_key(prompt, negative_prompt, seed if keyed_by_seed else None, quality)
+        if result_cache and use_cache:
+            with tracing.span("cache.lookup") as span:
+                cached = load_cached_image(cache_key)
+                span.set(hit=bool(cached))
+            metrics.CACHE_LOOKUPS.inc(result="hit" if cached else "miss")
+            if cached:
+                logger.info(f"⚡ Изображение найдено в кэше: {cache_key[:12]}")
+                return cached, None
+
+        def request_and_process():
+            if not provider_chain.providers:
+                logger.error("InferenceClient не инициализирован")
+                metrics.GENERATION_ERRORS.inc(kind="config")
+                return None, "InferenceClient не инициализирован. Проверьте HF_TOKEN."
+
+            if not HF_TOKEN:
+                logger.error("HF_TOKEN не настроен")
+                metrics.GENERATION_ERRORS.inc(kind="config")
+                return None, "HF_TOKEN не настроен"
+
+            logger.info(f"🚀 Генерация изображения через FLUX.1-dev, качество: {quality}")
+            logger.info(f"📝 Промпт: {prompt[:100]}...")
+
+            start_time = time.time()
+
+            def request_image():
+                logger.info("📤 Отправка запроса к FLUX.1-dev...")
+
+                # Каждая попытка - отдельный спан: паузы между ними видны как промежутки
+                with tracing.span("provider", model=tier["model"], steps=tier["steps"]) as span:
+                    # Используем параметры для лучшего качества татуировок
+                    result = provider_chain.text_to_image(
+                        prompt,
+                        model=tier["model"],
+                        negative_prompt=negative_prompt,
+                        guidance_scale=tier["guidance_scale"],
+                        num_inference_steps=tier["steps"],
+                        height=tier["size"],
+                        width=tier["size"],
+                        seed=seed  # None - случайный сид для разнообразия
+                    )
+                    span.set(provider=result[1].name)
+                    return result
 
-            # Пробуем альтернативный подход без провайдера
-            logger.info("🔄 Пробую альтернативный метод...")
+            # Генерируем изображение через FLUX.1-dev: при ошибке - следующий провайдер,
+            # если упали все - повтор с задержкой в пределах дедлайна задачи
             try:
-                # Пробуем через стандартный API
-                from huggingface_hub import InferenceClient as StandardClient
-                alt_client = StandardClient(
-                    api_key=HF_TOKEN,
-                )
-
-                image = alt_client.text_to_image(
-                    prompt,
-                    model="black-forest-labs/FLUX.1-dev",
-                    negative_prompt=negative_prompt,
-                )
-
-                if image:
-                    # Сохраняем изображение
-                    img_byte_arr = io.BytesIO()
-                    image.save(img_byte_arr, format='PNG', quality=95)
-                    img_byte_arr.seek(0)
-                    return img_byte_arr, None
-                else:
-                    return None, f"Ошибка FLUX.1-dev: {str(e)}"
-
-            except Exception as alt_error:
-                logger.error(f"❌ Альтернативный метод тоже не сработал: {alt_error}")
-                return None, f"Ошибка генерации: {str(e)}"
+                image, provider = call_with_retry(request_image, retry_policy, bucket=provider_bucket, cancel=cancel)
+            except RetryError as e:
+                logger.error(f"❌ Ошибка FLUX.1-dev ({e.kind}, попыток: {e.attempts}): {str(e)}")
+                metrics.GENERATION_ERRORS.inc(kind=e.kind)
+                tracing.current().set_error(f"{e.kind}: {e}")
+                reason = GENERATION_ERROR_MESSAGES.get(e.kind, f"Ошибка генерации: {str(e)[:100]}")
+                return None, reason
 
+            generation_time = time.time() - start_time
+            generation_latency.record(generation_time)
+            logger.info(f"⏱️ Генерация заняла: {generation_time:.1f} секунд ({provider.name})")
+
+            metadata = {
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "model": provider.model_for(tier["model"]),
+                "quality": quality,
+                "steps": tier["steps"],
+                "guidance_scale": tier["guidance_scale"],
+                "width": tier["size"],
+                "height": tier["size"],
+                "provider": provider.name,
+                "seed": seed,
+                "generation_time": round(generation_time, 2),
+                "cache_key": cache_key,
+            }
+            return process_generated_image(image, cache_key, metadata), None
+
+        # Одинаковый запрос уже генерируется - ждем его результат вместо нового запроса к провайдеру.
+        # Новый вариант мимо кэша (use_cache=False) всегда генерируется отдельно
+        if generation_flight is None or not use_cache:
+            return request_and_process()
+        wait_start = time.time()
+        result, shared = generation_flight.do(cache_key, request_and_process,
+                                              check=cancel.raise_if_cancelled if cancel is not None else None)
+        if shared:
+            logger.info(f"🤝 Запрос {cache_key[:12]} уже генерировался, результат получен вместе с ним")
+            metrics.COALESCED_GENERATIONS.inc(outcome="ok" if result[0] else "error")
+            tracing.record("coalesced", wait_start, time.time())
+        return result
+
+    except JobCancelledError:
+        raise
     except Exception as e:
         logger.error(f"❌ Неизвестная ошибка в generate_image_with_flux: {str(e)}")
+        metrics.GENERATION_ERRORS.inc(kind="internal")
         import traceback
         logger.error(traceback.format_exc())
         return None, f"Ошибка: {str(e)[:100]}"
 
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) == UserState.WAITING_FOR_STYLE)
-def handle_style_selection(message):
-    try:
-        chat_id = message.chat.id
-        ensure_user_data(chat_id)
-
-        if message.text in STYLE_PROMPTS:
-            user_data[chat_id]['style'] = message.text
-        else:
-            user_data[chat_id]['style'] = "Минимализм"
+def show_wizard_step(chat_id, text, markup, inline_markup, message_id=None):
+    """Показывает следующий шаг мастера и возвращает id сообщения с активными кнопками.
+
+    В режиме inline сообщение мастера message_id редактируется на месте: меняются
+    текст и кнопки, новых сообщений в чате не появляется. Без message_id (и в режиме
+    reply) отправляется новое сообщение.
+    """
+    if WIZARD_MODE != "inline":
+        return bot.send_message(chat_id, text, reply_markup=markup, parse_mode='HTML').message_id
+    if message_id:
+        bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                              reply_markup=inline_markup, parse_mode='HTML')
+        return message_id
+    return bot.send_message(chat_id, text, reply_markup=inline_markup, parse_mode='HTML').message_id
+
+def run_speculative_generation(chat_id, request):
+    """Генерирует самый вероятный вариант эскиза заранее: результат ложится в кэш"""
+    with tracing.trace(f"spec-{uuid.uuid4().hex[:8]}", "speculative", chat_id=chat_id,
+                       color=request['color'], quality=request['quality']):
+        prompt, negative_prompt = generate_prompt(request)
+        image, error = generate_image_with_flux(prompt, negative_prompt, quality=request['quality'])
+    if error:
+        logger.info(f"🔮 Спекулятивная генерация для {chat_id} не удалась: {error}")
+
+def start_speculation(chat_id):
+    """Описание получено: запускаем генерацию с цветом и качеством, которые чаще выбирают с этим стилем"""
+    if speculator is None:
+        return
+    data = sessions.get_data(chat_id)
+    style = data.get('style')
+    guess = {
+        "color": choice_stats.predict(style, "color", catalog.COLORS.default, allowed=catalog.COLORS),
+        "quality": choice_stats.predict(style, "quality", QUALITY_DEFAULT, allowed=QUALITY_TIERS),
+    }
+    request = dict(guess, style=style, body_part=data.get('body_part'), subject=data.get('subject'))
+    prompt, negative_prompt = generate_prompt(request)
+    if has_cached_result(flux_cache_key(prompt, negative_prompt, quality=guess["quality"])):
+        metrics.SPECULATIONS.inc(outcome="skipped_cached")
+        return
+    outcome = speculator.start(chat_id, guess, chat_id, request)
+    metrics.SPECULATIONS.inc(outcome=outcome if outcome == "started" else f"skipped_{outcome}")
+    if outcome == "started":
+        logger.info(f"🔮 Спекулятивная генерация для {chat_id}: {guess['color']}, {guess['quality']}")
+
+def check_speculation(chat_id, final=False, **choices):
+    """Сверяет выбор пользователя с заранее начатой генерацией; final - последний шаг мастера"""
+    if speculator is None:
+        return
+    result = speculator.check(chat_id, **choices)
+    if result == "miss":
+        metrics.SPECULATIONS.inc(outcome="miss")
+    elif result == "match" and final:
+        speculator.finish(chat_id)
+        metrics.SPECULATIONS.inc(outcome="hit")
+
+def cancel_speculation(chat_id):
+    if speculator is not None and speculator.cancel(chat_id):
+        metrics.SPECULATIONS.inc(outcome="cancelled")
+
+def select_style(chat_id, style, message_id=None):
+    message_id = show_wizard_step(
+        chat_id,
+        f"✅ <b>Стиль:</b> {style}\n\n"
+        "📍 <b>Выбери часть тела для тату:</b>",
+        catalog.BODY_PARTS.markup,
+        catalog.BODY_PARTS.inline_markup,
+        message_id
+    )
+    wizard.transition(chat_id, UserState.WAITING_FOR_BODY_PART, style=style, wizard_message_id=message_id)
 
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-        body_parts = ["Плечо", "Предплечье", "Запястье", "Кисть", "Грудь", "Ребра",
-                      "Спина", "Живот", "Шея", "За ушем", "Лодыжка", "Бедро", "Икра"]
+def select_body_part(chat_id, body_part, message_id=None):
+    message_id = show_wizard_step(
+        chat_id,
+        f"✅ <b>Часть тела:</b> {body_part}\n\n"
+        "🎨 <b>Что должно быть изображено на тату?</b>\n\n"
+        "🌍 <b>Для лучшего результата пиши описание на английском!</b>\n"
+        "🤖 FLUX.1-dev лучше понимает английский язык\n\n"
+        "<i>Опиши детально:</i>\n"
+        "• <b>wolf with moon light</b> (волк с лунным светом)\n"
+        "• <b>lotus flower with roots</b> (цветок лотоса с корнями)\n"
+        "• <b>dragon wrapping around a sword</b> (дракон, обвивающий меч)\n"
+        "• <b>compass and old map</b> (компас и старая карта)\n"
+        "• <b>phoenix with spread wings</b> (феникс с расправленными крыльями)\n\n"
+        "<b>Чем детальнее описание, тем лучше результат!</b>",
+        types.ReplyKeyboardRemove(),
+        None,
+        message_id
+    )
+    wizard.transition(chat_id, UserState.WAITING_FOR_SUBJECT, body_part=body_part, wizard_message_id=message_id)
 
-        for i in range(0, len(body_parts), 2):
-            markup.row(*body_parts[i:i + 2])
+def select_subject(chat_id, subject):
+    # Описание пользователь пишет сообщением, поэтому цвета - уже под новым сообщением
+    message_id = show_wizard_step(
+        chat_id,
+        f"✅ <b>Изображение:</b> {subject}\n\n"
+        "🌈 <b>Выбери цветовую схему:</b>",
+        catalog.COLORS.markup,
+        catalog.COLORS.inline_markup
+    )
+    wizard.transition(chat_id, UserState.WAITING_FOR_COLOR, subject=subject, wizard_message_id=message_id)
+    start_speculation(chat_id)
 
-        bot.send_message(
-            chat_id,
-            f"✅ <b>Стиль:</b> {user_data[chat_id]['style']}\n\n"
-            "📍 <b>Выбери часть тела для тату:</b>",
-            reply_markup=markup,
-            parse_mode='HTML'
-        )
-        user_states[chat_id] = UserState.WAITING_FOR_BODY_PART
+def select_color(chat_id, color, message_id=None):
+    check_speculation(chat_id, color=color)
+    message_id = show_wizard_step(
+        chat_id,
+        f"✅ <b>Цвет:</b> {color}\n\n"
+        "🎚 <b>Выбери качество:</b>\n"
+        f"⚡ Быстро - черновик {QUALITY_DRAFT_SIZE}×{QUALITY_DRAFT_SIZE} за несколько секунд\n"
+        f"✨ Стандарт - {FLUX_SIZE}×{FLUX_SIZE}, {FLUX_STEPS} шагов\n"
+        f"💎 Детально - {FLUX_SIZE}×{FLUX_SIZE}, {QUALITY_HIGH_STEPS} шагов, дольше",
+        QUALITY_MARKUP,
+        QUALITY_INLINE_MARKUP,
+        message_id
+    )
+    wizard.transition(chat_id, UserState.WAITING_FOR_QUALITY, color=color, wizard_message_id=message_id)
+
+def select_quality(chat_id, quality, message_id=None):
+    """Последний шаг: итог параметров и постановка задачи в очередь.
+
+    В режиме inline сообщение мастера становится сообщением задачи: в нем же
+    показываются место в очереди и прогресс генерации.
+    """
+    data = dict(sessions.get_data(chat_id), quality=quality)
+    check_speculation(chat_id, final=True, quality=quality)
+    if choice_stats is not None:
+        # Запись статистики на диск - в потоке записи, а не в обработчике кнопки
+        archive_writer.defer(choice_stats.record, data.get('style'), color=data.get('color'), quality=quality)
+
+    summary_text = (
+        f"✨ <b>Параметры эскиза:</b>\n\n"
+        f"🤖 <b>Генератор:</b> {generator_label(quality)}\n"
+        f"🎨 <b>Стиль:</b> {data.get('style')}\n"
+        f"📍 <b>Место:</b> {data.get('body_part')}\n"
+        f"🖼 <b>Изображение:</b> {data.get('subject')}\n"
+        f"🌈 <b>Цвет:</b> {data.get('color')}\n"
+        f"🎚 <b>Качество:</b> {QUALITY_TIERS[quality]['title']}\n\n"
+        f"⏳ <i>Генерирую эскиз... Это займет 15-45 секунд.</i>"
+    )
+    message_id = show_wizard_step(chat_id, summary_text, types.ReplyKeyboardRemove(), None, message_id)
+
+    # Ставим генерацию в очередь, обработчик сразу освобождается
+    request = {key: data.get(key) for key in ('style', 'body_part', 'subject', 'color', 'quality')}
+    job = GenerationJob(chat_id, "tattoo", data=request, message_id=message_id)
+    if submit_generation_job(job):
+        reset_user_state(chat_id, quality=quality, last_request=request, last_variant_seeds=None,
+                         wizard_message_id=None)
+    else:
+        # Оставляем пользователя на шаге выбора качества, чтобы он мог повторить
+        message_id = show_wizard_step(chat_id, "🔁 Выбери качество еще раз, чтобы повторить попытку.",
+                                      QUALITY_MARKUP, QUALITY_INLINE_MARKUP)
+        wizard.transition(chat_id, UserState.WAITING_FOR_QUALITY, wizard_message_id=message_id)
+
+@wizard.step(UserState.WAITING_FOR_STYLE, "style", next_states=[UserState.WAITING_FOR_BODY_PART])
+def handle_style_selection(message):
+    try:
+        select_style(message.chat.id, catalog.STYLES.resolve(message.text))
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_style_selection: {e}")
-        bot.send_message(chat_id, "❌ Ошибка. Попробуйте снова /generate")
+        bot.send_message(message.chat.id, "❌ Ошибка. Попробуйте снова /generate")
 
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) == UserState.WAITING_FOR_BODY_PART)
+@wizard.step(UserState.WAITING_FOR_BODY_PART, "body_part", next_states=[UserState.WAITING_FOR_SUBJECT])
 def handle_body_part_selection(message):
     try:
-        chat_id = message.chat.id
-        ensure_user_data(chat_id)
-
-        user_data[chat_id]['body_part'] = message.text
-
-        markup = types.ReplyKeyboardRemove()
-        bot.send_message(
-            chat_id,
-            f"✅ <b>Часть тела:</b> {user_data[chat_id]['body_part']}\n\n"
-            "🎨 <b>Что должно быть изображено на тату?</b>\n\n"
-            "🌍 <b>Для лучшего результата пиши описание на английском!</b>\n"
-            "🤖 FLUX.1-dev лучше понимает английский язык\n\n"
-            "<i>Опиши детально:</i>\n"
-            "• <b>wolf with moon light</b> (волк с лунным светом)\n"
-            "• <b>lotus flower with roots</b> (цветок лотоса с корнями)\n"
-            "• <b>dragon wrapping around a sword</b> (дракон, обвивающий меч)\n"
-            "• <b>compass and old map</b> (компас и старая карта)\n"
-            "• <b>phoenix with spread wings</b> (феникс с расправленными крыльями)\n\n"
-            "<b>Чем детальнее описание, тем лучше результат!</b>",
-            reply_markup=markup,
-            parse_mode='HTML'
-        )
-        user_states[chat_id] = UserState.WAITING_FOR_SUBJECT
+        select_body_part(message.chat.id, message.text)
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_body_part_selection: {e}")
 
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) == UserState.WAITING_FOR_SUBJECT)
+@wizard.step(UserState.WAITING_FOR_SUBJECT, "subject", next_states=[UserState.WAITING_FOR_COLOR])
 def handle_subject_description(message):
     try:
-        chat_id = message.chat.id
-        ensure_user_data(chat_id)
-
-        user_data[chat_id]['subject'] = message.text
-
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-        markup.row("Черно-белая", "Цветная")
-        markup.row("Монохром", "С акцентами цвета")
-
-        bot.send_message(
-            chat_id,
-            f"✅ <b>Изображение:</b> {user_data[chat_id]['subject']}\n\n"
-            "🌈 <b>Выбери цветовую схему:</b>",
-            reply_markup=markup,
-            parse_mode='HTML'
-        )
-        user_states[chat_id] = UserState.WAITING_FOR_COLOR
+        select_subject(message.chat.id, message.text)
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_subject_description: {e}")
 
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) == UserState.WAITING_FOR_COLOR)
+@wizard.step(UserState.WAITING_FOR_COLOR, "color", next_states=[UserState.WAITING_FOR_QUALITY])
 def handle_color_selection(message):
     try:
-        chat_id = message.chat.id
-        ensure_user_data(chat_id)
-
-        color_options = ["Черно-белая", "Цветная", "Монохром", "С акцентами цвета"]
+        if message.text in catalog.COLORS:
+            select_color(message.chat.id, message.text)
+        else:
+            bot.send_message(
+                message.chat.id,
+                "❌ Выбери вариант цвета из предложенных.",
+                parse_mode='HTML'
+            )
+    except Exception as e:
+        logger.error(f"❌ Ошибка в handle_color_selection: {e}")
 
-        if message.text in color_options:
-            user_data[chat_id]['color'] = message.text
+@wizard.step(UserState.WAITING_FOR_QUALITY, "quality")
+def handle_quality_selection(message):
+    try:
+        quality = QUALITY_BY_TITLE.get(message.text)
+        if quality:
+            select_quality(message.chat.id, quality)
+        else:
+            bot.send_message(
+                message.chat.id,
+                "❌ Выбери качество из предложенных.",
+                parse_mode='HTML'
+            )
+    except Exception as e:
+        logger.error(f"❌ Ошибка в handle_quality_selection: {e}")
+
+def register_wizard_buttons(state, parse, select):
+    """Нажатие кнопки шага: callback_data -> значение -> тот же select_*, что и для текста"""
+    @wizard.callback(state)
+    def handle_button(call):
+        value = parse(call.data)
+        if value is None:
+            notify_stale_button(call)
+            return
+        answer_wizard_button(call)
+        select(call.message.chat.id, value, call.message.message_id)
+
+register_wizard_buttons(UserState.WAITING_FOR_STYLE, catalog.STYLES.from_callback, select_style)
+register_wizard_buttons(UserState.WAITING_FOR_BODY_PART, catalog.BODY_PARTS.from_callback, select_body_part)
+register_wizard_buttons(UserState.WAITING_FOR_COLOR, catalog.COLORS.from_callback, select_color)
+register_wizard_buttons(UserState.WAITING_FOR_QUALITY, QUALITY_BY_CALLBACK.get, select_quality)
+
+def send_sketch_photo(chat_id, image, caption):
+    """Отправляет эскиз, переиспользуя file_id, если такое изображение уже загружалось"""
+    key = image_hash(image.data)
+    file_id = file_id_store.get(key)
+    if file_id:
+        try:
+            with tracing.span("telegram.send_photo", file_id=True):
+                msg = bot.send_photo(chat_id, photo=file_id, caption=caption, parse_mode='HTML')
+            logger.info(f"♻️ Эскиз отправлен по file_id без повторной загрузки: {key[:12]}")
+            return msg
+        except telebot.apihelper.ApiTelegramException as e:
+            logger.warning(f"⚠️ file_id устарел, загружаю изображение заново: {e}")
+            file_id_store.discard(key)
+
+    upload_start = time.time()
+    with tracing.span("telegram.send_photo", file_id=False, bytes=image.size):
+        msg = bot.send_photo(chat_id, photo=image.as_file(), caption=caption, parse_mode='HTML')
+    upload_time = time.time() - upload_start
+    metrics.UPLOAD_SECONDS.observe(upload_time, kind="photo")
+    logger.info(f"📤 Эскиз загружен в Telegram: {image.size / 1024:.0f} КБ за {upload_time:.1f} с")
+    if msg and msg.photo:
+        # Самый большой размер - последний в списке
+        file_id_store.set(key, msg.photo[-1].file_id)
+    return msg
+
+def format_duration(seconds):
+    """Человекочитаемая длительность: 40 с или 2 мин 5 с"""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} с"
+    return f"{seconds // 60} мин {seconds % 60} с"
+
+def update_queue_position(job, position):
+    """Показывает пользователю текущее место задачи в очереди и примерное ожидание"""
+    if not job.message_id:
+        return
+    # Задачи разбираются волнами по числу воркеров; +1 - генерация самой задачи
+    waves = -(-position // max(1, generation_queue.workers)) + 1
+    try:
+        with deferred_edits():
+            bot.edit_message_text(
+                f"🕒 <b>Эскиз в очереди</b>\n"
+                f"📋 Место в очереди: {position}\n"
+                f"⏳ Готово примерно через: {format_duration(waves * generation_latency.estimate())}\n"
+                f"🆔 Задача: <code>{job.job_id}</code>\n\n"
+                f"<i>Генерация начнется автоматически, ничего нажимать не нужно.</i>",
+                chat_id=job.chat_id,
+                message_id=job.message_id,
+                parse_mode='HTML'
+            )
+    except Exception as e:
+        logger.debug(f"Не удалось обновить позицию задачи {job.job_id}: {e}")
 
-            summary_text = (
-                f"✨ <b>Параметры эскиза:</b>\n\n"
-                f"🤖 <b>Генератор:</b> FLUX.1-dev\n"
-                f"🎨 <b>Стиль:</b> {user_data[chat_id]['style']}\n"
-                f"📍 <b>Место:</b> {user_data[chat_id]['body_part']}\n"
-                f"🖼 <b>Изображение:</b> {user_data[chat_id]['subject']}\n"
-                f"🌈 <b>Цвет:</b> {user_data[chat_id]['color']}\n\n"
-                f"⏳ <i>Генерирую эскиз... Это займет 15-45 секунд.</i>"
+def submit_generation_job(job):
+    """Ставит задачу в очередь генерации. Возвращает False, если очередь переполнена или сработал лимит"""
+    try:
+        position = generation_queue.submit(job)
+    except QueueFullError as e:
+        logger.warning(f"🚦 Очередь генерации переполнена, задача {job.job_id} отклонена: {e}")
+        text = (
+            "🚦 <b>Сейчас слишком много запросов</b>\n\n"
+            "Очередь генерации заполнена. Подожди минуту и попробуй снова."
+        )
+    except RateLimitedError as e:
+        logger.warning(f"🚦 Задача {job.job_id} от {job.chat_id} отклонена лимитом: {e}")
+        if e.retry_after is None:
+            text = (
+                "🚦 <b>У тебя уже есть эскизы в работе</b>\n\n"
+                "Дождись, пока они будут готовы, и попробуй снова."
             )
+        else:
+            text = (
+                "🚦 <b>Слишком много запросов</b>\n\n"
+                f"Попробуй снова через {max(1, round(e.retry_after))} сек."
+            )
+    else:
+        if position > generation_queue.workers - generation_queue.active_count():
+            update_queue_position(job, position)
+        return True
 
-            remove_markup = types.ReplyKeyboardRemove()
-            msg = bot.send_message(chat_id, summary_text,
-                                   reply_markup=remove_markup, parse_mode='HTML')
+    if job.message_id:
+        try:
+            bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.message_id, parse_mode='HTML')
+            return False
+        except Exception:
+            pass
+    bot.send_message(job.chat_id, text, parse_mode='HTML')
+    return False
 
-            # Запускаем генерацию
-            generate_and_send_tattoo(chat_id, msg.message_id)
+def show_job_cancelled(job):
+    """Меняет сообщение задачи на отметку об отмене"""
+    if not job.message_id:
+        return
+    try:
+        bot.edit_message_text("🛑 <b>Генерация отменена</b>", chat_id=job.chat_id, message_id=job.message_id,
+                              parse_mode='HTML')
+    except Exception as e:
+        logger.debug(f"Не удалось отметить отмену задачи {job.job_id}: {e}")
+
+def cancel_jobs(chat_id, reason):
+    """Отменяет задачи чата: ожидающие уходят из очереди, выполняемые останавливаются на ближайшей проверке.
+
+    Возвращает число отмененных задач.
+    """
+    removed, running = generation_queue.cancel(chat_id, reason)
+    for job in removed:
+        show_job_cancelled(job)
+    if removed:
+        metrics.JOBS_CANCELLED.inc(len(removed), stage="queued")
+    if running:
+        metrics.JOBS_CANCELLED.inc(len(running), stage="running")
+    if removed or running:
+        logger.info(f"🛑 Отменены задачи {chat_id} ({reason}): в очереди {len(removed)}, в работе {len(running)}")
+    return len(removed) + len(running)
+
+def resume_generation_jobs():
+    """Возвращает в очередь задачи из журнала и сообщает пользователям, что генерация продолжается"""
+    resumed, dropped = generation_queue.resume()
+    for job in resumed:
+        metrics.JOBS_RESUMED.inc(outcome="resumed")
+        if not job.message_id:
+            continue
+        try:
+            bot.edit_message_text(
+                f"🔄 <b>Бот перезапустился</b>\n"
+                f"Эскиз снова в очереди и скоро будет готов.\n"
+                f"🆔 Задача: <code>{job.job_id}</code>",
+                chat_id=job.chat_id,
+                message_id=job.message_id,
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.debug(f"Не удалось обновить сообщение задачи {job.job_id}: {e}")
+    for job in dropped:
+        report_dropped_job(job)
 
+def report_dropped_job(job):
+    """Сообщает пользователю о задаче, которая несколько раз прерывалась и убрана из очереди"""
+    metrics.JOBS_RESUMED.inc(outcome="dropped")
+    try:
+        text = ("❌ <b>Не удалось сгенерировать эскиз</b>\n"
+                "Генерация несколько раз прерывалась. Попробуйте еще раз: /generate")
+        if job.message_id:
+            bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.message_id, parse_mode='HTML')
         else:
-            bot.send_message(
-                chat_id,
-                "❌ Выбери вариант цвета из предложенных.",
-                parse_mode='HTML'
+            bot.send_message(job.chat_id, text, parse_mode='HTML')
+    except Exception as e:
+        logger.debug(f"Не удалось сообщить о сбойной задаче {job.job_id}: {e}")
+
+def show_job_paused(job):
+    """Меняет сообщение задачи на отметку, что она дождется перезапуска бота"""
+    if not job.message_id:
+        return
+    try:
+        bot.edit_message_text(
+            f"⏸ <b>Бот перезапускается</b>\n"
+            f"Эскиз сохранен в очереди и будет готов после перезапуска.\n"
+            f"🆔 Задача: <code>{job.job_id}</code>",
+            chat_id=job.chat_id,
+            message_id=job.message_id,
+            parse_mode='HTML'
+        )
+    except Exception as e:
+        logger.debug(f"Не удалось обновить сообщение задачи {job.job_id}: {e}")
+
+def drain_generation_queue():
+    """Плавная остановка: ожидающие задачи остаются в журнале, начатые дорабатываются.
+
+    Без журнала ждать приходится всю очередь - иначе задачи потеряются.
+    """
+    keep_pending = JOB_QUEUE_BACKEND == "sqlite" or bool(JOB_JOURNAL_PATH)
+    pending = generation_queue.pending_jobs()
+    if keep_pending:
+        for job in pending:
+            show_job_paused(job)
+    logger.info(f"🛑 Останавливаю очередь: в работе {generation_queue.active_count()}, "
+                f"ожидают {len(pending)}")
+    generation_queue.stop(timeout=SHUTDOWN_DRAIN_SECONDS, finish_pending=not keep_pending)
+
+def run_generation_job(job):
+    """Выполняет задачу из очереди в потоке воркера.
+
+    Вся задача - одна трасса с ID задачи: корневой спан начинается при
+    постановке в очередь, все этапы ниже пишутся дочерними спанами.
+    """
+    if job.started_at:
+        metrics.QUEUE_WAIT.observe(max(0.0, job.started_at - job.created_at), kind=job.kind)
+    with tracing.trace(job.job_id, f"job.{job.kind}", start=job.created_at,
+                       chat_id=job.chat_id, quality=job.data.get('quality') or ""):
+        if job.started_at:
+            tracing.record("queue", job.created_at, job.started_at)
+        try:
+            if job.kind == "tattoo":
+                generate_and_send_tattoo(job.chat_id, job.message_id, job.data, cancel=job.token)
+            elif job.kind == "variants":
+                generate_and_send_variants(job.chat_id, job.message_id, job.data, cancel=job.token)
+            elif job.kind == "batch":
+                generate_and_send_batch(job.chat_id, job.message_id, job.data, cancel=job.token)
+            elif job.kind == "test":
+                run_test_generation(job.chat_id)
+            else:
+                logger.error(f"❌ Неизвестный тип задачи: {job.kind}")
+                return
+        except JobCancelledError:
+            logger.info(f"🛑 Задача {job.job_id} отменена ({job.token.reason}), воркер освобожден")
+            tracing.current().set(cancelled=job.token.reason or "cancel")
+            if job.token.reason == "shutdown":
+                # Задачу вернули в очередь при остановке - ее доделает другой воркер
+                show_job_paused(job)
+            else:
+                show_job_cancelled(job)
+            return
+    # От конца мастера (постановки задачи) до отправки результата пользователю
+    metrics.JOB_SECONDS.observe(time.time() - job.created_at, kind=job.kind)
+
+def generation_progress_text(elapsed, remaining, estimate):
+    """Текст сообщения о ходе генерации"""
+    if remaining > 0:
+        eta = f"⏳ Осталось примерно: {format_duration(remaining)}"
+    else:
+        eta = "⏳ Почти готово, FLUX дорисовывает детали..."
+    return (
+        f"🎨 <b>FLUX.1-dev рисует эскиз...</b>\n"
+        f"{progress_bar(elapsed, estimate)}\n"
+        f"⏱ Прошло: {format_duration(elapsed)}\n"
+        f"{eta}"
+    )
+
+def send_generation_preview(chat_id, prompt, negative_prompt, seed, finished, quality):
+    """Быстрый черновик с малым числом шагов, пока рисуется полный эскиз.
+
+    Черновик не ждет общий лимит запросов к провайдеру: если токена нет,
+    он просто пропускается, чтобы не задерживать основной запрос.
+    """
+    if not provider_bucket.try_acquire():
+        logger.info("⏭️ Черновик пропущен: лимит запросов к провайдеру")
+        return
+    start_time = time.time()
+    try:
+        with tracing.span("preview", steps=PREVIEW_STEPS):
+            image, provider = provider_chain.text_to_image(
+                prompt,
+                model=QUALITY_TIERS[quality]["model"],
+                negative_prompt=negative_prompt,
+                guidance_scale=QUALITY_TIERS[quality]["guidance_scale"],
+                num_inference_steps=PREVIEW_STEPS,
+                height=PREVIEW_SIZE,
+                width=PREVIEW_SIZE,
+                seed=seed
             )
     except Exception as e:
-        logger.error(f"❌ Ошибка в handle_color_selection: {e}")
+        logger.warning(f"⚠️ Не удалось сгенерировать черновик: {e}")
+        return
+
+    if finished.is_set():
+        logger.info("⏭️ Черновик не нужен: полный эскиз уже готов")
+        return
+    preview = encode_image(image, "jpeg", quality=80)
+    size = QUALITY_TIERS[quality]["size"]
+    bot.send_photo(
+        chat_id,
+        photo=preview.as_file("preview"),
+        caption=f"⚡ <b>Черновик эскиза</b>\n<i>Полная версия {size}×{size} еще рисуется...</i>",
+        parse_mode='HTML'
+    )
+    logger.info(f"⚡ Черновик отправлен за {time.time() - start_time:.1f} с ({provider.name})")
 
-def generate_and_send_tattoo(chat_id, message_id=None):
-    """Функция генерации и отправки эскиза через FLUX.1-dev"""
+def generate_and_send_tattoo(chat_id, message_id=None, data=None, cancel=None):
+    """Функция генерации и отправки эскиза через FLUX.1-dev. cancel - токен отмены задачи"""
     try:
-        data = user_data.get(chat_id, {})
+        if data is None:
+            data = sessions.get_data(chat_id)
 
         if not data:
             bot.send_message(chat_id, "❌ Не удалось найти данные. Попробуйте снова /generate")
             return
 
-        # Обновляем сообщение
-        if message_id:
-            try:
-                bot.edit_message_text(
-                    "🎨 <b>FLUX.1-dev запущен...</b>\n"
-                    "⏳ Генерация через Nebius\n"
-                    "<i>Это займет 5-30 секунд</i>",
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    parse_mode='HTML'
-                )
-            except:
-                pass
-
         # Генерируем промпт
-        prompt, negative_prompt = generate_prompt(data)
+        with tracing.span("prompt"):
+            prompt, negative_prompt = generate_prompt(data)
 
         logger.info(f"📝 Генерация с промптом: {prompt[:100]}...")
 
-        # Генерируем изображение через FLUX.1-dev
-        image_bytes, error_message = generate_image_with_flux(prompt, negative_prompt)
+        # При глубокой очереди уровень качества снижается
+        requested_quality = data.get('quality', QUALITY_DEFAULT)
+        quality = effective_quality(requested_quality)
+        tier = QUALITY_TIERS[quality]
+
+        # "fresh" - пользователь просит новый вариант мимо кэша
+        use_cache = not data.get('fresh')
+        cache_key = flux_cache_key(prompt, negative_prompt, quality=quality)
+        cached = use_cache and has_cached_result(cache_key)
+        # Такой же эскиз уже генерируется для другого чата - дождемся его результата
+        coalesced = use_cache and generation_flight is not None and cache_key in generation_flight
+        estimate = generation_latency.estimate()
+
+        last_progress_text = [None]
+
+        def show_progress(elapsed, remaining):
+            text = generation_progress_text(elapsed, remaining, estimate)
+            # Telegram отклоняет правку, которая не меняет текст
+            if message_id and text != last_progress_text[0]:
+                # Прогресс не ждет лимита чата: правка уходит в фоне, устаревшая вытесняется новой
+                with deferred_edits():
+                    bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, parse_mode='HTML')
+                last_progress_text[0] = text
+
+        if not cached:
+            try:
+                show_progress(0.0, estimate)
+            except:
+                pass
 
-        if image_bytes:
-            # Обновляем сообщение
+        # Черновик и полный эскиз рисуются с одним сидом; черновик отправляется, только если успел раньше
+        seed = None
+        finished = threading.Event()
+        # Быстрому уровню черновик не нужен; при общей генерации сид выбрала первая задача
+        if PREVIEW_ENABLED and not cached and not coalesced and tier["steps"] > PREVIEW_STEPS:
+            seed = random.randint(0, 2 ** 32 - 1)
+            threading.Thread(
+                target=tracing.wrap(send_generation_preview),
+                args=(chat_id, prompt, negative_prompt, seed, finished, quality),
+                name="preview",
+                daemon=True,
+            ).start()
+
+        # Генерируем изображение через FLUX.1-dev, пока фоновый поток обновляет прогресс
+        reporter = None if cached else ProgressReporter(show_progress, estimate, interval=PROGRESS_INTERVAL)
+        if reporter:
+            reporter.start()
+        try:
+            with tracing.span("generate", quality=quality, cached=cached):
+                image, error_message = generate_image_with_flux(prompt, negative_prompt, use_cache=use_cache,
+                                                                seed=seed, keyed_by_seed=False, quality=quality,
+                                                                cancel=cancel)
+        finally:
+            finished.set()
+            if reporter:
+                reporter.stop()
+        # Эскиз уже в кэше, но пользователь его больше не ждет
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+        metrics.GENERATIONS.inc(style=data.get('style') or "unknown", quality=quality,
+                                outcome="cached" if cached and image else "ok" if image else "error")
+
+        if image:
+            # Обновляем сообщение прогресса: эскиз идет следом и важнее этой правки
             if message_id:
                 try:
-                    bot.edit_message_text(
-                        "✅ <b>Эскиз готов!</b>\n"
-                        "Отправляю изображение...",
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        parse_mode='HTML'
-                    )
+                    with deferred_edits():
+                        bot.edit_message_text(
+                            "✅ <b>Эскиз готов!</b>\n"
+                            "Отправляю изображение...",
+                            chat_id=chat_id,
+                            message_id=message_id,
+                            parse_mode='HTML'
+                        )
                 except:
                     pass
 
+            downgrade_note = ""
+            if quality != requested_quality:
+                downgrade_note = "📉 <i>Из-за нагрузки качество снижено на уровень</i>\n"
+
             # Отправляем изображение
             try:
-                image_bytes.seek(0)
-
-                bot.send_photo(
+                send_sketch_photo(
                     chat_id,
-                    photo=image_bytes,
+                    image,
                     caption=f"🎨 <b>Твой эскиз татуировки</b>\n"
-                            f"🤖 <b>Генератор:</b> FLUX.1-dev (Nebius)\n"
-                            f"📏 <b>Разрешение:</b> 1024x1024\n\n"
+                            f"🤖 <b>Генератор:</b> {generator_label(quality, image)}\n"
+                            f"📏 <b>Разрешение:</b> {tier['size']}x{tier['size']}\n"
+                            f"🎚 <b>Качество:</b> {tier['title']}\n"
+                            f"{downgrade_note}\n"
                             f"<b>Стиль:</b> {data.get('style', 'Не указан')}\n"
                             f"<b>Место:</b> {data.get('body_part', 'Не указано')}\n"
                             f"<b>Изображение:</b> {data.get('subject', 'Не указано')}\n"
                             f"<b>Цвет:</b> {data.get('color', 'Не указан')}\n\n"
-                            f"💡 <i>Сохрани для консультации с тату-мастером!</i>",
-                    parse_mode='HTML'
+                            f"💡 <i>Сохрани для консультации с тату-мастером!</i>"
                 )
             except Exception as e:
                 logger.error(f"❌ Ошибка отправки фото: {e}")
@@ -413,12 +1255,16 @@ def generate_and_send_tattoo(chat_id, message_id=None):
                 chat_id,
                 f"💭 <b>Использованный промпт:</b>\n"
                 f"<code>{prompt[:700]}</code>\n\n"
+                f"🎲 Другой вариант с теми же параметрами: /variant\n"
+                f"🎲 Несколько вариантов сразу: /variants\n"
+                f"🖼 Оригинал в PNG без сжатия: /original\n"
                 f"🔄 Новый эскиз: /generate\n"
-                f"🤖 Модель: FLUX.1-dev через Nebius",
+                f"🤖 Модель: {generator_label(quality, image)}",
                 parse_mode='HTML'
             )
 
         else:
+            tracing.current().set_error(error_message)
             # Если не удалось сгенерировать
             if message_id:
                 try:
@@ -444,8 +1290,8 @@ def generate_and_send_tattoo(chat_id, message_id=None):
                 parse_mode='HTML'
             )
 
-        reset_user_state(chat_id)
-
+    except JobCancelledError:
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка в generate_and_send_tattoo: {e}")
         import traceback
@@ -460,76 +1306,322 @@ def generate_and_send_tattoo(chat_id, message_id=None):
             )
         except:
             pass
-        reset_user_state(chat_id)
-
-def test_generation(message):
-    """Тестовая команда для проверки FLUX.1-dev"""
-    chat_id = message.chat.id
 
-    if not HF_TOKEN:
-        bot.send_message(
-            chat_id,
-            "❌ <b>Hugging Face токен не настроен</b>\n\n"
-            "Добавьте в .env файл:\n"
-            "<code>HF_TOKEN=ваш_токен</code>\n\n"
-            "Получите токен на https://huggingface.co/settings/tokens",
-            parse_mode='HTML'
-        )
+def send_variant_album(chat_id, variants, data):
+    """Отправляет варианты одним альбомом и запоминает их file_id"""
+    media = []
+    for index, (seed, image) in enumerate(variants, 1):
+        caption = None
+        if index == 1:
+            caption = (
+                f"🎲 <b>Варианты эскиза: {len(variants)}</b>\n\n"
+                f"<b>Стиль:</b> {data.get('style', 'Не указан')}\n"
+                f"<b>Место:</b> {data.get('body_part', 'Не указано')}\n"
+                f"<b>Изображение:</b> {data.get('subject', 'Не указано')}\n"
+                f"<b>Цвет:</b> {data.get('color', 'Не указан')}"
+            )
+        media.append(types.InputMediaPhoto(image.as_file(f"variant_{index}"), caption=caption, parse_mode='HTML'))
+
+    upload_start = time.time()
+    with tracing.span("telegram.send_media_group", photos=len(media)):
+        messages = bot.send_media_group(chat_id, media)
+    upload_time = time.time() - upload_start
+    metrics.UPLOAD_SECONDS.observe(upload_time, kind="album")
+    logger.info(f"📤 Альбом из {len(media)} вариантов загружен за {upload_time:.1f} с")
+    for (seed, image), msg in zip(variants, messages or []):
+        if msg.photo:
+            file_id_store.set(image_hash(image.data), msg.photo[-1].file_id)
+
+def show_series_progress(chat_id, message_id, title, done, total):
+    """Прогресс задачи из нескольких эскизов: сколько уже готово"""
+    if not message_id:
         return
+    try:
+        # Как и прогресс одного эскиза, правка уходит в фоне и не задерживает воркер
+        with deferred_edits():
+            bot.edit_message_text(
+                f"🎨 <b>FLUX.1-dev запущен...</b>\n"
+                f"⏳ {title}: {done} из {total}\n"
+                f"{progress_bar(done, total)}",
+                chat_id=chat_id,
+                message_id=message_id,
+                parse_mode='HTML'
+            )
+    except:
+        pass
+
+def generate_and_send_variants(chat_id, message_id=None, data=None, cancel=None):
+    """Генерирует несколько вариантов эскиза по очереди и отправляет их одним альбомом.
+
+    У каждого варианта свой сид, поэтому любой из них можно воспроизвести
+    и достать оригиналом через /original N. Варианты рисуются один за другим
+    внутри задачи: задача занимает один слот пользователя и не обходит его лимиты.
+    """
+    try:
+        count = max(1, min(VARIANTS_MAX, int(data.get('variants', VARIANTS_DEFAULT))))
+        quality = effective_quality(data.get('quality', QUALITY_DEFAULT))
+        prompt, negative_prompt = generate_prompt(data)
+        seeds = [random.randint(0, 2 ** 32 - 1) for _ in range(count)]
 
-    if not client:
+        start_time = time.time()
+        results = []
+        for seed in seeds:
+            show_series_progress(chat_id, message_id, "Готово вариантов", len(results), count)
+            with tracing.span("generate", quality=quality, seed=seed):
+                results.append(generate_image_with_flux(prompt, negative_prompt, seed=seed, quality=quality,
+                                                         cancel=cancel))
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+        variants = [(seed, image) for seed, (image, _) in zip(seeds, results) if image]
+        for image, _ in results:
+            metrics.GENERATIONS.inc(style=data.get('style') or "unknown", quality=quality,
+                                    outcome="ok" if image else "error")
+        logger.info(f"⏱️ Варианты: {len(variants)}/{count} за {time.time() - start_time:.1f} секунд")
+
+        if not variants:
+            error_message = next((error for _, error in results if error), "Неизвестная ошибка")
+            if message_id:
+                try:
+                    bot.edit_message_text(
+                        f"⚠️ <b>Не удалось сгенерировать варианты</b>\n\n"
+                        f"Причина: {error_message}",
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        parse_mode='HTML'
+                    )
+                except:
+                    pass
+            bot.send_message(chat_id, "🔄 Попробуй еще раз через минуту: /variants", parse_mode='HTML')
+            return
+
+        request = {key: data.get(key) for key in ('style', 'body_part', 'subject', 'color', 'quality')}
+        sessions.update_data(chat_id, last_request=request, last_variant_seeds=[seed for seed, _ in variants],
+                             last_variant_quality=quality)
+
+        if message_id:
+            try:
+                bot.edit_message_text(
+                    f"✅ <b>Готово вариантов: {len(variants)} из {count}</b>\n"
+                    "Отправляю изображения...",
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    parse_mode='HTML'
+                )
+            except:
+                pass
+
+        if len(variants) == 1:
+            send_sketch_photo(chat_id, variants[0][1], caption="🎲 <b>Вариант эскиза</b>")
+        else:
+            send_variant_album(chat_id, variants, data)
+
+        seeds_text = "\n".join(f"{index}. <code>{seed}</code>" for index, (seed, _) in enumerate(variants, 1))
         bot.send_message(
             chat_id,
-            "❌ <b>InferenceClient не инициализирован</b>\n\n"
-            "Проверьте ваш HF_TOKEN и перезапустите бота.",
+            f"🎲 <b>Сиды вариантов:</b>\n{seeds_text}\n\n"
+            f"🖼 Оригинал варианта в PNG: /original 1 … /original {len(variants)}\n"
+            f"🎲 Еще варианты: /variants\n"
+            f"🔄 Новый эскиз: /generate",
             parse_mode='HTML'
         )
-        return
 
-    bot.send_message(
-        chat_id,
-        "🧪 <b>Тестирую FLUX.1-dev через Nebius...</b>\n"
-        "⏳ Генерация тестового изображения...",
-        parse_mode='HTML'
+    except JobCancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка в generate_and_send_variants: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        try:
+            bot.send_message(
+                chat_id,
+                "❌ <b>Произошла ошибка при генерации вариантов</b>\n"
+                "🔄 Попробуй еще раз: /variants",
+                parse_mode='HTML'
+            )
+        except:
+            pass
+
+def batch_caption(index, item):
+    return (
+        f"<b>{index}.</b> {item.get('style')} · {item.get('body_part') or 'место не указано'} · "
+        f"{item.get('color')}\n{html.escape(item.get('subject') or '')}"
     )
 
+def send_batch_album(chat_id, sketches):
+    """Отправляет эскизы пакета одним альбомом: у каждого фото своя подпись с параметрами"""
+    media = [types.InputMediaPhoto(image.as_file(f"batch_{index}"), caption=batch_caption(index, item),
+                                   parse_mode='HTML')
+             for index, item, image in sketches]
+
+    upload_start = time.time()
+    with tracing.span("telegram.send_media_group", photos=len(media)):
+        messages = bot.send_media_group(chat_id, media)
+    upload_time = time.time() - upload_start
+    metrics.UPLOAD_SECONDS.observe(upload_time, kind="album")
+    logger.info(f"📤 Альбом из {len(media)} эскизов пакета загружен за {upload_time:.1f} с")
+    for (_, _, image), msg in zip(sketches, messages or []):
+        if msg.photo:
+            file_id_store.set(image_hash(image.data), msg.photo[-1].file_id)
+
+def generate_and_send_batch(chat_id, message_id=None, data=None, cancel=None):
+    """Генерирует эскизы из /batch по очереди и отправляет их одним альбомом.
+
+    Весь пакет - одна задача в очереди, поэтому эскизы рисуются один за другим:
+    пакет занимает один слот пользователя, как и одиночный эскиз.
+    """
     try:
-        # Простой тестовый промпт
-        test_prompt = "minimalist black and white tattoo of a simple geometric wolf, clean lines, elegant design, tattoo art, high quality, 8k"
-        negative_prompt = "blurry, low quality, watermark, text"
+        items = data.get('items') or []
+        if not items:
+            logger.error(f"❌ Пустой пакет у {chat_id}")
+            return
+
+        start_time = time.time()
+        results = []
+        for item in items:
+            show_series_progress(chat_id, message_id, "Готово эскизов", len(results), len(items))
+            quality = effective_quality(item.get('quality', QUALITY_DEFAULT))
+            prompt, negative_prompt = generate_prompt(item)
+            with tracing.span("generate", quality=quality, style=item.get('style') or ""):
+                image, error = generate_image_with_flux(prompt, negative_prompt, quality=quality, cancel=cancel)
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+            metrics.GENERATIONS.inc(style=item.get('style') or "unknown", quality=quality,
+                                    outcome="ok" if image else "error")
+            results.append((image, error))
+        sketches = [(index, item, image) for index, (item, (image, _)) in enumerate(zip(items, results), 1) if image]
+        failed = [(index, error) for index, (image, error) in enumerate(results, 1) if not image]
+        logger.info(f"⏱️ Пакет: {len(sketches)}/{len(items)} за {time.time() - start_time:.1f} секунд")
+
+        if message_id:
+            try:
+                bot.edit_message_text(
+                    f"✅ <b>Готово эскизов: {len(sketches)} из {len(items)}</b>\n"
+                    + ("Отправляю изображения..." if sketches else "⚠️ Ни один эскиз не получился"),
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    parse_mode='HTML'
+                )
+            except:
+                pass
 
-        image_bytes, error = generate_image_with_flux(test_prompt, negative_prompt)
+        if len(sketches) == 1:
+            index, item, image = sketches[0]
+            send_sketch_photo(chat_id, image, caption=batch_caption(index, item))
+        elif sketches:
+            send_batch_album(chat_id, sketches)
 
-        if image_bytes:
-            bot.send_photo(
+        if sketches:
+            # /variant и /original дальше работают с последним эскизом пакета
+            sessions.update_data(chat_id, last_request=sketches[-1][1], last_variant_seeds=None)
+
+        if failed:
+            failed_text = "\n".join(f"{index}. {html.escape(error or 'Неизвестная ошибка')}" for index, error in failed)
+            bot.send_message(
                 chat_id,
-                photo=image_bytes,
-                caption="✅ <b>FLUX.1-dev работает через Nebius!</b>\n"
-                        "🎨 Генерация успешна\n"
-                        "🤖 Провайдер: Nebius\n"
-                        "⚡ Модель: FLUX.1-dev\n\n"
-                        "Создайте свой эскиз: /generate",
+                f"⚠️ <b>Не получились строки:</b>\n{failed_text}\n\n"
+                "🔄 Повтори их отдельным /batch через минуту",
                 parse_mode='HTML'
             )
-        else:
+
+    except JobCancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка в generate_and_send_batch: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        try:
             bot.send_message(
                 chat_id,
-                f"❌ <b>Тест не пройден</b>\n\n"
-                f"Ошибка: {error}\n\n"
-                "Проверьте:\n"
-                "1. HF_TOKEN в .env файле\n"
-                "2. Правильный ли токен (нужен Inference API токен)\n"
-                "3. Доступность Nebius провайдера",
+                "❌ <b>Произошла ошибка при генерации пакета</b>\n"
+                "🔄 Попробуй еще раз: /batch",
                 parse_mode='HTML'
             )
+        except:
+            pass
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка теста: {e}")
-        bot.send_message(
-            chat_id,
-            f"❌ <b>Ошибка тестирования:</b> {str(e)[:200]}",
-            parse_mode='HTML'
+# Очередь генерации: обработчики только ставят задачи, FLUX вызывается в воркерах
+job_scheduler = FairScheduler(
+    per_user_concurrency=USER_MAX_CONCURRENT,
+    per_user_limit=USER_MAX_JOBS,
+    user_rate=USER_RATE_PER_MINUTE / 60,
+    user_burst=USER_BURST,
+    global_rate=GLOBAL_RATE_PER_MINUTE / 60,
+    global_burst=GLOBAL_BURST,
+)
+generation_queue = create_job_queue(
+    JOB_QUEUE_BACKEND,
+    run_generation_job,
+    workers=GENERATION_WORKERS,
+    max_size=GENERATION_QUEUE_SIZE,
+    on_position=update_queue_position,
+    sqlite_path=JOB_QUEUE_PATH,
+    scheduler=job_scheduler,
+    journal_path=JOB_JOURNAL_PATH or None,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    lease_timeout=JOB_LEASE_SECONDS,
+    on_dropped=report_dropped_job,
+)
+
+# Спекулятивная генерация нужна только там, где идет генерация, и только с кэшем результатов
+speculator = None
+choice_stats = None
+if SPECULATIVE_ENABLED:
+    if GENERATION_WORKERS > 0 and result_cache is not None:
+        choice_stats = ChoiceStats(CHOICE_STATS_PATH)
+        speculator = Speculator(
+            run_speculative_generation,
+            TokenBucket(SPECULATIVE_BUDGET_PER_HOUR / 3600, SPECULATIVE_BURST),
+            workers=SPECULATIVE_WORKERS,
+            # Настоящие задачи в очереди важнее догадок
+            is_idle=lambda: generation_queue.depth() == 0,
         )
+    else:
+        logger.warning("⚠️ Спекулятивная генерация выключена: нужны воркеры в процессе бота и кэш результатов")
+
+# Метрики, которые вычисляются в момент сбора
+metrics.instrument_telegram_api(telebot.apihelper)
+# Диспетчер ставится поверх замера: в метрику Bot API попадает сам запрос, без ожидания очереди
+outbound_dispatcher = None
+if TELEGRAM_DISPATCHER_ENABLED:
+    outbound_dispatcher = OutboundDispatcher(
+        global_rate=TELEGRAM_GLOBAL_RATE / TELEGRAM_PROCESSES,
+        global_burst=max(1, TELEGRAM_GLOBAL_RATE / TELEGRAM_PROCESSES),
+        chat_rate=TELEGRAM_CHAT_RATE / TELEGRAM_PROCESSES,
+        chat_burst=max(1, TELEGRAM_CHAT_BURST // TELEGRAM_PROCESSES),
+        max_retries=TELEGRAM_MAX_RETRIES,
+    )
+    outbound_dispatcher.install(telebot.apihelper)
+metrics.QUEUE_DEPTH.set_function(generation_queue.depth)
+metrics.ACTIVE_JOBS.set_function(generation_queue.active_count)
+metrics.ACTIVE_SESSIONS.set_function(sessions.count)
+if generation_flight is not None:
+    metrics.COALESCED_WAITING.set_function(generation_flight.waiting)
+metrics.PROVIDER_BREAKER_OPEN.set_function(lambda: {
+    (provider.name,): int(state == "open") for provider, state in provider_chain.status()
+})
+
+# Трассировка: у каждого процесса свой трассировщик, файл JSONL общий
+tracing.configure(
+    enabled=TRACE_ENABLED,
+    jsonl_path=TRACE_FILE,
+    jsonl_max_bytes=int(TRACE_FILE_MAX_MB * 1024 * 1024),
+    jsonl_backups=TRACE_FILE_BACKUPS,
+    otlp_endpoint=TRACE_OTLP_ENDPOINT,
+    service_name=TRACE_SERVICE_NAME,
+)
+
+def start_metrics_server(port=None):
+    """Запускает эндпоинт /metrics, если он включен. Возвращает сервер или None"""
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    try:
+        server = metrics.MetricsServer(METRICS_HOST, port)
+    except OSError as e:
+        logger.error(f"❌ Не удалось запустить эндпоинт метрик на порту {port}: {e}")
+        return None
+    server.start()
+    return server
 
 ## КОМАНДЫ
 
@@ -591,7 +1683,6 @@ def about_bot(message):
 def start_generation(message):
     try:
         chat_id = message.chat.id
-        ensure_user_data(chat_id)
 
         # Проверяем наличие токена
         if not HF_TOKEN:
@@ -610,7 +1701,7 @@ def start_generation(message):
             )
             return
 
-        if not client:
+        if not provider_chain.providers:
             bot.send_message(
                 chat_id,
                 "❌ <b>InferenceClient не инициализирован</b>\n\n"
@@ -619,27 +1710,214 @@ def start_generation(message):
             )
             return
 
-        # Начинаем процесс генерации
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=3)
-        styles = list(STYLE_PROMPTS.keys())
-
-        for i in range(0, len(styles), 3):
-            markup.row(*styles[i:i + 3])
-
-        bot.send_message(
+        # Начинаем процесс генерации: незаконченные эскизы этого чата больше не нужны
+        cancel_speculation(chat_id)
+        if CANCEL_ON_NEW_WIZARD:
+            cancel_jobs(chat_id, "restart")
+        message_id = show_wizard_step(
             chat_id,
             "🤖 <b>Используется FLUX.1-dev</b>\n"
             "🚀 Быстрая генерация через Nebius\n\n"
             "🎨 <b>Выбери стиль татуировки:</b>",
-            reply_markup=markup,
-            parse_mode='HTML'
+            catalog.STYLES.markup,
+            catalog.STYLES.inline_markup
         )
-        user_states[chat_id] = UserState.WAITING_FOR_STYLE
+        wizard.transition(chat_id, UserState.WAITING_FOR_STYLE, wizard_message_id=message_id)
 
     except Exception as e:
         logger.error(f"❌ Ошибка в start_generation: {e}")
         bot.reply_to(message, "❌ Ошибка. Попробуйте еще раз.")
 
+@bot.message_handler(commands=['variant'])
+def generate_variant(message):
+    """Новый вариант последнего эскиза без использования кэша"""
+    chat_id = message.chat.id
+
+    request = sessions.get_data(chat_id).get('last_request')
+    if not request:
+        bot.reply_to(message, "🤷 Пока нечего повторять. Создай эскиз: /generate")
+        return
+
+    msg = bot.send_message(
+        chat_id,
+        f"🎲 <b>Генерирую новый вариант...</b>\n\n{format_request_summary(request)}",
+        parse_mode='HTML'
+    )
+    submit_generation_job(GenerationJob(chat_id, "tattoo", data=dict(request, fresh=True), message_id=msg.message_id))
+
+@bot.message_handler(commands=['variants'])
+def generate_variants(message):
+    """Несколько вариантов последнего эскиза за одну задачу: /variants [N]"""
+    chat_id = message.chat.id
+
+    request = sessions.get_data(chat_id).get('last_request')
+    if not request:
+        bot.reply_to(message, "🤷 Пока нечего повторять. Создай эскиз: /generate")
+        return
+
+    args = message.text.split()[1:]
+    count = VARIANTS_DEFAULT
+    if args:
+        if not args[0].isdigit() or not 2 <= int(args[0]) <= VARIANTS_MAX:
+            bot.reply_to(message, f"🔢 Укажи число вариантов от 2 до {VARIANTS_MAX}, например: /variants {VARIANTS_MAX}")
+            return
+        count = int(args[0])
+    count = max(1, min(VARIANTS_MAX, count))
+
+    msg = bot.send_message(
+        chat_id,
+        f"🎲 <b>Генерирую варианты: {count}</b>\n\n{format_request_summary(request)}",
+        parse_mode='HTML'
+    )
+    submit_generation_job(GenerationJob(chat_id, "variants", data=dict(request, variants=count),
+                                        message_id=msg.message_id))
+
+@bot.message_handler(commands=['cancel'])
+def cancel_generation(message):
+    """Отменяет мастер и все задачи генерации пользователя"""
+    chat_id = message.chat.id
+    state, _ = sessions.get_session(chat_id)
+    cancel_speculation(chat_id)
+    cancelled = cancel_jobs(chat_id, "command")
+    if state != UserState.NONE:
+        reset_user_state(chat_id, wizard_message_id=None)
+
+    if cancelled:
+        text = f"🛑 <b>Отменено эскизов: {cancelled}</b>"
+    elif state != UserState.NONE:
+        text = "🛑 <b>Создание эскиза отменено</b>"
+    else:
+        text = "🤷 Отменять нечего: эскизов в работе нет."
+    bot.reply_to(message, text + "\n\n🔄 Новый эскиз: /generate", reply_markup=types.ReplyKeyboardRemove(),
+                 parse_mode='HTML')
+
+GEN_USAGE = (
+    "⚡ <b>Эскиз одной командой</b>\n\n"
+    "<code>/gen style=Японский place=Спина color=Цветная koi fish in waves</code>\n\n"
+    "• <b>style</b> (стиль), <b>place</b> (место), <b>color</b> (цвет), <b>quality</b> (качество: "
+    "draft, standard, high)\n"
+    "• Регистр не важен, хватает начала названия: <code>style=япон</code>\n"
+    "• Пробел в значении - через _ или в кавычках: <code>place=за_ухом</code>\n"
+    "• Все остальное - описание изображения\n\n"
+    "Без параметра берется: стиль Минимализм, цвет Черно-белая.\n"
+    f"📦 Несколько эскизов сразу: /batch, по строке на эскиз (до {BATCH_MAX_ITEMS})"
+)
+
+def format_request_summary(request):
+    """Параметры эскиза для сообщений /gen, /variant и /variants"""
+    quality = request.get('quality') or QUALITY_DEFAULT
+    return (
+        f"🎨 <b>Стиль:</b> {request.get('style') or 'Не указан'}\n"
+        f"📍 <b>Место:</b> {request.get('body_part') or 'Не указано'}\n"
+        f"🖼 <b>Изображение:</b> {html.escape(request.get('subject') or '')}\n"
+        f"🌈 <b>Цвет:</b> {request.get('color') or 'Не указан'}\n"
+        f"🎚 <b>Качество:</b> {QUALITY_TIERS[quality]['title'] if quality in QUALITY_TIERS else quality}"
+    )
+
+@bot.message_handler(commands=['gen'])
+def quick_generation(message):
+    """Эскиз одним сообщением, без шагов мастера: /gen style=... place=... color=... описание"""
+    chat_id = message.chat.id
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        bot.reply_to(message, GEN_USAGE, parse_mode='HTML')
+        return
+    try:
+        request = commands.parse_generation_request(args[1], QUALITY_ALIASES, QUALITY_DEFAULT)
+    except commands.CommandSyntaxError as e:
+        bot.reply_to(message, f"❌ <b>Не понял команду:</b> {html.escape(str(e))}\n\n{GEN_USAGE}", parse_mode='HTML')
+        return
+
+    msg = bot.send_message(
+        chat_id,
+        f"✨ <b>Параметры эскиза:</b>\n\n{format_request_summary(request)}\n\n"
+        f"⏳ <i>Генерирую эскиз... Это займет 15-45 секунд.</i>",
+        parse_mode='HTML'
+    )
+    if submit_generation_job(GenerationJob(chat_id, "tattoo", data=request, message_id=msg.message_id)):
+        sessions.update_data(chat_id, last_request=request, last_variant_seeds=None)
+
+@bot.message_handler(commands=['batch'])
+def batch_generation(message):
+    """Несколько эскизов одним сообщением: каждая строка после /batch - запрос в формате /gen"""
+    chat_id = message.chat.id
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        bot.reply_to(
+            message,
+            "📦 <b>Пакет эскизов</b>\n\n"
+            "Каждая строка после /batch - отдельный эскиз в формате /gen:\n"
+            "<code>/batch\n"
+            "style=Японский place=Спина color=Цветная koi fish in waves\n"
+            "style=Лайнворк place=Запястье mountain range\n"
+            "style=Геометрия q=draft wolf head</code>\n\n"
+            f"До {BATCH_MAX_ITEMS} строк, эскизы генерируются по очереди и приходят одним альбомом.\n"
+            "Подробно о параметрах: /gen",
+            parse_mode='HTML'
+        )
+        return
+    try:
+        items = commands.parse_batch(args[1], QUALITY_ALIASES, QUALITY_DEFAULT, BATCH_MAX_ITEMS)
+    except commands.CommandSyntaxError as e:
+        bot.reply_to(message, f"❌ <b>Не понял пакет:</b>\n{html.escape(str(e))}\n\nФормат строк: /gen",
+                     parse_mode='HTML')
+        return
+
+    lines = "\n".join(batch_caption(index, item).replace("\n", " - ") for index, item in enumerate(items, 1))
+    msg = bot.send_message(
+        chat_id,
+        f"📦 <b>Пакет эскизов: {len(items)}</b>\n\n{lines}\n\n"
+        f"⏳ <i>Генерирую по очереди... Это займет 15-45 секунд на эскиз.</i>",
+        parse_mode='HTML'
+    )
+    submit_generation_job(GenerationJob(chat_id, "batch", data={"items": items}, message_id=msg.message_id))
+
+@bot.message_handler(commands=['original'])
+def send_original(message):
+    """Отправляет PNG-оригинал последнего эскиза документом, без сжатия Telegram.
+
+    /original N - оригинал N-го варианта из последнего /variants.
+    """
+    chat_id = message.chat.id
+
+    data = sessions.get_data(chat_id)
+    request = data.get('last_request')
+    seed = None
+    args = message.text.split()[1:]
+    if args:
+        seeds = data.get('last_variant_seeds') or []
+        if not args[0].isdigit() or not 1 <= int(args[0]) <= len(seeds):
+            bot.reply_to(message, "🤷 Такого варианта нет. Получить варианты: /variants")
+            return
+        seed = seeds[int(args[0]) - 1]
+
+    original = None
+    if request and result_cache:
+        prompt, negative_prompt = generate_prompt(request)
+        if seed is not None:
+            qualities = [data.get('last_variant_quality') or request.get('quality', QUALITY_DEFAULT)]
+        else:
+            # Эскиз мог быть сгенерирован на уровень ниже из-за нагрузки - проверяем от запрошенного вниз
+            order = list(QUALITY_TIERS)
+            requested = request.get('quality', QUALITY_DEFAULT)
+            qualities = order[:order.index(requested) + 1][::-1] if requested in order else [QUALITY_DEFAULT]
+        for quality in qualities:
+            original = result_cache.get(flux_cache_key(prompt, negative_prompt, seed, quality))
+            if original:
+                break
+
+    if not original:
+        bot.reply_to(message, "🤷 Оригинал последнего эскиза не найден. Создай эскиз: /generate")
+        return
+
+    with metrics.UPLOAD_SECONDS.time(kind="document"):
+        bot.send_document(
+            chat_id,
+            document=EncodedImage(original, "png").as_file("tattoo_original"),
+            caption="🖼 <b>Оригинал эскиза</b> в PNG без сжатия",
+            parse_mode='HTML'
+        )
+
 @bot.message_handler(commands=['test'])
 def test_generation(message):
     """Тестовая команда для проверки FLUX.1-dev"""
@@ -656,7 +1934,7 @@ def test_generation(message):
         )
         return
 
-    if not client:
+    if not provider_chain.providers:
         bot.send_message(
             chat_id,
             "❌ <b>InferenceClient не инициализирован</b>\n\n"
@@ -665,30 +1943,35 @@ def test_generation(message):
         )
         return
 
-    bot.send_message(
+    msg = bot.send_message(
         chat_id,
         "🧪 <b>Тестирую FLUX.1-dev через Nebius...</b>\n"
         "⏳ Генерация тестового изображения...",
         parse_mode='HTML'
     )
 
+    submit_generation_job(GenerationJob(chat_id, "test", message_id=msg.message_id))
+
+def run_test_generation(chat_id):
+    """Тестовая генерация FLUX.1-dev, выполняется воркером очереди"""
     try:
         # Простой тестовый промпт
         test_prompt = "minimalist black and white tattoo of a simple geometric wolf, clean lines, elegant design, tattoo art, high quality, 8k"
         negative_prompt = "blurry, low quality, watermark, text"
 
-        image_bytes, error = generate_image_with_flux(test_prompt, negative_prompt)
+        # Проверке работоспособности хватает самого дешевого уровня
+        image, error = generate_image_with_flux(test_prompt, negative_prompt, quality="draft")
+        metrics.GENERATIONS.inc(style="test", quality="draft", outcome="ok" if image else "error")
 
-        if image_bytes:
-            bot.send_photo(
+        if image:
+            send_sketch_photo(
                 chat_id,
-                photo=image_bytes,
+                image,
                 caption="✅ <b>FLUX.1-dev работает через Nebius!</b>\n"
                         "🎨 Генерация успешна\n"
                         "🤖 Провайдер: Nebius\n"
-                        "⚡ Модель: FLUX.1-dev\n\n"
-                        "Создайте свой эскиз: /generate",
-                parse_mode='HTML'
+                        f"⚡ Модель: {QUALITY_TIERS['draft']['model'].split('/')[-1]} (быстрый уровень)\n\n"
+                        "Создайте свой эскиз: /generate"
             )
         else:
             bot.send_message(
@@ -710,17 +1993,36 @@ def test_generation(message):
             parse_mode='HTML'
         )
 
+def format_provider_status():
+    """Провайдеры и состояние их breaker для /status"""
+    icons = {"closed": "✅", "half-open": "🟡", "open": "⛔"}
+    return ", ".join(f"{icons[state]} {provider.name}" for provider, state in provider_chain.status()) or "нет"
+
+def format_cache_status():
+    """Строка статуса кэша для /status"""
+    if not result_cache:
+        return "🗃️ <b>Кэш:</b> выключен\n"
+    stats = result_cache.stats()
+    return (f"🗃️ <b>Кэш:</b> {stats['items']} эскизов, {stats['bytes'] / 1024 / 1024:.1f} МБ, "
+            f"попаданий {stats['hits']}/{stats['hits'] + stats['misses']}\n")
+
 @bot.message_handler(commands=['status'])
 def show_status(message):
     """Показывает статус FLUX.1-dev API"""
+    downgrade_text = f", снижается при очереди от {QUALITY_DOWNGRADE_DEPTH}" if QUALITY_DOWNGRADE_DEPTH else ""
+    tier = QUALITY_TIERS[QUALITY_DEFAULT]
     status_text = (
-        "📊 <b>Статус FLUX.1-dev API</b>\n\n"
+        "📊 <b>Статус FLUX API</b>\n\n"
         f"🔑 <b>Токен настроен:</b> {'✅ Да' if HF_TOKEN else '❌ Нет'}\n"
-        f"🤖 <b>Клиент инициализирован:</b> {'✅ Да' if client else '❌ Нет'}\n"
-        f"🚀 <b>Провайдер:</b> Nebius\n"
-        f"⚡ <b>Модель:</b> black-forest-labs/FLUX.1-dev\n"
-        f"📏 <b>Разрешение:</b> 1024x1024 пикселей\n"
+        f"🤖 <b>Клиент инициализирован:</b> {'✅ Да' if provider_chain.providers else '❌ Нет'}\n"
+        f"🚀 <b>Провайдеры:</b> {format_provider_status()}\n"
+        f"⚡ <b>Модель:</b> {generator_label(QUALITY_DEFAULT)}\n"
+        f"📏 <b>Разрешение:</b> {tier['size']}x{tier['size']} пикселей\n"
         f"⏱️ <b>Скорость:</b> 5-30 секунд\n"
+        f"🎚 <b>Качество по умолчанию:</b> {QUALITY_TIERS[QUALITY_DEFAULT]['title']}{downgrade_text}\n"
+        f"📋 <b>В очереди:</b> {generation_queue.depth()}, в работе: {generation_queue.active_count()}\n"
+        f"👥 <b>Активных сессий:</b> {sessions.count()}\n"
+        f"{format_cache_status()}"
         f"💳 <b>Оплата:</b> Nebius может иметь лимиты\n"
         f"🌐 <b>VPN:</b> Не требуется\n\n"
         "💡 <b>Если не работает:</b>\n"
@@ -732,6 +2034,77 @@ def show_status(message):
 
     bot.reply_to(message, status_text, parse_mode='HTML')
 
+def format_trace(spans):
+    """Дерево спанов трассы: сдвиг от начала задачи, длительность и этап"""
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent_id"], []).append(span)
+    known_ids = {span["span_id"] for span in spans}
+    # Корни - спаны без родителя или с родителем, которого нет среди записанных
+    roots = [span for span in spans if span["parent_id"] is None or span["parent_id"] not in known_ids]
+    origin = min(span["start"] for span in spans)
+
+    lines = []
+
+    def walk(span, depth):
+        details = ", ".join(f"{key}={value}" for key, value in span["attributes"].items() if key != "chat_id")
+        line = f"{span['start'] - origin:6.2f} {span['duration']:6.2f}  {'  ' * depth}{span['name']}"
+        if details:
+            line += f" ({details})"
+        if span.get("error"):
+            line += f" ⚠️ {span['error']}"
+        lines.append(html.escape(line))
+        for child in sorted(children.get(span["span_id"], []), key=lambda child: child["start"]):
+            walk(child, depth + 1)
+
+    for root in sorted(roots, key=lambda root: root["start"]):
+        walk(root, 0)
+    return "\n".join(lines)
+
+@bot.message_handler(commands=['trace'])
+def show_trace(message):
+    """Спаны задачи генерации по ID (только для администраторов).
+
+    /trace - самые долгие из последних задач этого процесса.
+    """
+    if message.chat.id not in ADMIN_IDS:
+        bot.reply_to(message, "⛔ Команда доступна только администраторам.")
+        return
+    if not TRACE_ENABLED:
+        bot.reply_to(message, "🔍 Трассировка выключена: TRACE_ENABLED=0")
+        return
+
+    parts = message.text.split()
+    if len(parts) < 2:
+        recent = tracing.TRACER.recent()
+        if not recent:
+            bot.reply_to(message, "🔍 Завершенных задач пока нет.")
+            return
+        lines = [
+            f"<code>{root['trace_id']}</code> {html.escape(root['name'])} - {root['duration']:.1f} с"
+            f"{' ⚠️' if root.get('error') else ''}"
+            for root in recent
+        ]
+        bot.reply_to(message, "🔍 <b>Самые долгие задачи:</b>\n" + "\n".join(lines) + "\n\nПодробно: /trace ID",
+                     parse_mode='HTML')
+        return
+
+    trace_id = parts[1].strip()
+    spans = tracing.TRACER.get_trace(trace_id)
+    if not spans:
+        bot.reply_to(message, f"🔍 Трасса <code>{html.escape(trace_id)}</code> не найдена.", parse_mode='HTML')
+        return
+    tree = format_trace(spans)
+    if len(tree) > 3500:
+        # Сообщение Telegram ограничено 4096 символами: обрезаем по целым строкам
+        tree = tree[:3500].rsplit("\n", 1)[0] + "\n..."
+    bot.reply_to(
+        message,
+        f"🔍 <b>Задача</b> <code>{html.escape(trace_id)}</code>, спанов: {len(spans)}\n"
+        f"<i>начало, длительность (с) и этап</i>\n<pre>{tree}</pre>",
+        parse_mode='HTML'
+    )
+
 @bot.message_handler(commands=['styles'])
 def show_styles(message):
     styles_text = (
@@ -821,6 +2194,12 @@ def help_cmd(message):
 
         "🎨 <b>Генерация эскизов:</b>\n"
         "/generate - Создать эскиз тату\n"
+        "/variant - Другой вариант последнего эскиза\n"
+        f"/variants - Сразу несколько вариантов (до {VARIANTS_MAX})\n"
+        "/gen - Эскиз одной командой с параметрами\n"
+        "/cancel - Отменить мастер и эскизы в работе\n"
+        f"/batch - Несколько эскизов одним сообщением (до {BATCH_MAX_ITEMS})\n"
+        "/original - Оригинал последнего эскиза в PNG\n"
         "/test - Проверить работу FLUX.1-dev\n"
         "/status - Статус API\n"
         "/styles - Стили татуировок\n\n"
@@ -843,15 +2222,10 @@ def help_cmd(message):
     )
     bot.reply_to(message, help_text, parse_mode='HTML')
 
-@bot.message_handler(func=lambda message: True)
+@wizard.step(UserState.NONE, "idle")
 def handle_all_messages(message):
-    """Обработка всех сообщений"""
+    """Сообщения вне мастера"""
     try:
-        chat_id = message.chat.id
-
-        if user_states.get(chat_id) != UserState.NONE:
-            return
-
         if message.text.startswith('/'):
             bot.reply_to(message,
                          "Неизвестная команда 😕\n"
@@ -869,15 +2243,50 @@ def handle_all_messages(message):
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_all_messages: {e}")
 
+# Регистрируется последним: сначала команды, затем шаг мастера по состоянию
+wizard.validate()
+bot.register_message_handler(wizard.dispatch, func=lambda message: True)
+bot.register_callback_query_handler(wizard.dispatch_callback,
+                                    func=lambda call: (call.data or "").startswith(catalog.CALLBACK_PREFIX))
+
+
+def run_webhook():
+    """Прием обновлений через webhook вместо long polling"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("❌ Для BOT_MODE=webhook нужен WEBHOOK_URL")
+
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+    print(f"🌐 Webhook установлен: {WEBHOOK_URL}")
+
+    global webhook_server
+    webhook_server = WebhookServer(bot, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET or None,
+                                   callback_text=stale_button_text)
+    webhook_server.serve_forever()
+
+
+webhook_server = None
+
+
+def request_shutdown(signum, frame):
+    """SIGTERM/SIGINT: перестает принимать обновления, остановку очереди доделывает finally в __main__"""
+    logger.info(f"🛑 Получен сигнал {signum}, прекращаю прием обновлений")
+    if webhook_server is not None:
+        # shutdown() ждет выхода из serve_forever, который крутится в этом же (главном) потоке
+        threading.Thread(target=webhook_server.shutdown, name="webhook-shutdown", daemon=True).start()
+    else:
+        bot.stop_polling()
+
 
 if __name__ == "__main__":
     print("=" * 60)
     print("🤖 TattooKaterokBot - FLUX.1-dev через InferenceClient")
     print("=" * 60)
     print(f"🔑 Hugging Face токен: {'✅ Найден' if HF_TOKEN else '❌ Не найден'}")
-    print(f"🤖 InferenceClient: {'✅ Инициализирован' if client else '❌ Не инициализирован'}")
-    print(f"🚀 Провайдер: Nebius")
+    print(f"🤖 InferenceClient: {'✅ Инициализирован' if provider_chain.providers else '❌ Не инициализирован'}")
+    print(f"🚀 Провайдеры: {', '.join(provider.name for provider in provider_chain.providers)}")
     print(f"⚡ Модель: black-forest-labs/FLUX.1-dev")
+    print(f"📡 Режим: {BOT_MODE}, очередь: {JOB_QUEUE_BACKEND}, воркеров в процессе: {GENERATION_WORKERS}")
 
     if not HF_TOKEN:
         print("\n⚠️  Для работы бота нужен токен Hugging Face:")
@@ -887,24 +2296,42 @@ if __name__ == "__main__":
         print("4. Создайте новый токен (бесплатно)")
         print("5. Добавьте в .env файл:")
         print("   HF_TOKEN=ваш_токен")
-    elif not client:
+    elif not provider_chain.providers:
         print("\n⚠️  Не удалось инициализировать InferenceClient")
         print("Проверьте ваш токен HF_TOKEN")
 
     print("=" * 60)
 
     # Создаем необходимые директории
-    directories = ["generated_tattoos"]
+    directories = [ARCHIVE_DIR]
     for dir_name in directories:
         os.makedirs(dir_name, exist_ok=True)
         print(f"📁 Создана директория: {dir_name}/")
 
     print("=" * 60)
 
+    archive_writer.start()
+    resume_generation_jobs()
+    generation_queue.start()
+    start_metrics_server()
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
     print("\n🚀 Запускаю бота...")
 
     try:
-        bot.infinity_polling(timeout=30, long_polling_timeout=30)
+        if BOT_MODE == "webhook":
+            run_webhook()
+        else:
+            bot.infinity_polling(timeout=30, long_polling_timeout=30)
     except Exception as e:
         print(f"❌ Ошибка бота: {e}")
-        print("🔄 Перезапустите бота вручную")
\ No newline at end of file
+        print("🔄 Перезапустите бота вручную")
+    finally:
+        if speculator is not None:
+            speculator.shutdown()
+        drain_generation_queue()
+        if outbound_dispatcher is not None:
+            outbound_dispatcher.flush(timeout=5)
+        archive_writer.stop()
+        tracing.TRACER.shutdown()
\ No newline at end of file
@@ -0,0 +1,305 @@
+"""Метрики в текстовом формате Prometheus и HTTP-эндпоинт для их сбора.
+
+Без внешних зависимостей: счетчики, gauge и гистограммы с метками, как в
+prometheus_client, но ровно в том объеме, который нужен боту.
+"""
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180)
+FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Текущее значение: задается set() или вычисляется функцией при каждом сборе"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """function() возвращает число или словарь {кортеж значений меток: число}"""
+        self.function = function
+
+    def _samples(self):
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                logger.debug(f"Не удалось вычислить {self.name}: {e}")
+                return []
+            items = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам плюс сумма и количество"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """Контекстный менеджер: измеряет длительность блока"""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+class Registry:
+    """Набор метрик, который отдается одним текстом"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), function=None):
+    return REGISTRY.register(Gauge(name, documentation, labelnames, function))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# Метрики бота: все в одном месте, чтобы было видно, что измеряется
+PROVIDER_LATENCY = histogram(
+    "tattoo_provider_request_seconds", "Длительность запроса к провайдеру FLUX", ["provider", "model", "outcome"])
+PROVIDER_ERRORS = counter(
+    "tattoo_provider_errors_total", "Ошибки провайдеров по типу", ["provider", "kind"])
+GENERATIONS = counter(
+    "tattoo_generations_total", "Генерации эскизов по стилю, качеству и результату", ["style", "quality", "outcome"])
+GENERATION_ERRORS = counter(
+    "tattoo_generation_errors_total", "Неудачные генерации по типу ошибки (после всех повторов)", ["kind"])
+CACHE_LOOKUPS = counter(
+    "tattoo_result_cache_lookups_total", "Обращения к кэшу результатов", ["result"])
+ENCODE_SECONDS = histogram(
+    "tattoo_image_encode_seconds", "Время кодирования изображения", ["format"], FAST_BUCKETS)
+UPLOAD_SECONDS = histogram(
+    "tattoo_telegram_upload_seconds", "Время загрузки эскиза в Telegram", ["kind"], FAST_BUCKETS)
+TELEGRAM_REQUESTS = histogram(
+    "tattoo_telegram_request_seconds", "Запросы к Bot API по методу и результату", ["method", "outcome"], FAST_BUCKETS)
+QUEUE_WAIT = histogram(
+    "tattoo_queue_wait_seconds", "Ожидание задачи в очереди до начала генерации", ["kind"])
+JOB_SECONDS = histogram(
+    "tattoo_job_end_to_end_seconds", "От постановки задачи (конец мастера) до отправки результата", ["kind"])
+TELEGRAM_OUTBOUND_WAIT = histogram(
+    "tattoo_telegram_outbound_wait_seconds", "Ожидание очереди к Bot API из-за лимитов Telegram", ["kind"], FAST_BUCKETS)
+TELEGRAM_COALESCED_EDITS = counter(
+    "tattoo_telegram_coalesced_edits_total", "Правки сообщений, вытесненные более новой правкой до отправки", ["method"])
+TELEGRAM_RATE_LIMITED = counter(
+    "tattoo_telegram_rate_limited_total", "Ответы 429 от Bot API (запрос повторен после Retry-After)", ["method"])
+WIZARD_HANDLER_SECONDS = histogram(
+    "tattoo_wizard_handler_seconds", "Время обработки сообщения на шаге мастера", ["step", "outcome"], FAST_BUCKETS)
+WIZARD_TRANSITIONS = counter(
+    "tattoo_wizard_transitions_total", "Переходы между шагами мастера", ["from_step", "to_step"])
+WIZARD_TIMEOUTS = counter(
+    "tattoo_wizard_timeouts_total", "Мастера, сброшенные по таймауту, по шагу", ["step"])
+COALESCED_GENERATIONS = counter(
+    "tattoo_coalesced_generations_total", "Генерации, получившие результат одинакового идущего запроса", ["outcome"])
+JOBS_CANCELLED = counter(
+    "tattoo_jobs_cancelled_total", "Отмененные задачи генерации: queued - до начала, running - в работе", ["stage"])
+JOBS_RESUMED = counter(
+    "tattoo_jobs_resumed_total", "Задачи из журнала после перезапуска: resumed - снова в очереди, dropped - сбойные",
+    ["outcome"])
+SPECULATIONS = counter(
+    "tattoo_speculative_generations_total",
+    "Спекулятивные генерации: started, hit, miss, cancelled, skipped_*", ["outcome"])
+QUEUE_DEPTH = gauge("tattoo_queue_depth", "Задач в очереди генерации")
+ACTIVE_JOBS = gauge("tattoo_active_jobs", "Задач в работе в этом процессе")
+ACTIVE_SESSIONS = gauge("tattoo_active_sessions", "Активных сессий пользователей")
+COALESCED_WAITING = gauge("tattoo_coalesced_waiting", "Запросов ждут результат одинаковой идущей генерации")
+PROVIDER_BREAKER_OPEN = gauge(
+    "tattoo_provider_breaker_open", "1, если breaker провайдера разомкнут", ["provider"])
+
+
+def instrument_telegram_api(apihelper):
+    """Оборачивает низкоуровневый вызов Bot API: время каждого send/edit по методу.
+
+    Все методы TeleBot проходят через apihelper._make_request, поэтому так
+    измеряются и отправки из обработчиков, и из воркеров.
+    """
+    original = apihelper._make_request
+    if getattr(original, "_instrumented", False):
+        return
+
+    def timed_request(token, method_name, *args, **kwargs):
+        start = time.monotonic()
+        outcome = "ok"
+        try:
+            return original(token, method_name, *args, **kwargs)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            TELEGRAM_REQUESTS.observe(time.monotonic() - start, method=method_name, outcome=outcome)
+
+    timed_request._instrumented = True
+    apihelper._make_request = timed_request
+
+
+class MetricsServer:
+    """HTTP-эндпоинт /metrics для Prometheus на стандартном http.server"""
+
+    def __init__(self, host="127.0.0.1", port=9464, registry=REGISTRY):
+        self.registry = registry
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                logger.debug(f"metrics: {format % args}")
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+
+    def _handle(self, request):
+        if request.path.split("?")[0] != "/metrics":
+            request.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        request.send_response(200)
+        request.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def start(self):
+        """Запускает сервер в фоновом потоке"""
+        host, port = self._httpd.server_address[:2]
+        thread = threading.Thread(target=self._httpd.serve_forever, name="metrics-server", daemon=True)
+        thread.start()
+        logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+        return thread
+
+    def shutdown(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,288 @@
+"""Исходящие запросы к Bot API: лимиты Telegram, приоритеты и склейка правок.
+
+Telegram ограничивает бота примерно 30 сообщениями в секунду всего и одним
+сообщением в секунду в чат, а при превышении отвечает 429 с Retry-After.
+OutboundDispatcher встает перед apihelper._make_request, поэтому через него
+проходят все отправки - из обработчиков, воркеров и потока прогресса:
+
+- запрос ждет токен общего bucket и bucket своего чата;
+- эскизы (sendPhoto, альбомы) идут раньше текстов, тексты - раньше правок статуса;
+- если для того же сообщения до отправки пришла новая правка, старая не
+  отправляется вовсе - уходит только последняя;
+- статусы, результат которых никому не нужен (прогресс, место в очереди),
+  внутри deferred_edits() не задерживают воркер: они уходят из фоновых потоков.
+  Остальные правки синхронные, и их ошибки получает вызывающий;
+- на 429 чат ставится на паузу на Retry-After, и запрос повторяется.
+"""
+import collections
+import contextlib
+import itertools
+import logging
+import threading
+import time
+
+import metrics
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Приоритет методов: меньше - раньше. Остальные методы (getUpdates, answerCallbackQuery...) идут без очереди
+METHOD_PRIORITY = {
+    "sendPhoto": 0,
+    "sendMediaGroup": 0,
+    "sendDocument": 0,
+    "sendMessage": 1,
+    "editMessageText": 2,
+    "editMessageCaption": 2,
+    "editMessageReplyMarkup": 2,
+    "deleteMessage": 2,
+}
+PRIORITY_NAMES = {0: "media", 1: "message", 2: "edit"}
+# Правки, которые заменяют друг друга: ключ - (метод, чат, сообщение)
+COALESCED_METHODS = frozenset({"editMessageText", "editMessageCaption", "editMessageReplyMarkup"})
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def deferred_edits():
+    """Правки сообщений в этом блоке уходят в фоне: вызов сразу возвращает True, ошибки - только в лог.
+
+    Только для статусов, которые можно потерять; без диспетчера ничего не меняет.
+    """
+    previous = getattr(_local, "defer", False)
+    _local.defer = True
+    try:
+        yield
+    finally:
+        _local.defer = previous
+
+
+class _Ticket:
+    """Запрос, ожидающий своей очереди на отправку"""
+
+    __slots__ = ("order", "chat_id", "edit_key", "tokens", "superseded")
+
+    def __init__(self, order, chat_id, edit_key, tokens):
+        self.order = order
+        self.chat_id = chat_id
+        self.edit_key = edit_key
+        self.tokens = tokens  # сколько токенов чата должно быть в запасе
+        self.superseded = False
+
+
+class OutboundDispatcher:
+    """Общий для процесса диспетчер запросов к Bot API.
+
+    global_rate/global_burst - сообщений в секунду на бота, chat_rate/chat_burst -
+    на один чат. max_retries - сколько раз повторять запрос после 429.
+    edit_senders - потоков для фоновой отправки правок (0 - правки ждут в вызывающем потоке).
+    """
+
+    def __init__(self, global_rate=30, global_burst=30, chat_rate=1, chat_burst=3, max_retries=3,
+                 max_tracked_chats=10000, edit_senders=4):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # Фоновые правки не забирают последний токен чата: эскиз или ответ после них уходит без ожидания
+        self.edit_tokens = 2 if chat_burst >= 2 else 1
+        self.max_retries = max(0, max_retries)
+        self.max_tracked_chats = max_tracked_chats
+        self._chat_buckets = collections.OrderedDict()
+        self._waiting = []
+        self._edits = {}
+        self._deferred = collections.OrderedDict()  # ключ правки -> аргументы запроса
+        self._edits_in_flight = set()
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._send_deferred, name=f"telegram-edits-{i + 1}", daemon=True)
+                         for i in range(edit_senders)]
+
+    def install(self, apihelper):
+        """Оборачивает apihelper._make_request; повторная установка ничего не меняет"""
+        original = apihelper._make_request
+        if getattr(original, "_dispatched", False):
+            return
+
+        def dispatched_request(token, method_name, method="get", params=None, files=None):
+            return self.call(original, token, method_name, method, params, files)
+
+        dispatched_request._dispatched = True
+        apihelper._make_request = dispatched_request
+        for thread in self._threads:
+            thread.start()
+
+    def call(self, request, token, method_name, method="get", params=None, files=None):
+        """Выполняет request(...) в свою очередь.
+
+        Правка сообщения внутри deferred_edits() сразу возвращает True и
+        отправляется фоновым потоком.
+        """
+        priority = METHOD_PRIORITY.get(method_name)
+        chat_id = (params or {}).get("chat_id")
+        if priority is None or chat_id is None:
+            return request(token, method_name, method, params, files)
+
+        edit_key = None
+        if method_name in COALESCED_METHODS and params.get("message_id") is not None:
+            edit_key = (method_name, str(chat_id), params["message_id"])
+            if self._threads and getattr(_local, "defer", False):
+                self._defer(edit_key, (request, token, method_name, method, params, files))
+                return True
+        return self._send(request, token, method_name, method, params, files, priority, edit_key)
+
+    def _send(self, request, token, method_name, method, params, files, priority, edit_key, tokens=1):
+        """Ждет очереди и выполняет запрос, повторяя его после 429. Вытесненная правка - True без запроса"""
+        chat_id = params["chat_id"]
+        kind = PRIORITY_NAMES[priority]
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            sent = self._wait_turn(priority, str(chat_id), edit_key, tokens)
+            metrics.TELEGRAM_OUTBOUND_WAIT.observe(time.monotonic() - start, kind=kind)
+            if not sent:
+                metrics.TELEGRAM_COALESCED_EDITS.inc(method=method_name)
+                return True
+            try:
+                return request(token, method_name, method, params, files)
+            except Exception as e:
+                retry_after = self._retry_after(e)
+                if retry_after is None or attempt >= self.max_retries:
+                    raise
+                metrics.TELEGRAM_RATE_LIMITED.inc(method=method_name)
+                logger.warning(f"🚦 Telegram просит подождать {retry_after} с ({method_name}, чат {chat_id})")
+                with self._cond:
+                    self._chat_bucket(str(chat_id)).pause(retry_after)
+                _rewind(files)
+
+    def waiting(self):
+        """Сколько запросов ждут своей очереди, включая отложенные правки"""
+        with self._cond:
+            return len(self._waiting) + len(self._deferred)
+
+    def flush(self, timeout=None):
+        """Ждет отправки отложенных правок (при остановке бота). False - не дождался"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._deferred or self._edits_in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 1.0)
+        return True
+
+    def _defer(self, edit_key, args):
+        with self._cond:
+            if edit_key in self._deferred:
+                # Место в очереди остается за старой правкой, отправится новый текст
+                metrics.TELEGRAM_COALESCED_EDITS.inc(method=edit_key[0])
+            else:
+                waiting = self._edits.get(edit_key)
+                if waiting is not None:
+                    waiting.superseded = True
+            self._deferred[edit_key] = args
+            self._cond.notify_all()
+
+    def _next_deferred(self):
+        """Правка, чат которой может получить токен сейчас (вызывается под _cond)"""
+        while True:
+            wait = None  # Нет правок - ждем _defer
+            for edit_key in self._deferred:
+                if edit_key in self._edits_in_flight:
+                    continue
+                chat_wait = self._chat_bucket(edit_key[1]).time_until_available(self.edit_tokens)
+                if chat_wait <= 0:
+                    self._edits_in_flight.add(edit_key)
+                    return edit_key, self._deferred.pop(edit_key)
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+            self._cond.wait(wait)
+
+    def _send_deferred(self):
+        """Поток фоновой отправки правок"""
+        while True:
+            with self._cond:
+                edit_key, (request, token, method_name, method, params, files) = self._next_deferred()
+            try:
+                self._send(request, token, method_name, method, params, files, METHOD_PRIORITY[method_name],
+                           edit_key, self.edit_tokens)
+            except Exception as e:
+                # Как и раньше у вызывающих: правка статуса не должна ронять генерацию
+                logger.debug(f"Не удалось отправить {method_name} в чат {edit_key[1]}: {e}")
+            finally:
+                with self._cond:
+                    self._edits_in_flight.discard(edit_key)
+                    self._cond.notify_all()
+
+    def _wait_turn(self, priority, chat_id, edit_key, tokens=1):
+        """Ждет токены для запроса. False - правку вытеснила более новая для того же сообщения"""
+        with self._cond:
+            ticket = _Ticket((priority, next(self._sequence)), chat_id, edit_key, tokens)
+            if edit_key is not None:
+                previous = self._edits.get(edit_key)
+                if previous is not None:
+                    previous.superseded = True
+                # Отложенный статус не должен прийти после этой правки и затереть ее
+                if self._deferred.pop(edit_key, None) is not None:
+                    metrics.TELEGRAM_COALESCED_EDITS.inc(method=edit_key[0])
+                self._edits[edit_key] = ticket
+            self._waiting.append(ticket)
+            self._cond.notify_all()
+            try:
+                while not ticket.superseded:
+                    wait = self._time_until_turn(ticket)
+                    if wait is not None and wait <= 0:
+                        self._chat_bucket(chat_id).try_acquire()
+                        self.global_bucket.try_acquire()
+                        return True
+                    # None - очередь за более важным запросом: он разбудит, когда уйдет
+                    self._cond.wait(wait)
+                return False
+            finally:
+                self._waiting.remove(ticket)
+                if edit_key is not None and self._edits.get(edit_key) is ticket:
+                    del self._edits[edit_key]
+                self._cond.notify_all()
+
+    def _time_until_turn(self, ticket):
+        """0 - запрос можно отправлять сейчас, иначе сколько ждать токенов или None,
+        если впереди более важный запрос (вызывается под _cond)"""
+        chat_wait = self._chat_bucket(ticket.chat_id).time_until_available(ticket.tokens)
+        if chat_wait > 0:
+            return chat_wait
+        for other in self._waiting:
+            if other.order >= ticket.order or other.superseded:
+                continue
+            # Первым в чате идет более важный запрос, а общий токен - более важному из готовых чатов
+            if other.chat_id == ticket.chat_id:
+                return None
+            if self._chat_bucket(other.chat_id).time_until_available(other.tokens) <= 0:
+                return None
+        return self.global_bucket.time_until_available()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.pop(chat_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self._chat_buckets[chat_id] = bucket
+        while len(self._chat_buckets) > self.max_tracked_chats:
+            self._chat_buckets.popitem(last=False)
+        return bucket
+
+    @staticmethod
+    def _retry_after(error):
+        """Retry-After из ответа 429 Bot API или None, если ошибка другая"""
+        if getattr(error, "error_code", None) != 429:
+            return None
+        parameters = (getattr(error, "result_json", None) or {}).get("parameters") or {}
+        return float(parameters.get("retry_after", 1))
+
+
+def _rewind(files):
+    """Перед повтором возвращает файлы запроса в начало - иначе уйдет пустая загрузка"""
+    for value in (files or {}).values():
+        stream = value[1] if isinstance(value, tuple) else value
+        stream = getattr(stream, "file", stream)
+        if hasattr(stream, "seek"):
+            try:
+                stream.seek(0)
+            except (OSError, ValueError):
+                pass
@@ -0,0 +1,70 @@
+"""Прогресс генерации: оценка времени и периодическое обновление сообщения"""
+import collections
+import logging
+import statistics
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyEstimator:
+    """Скользящая оценка длительности генерации по последним window замерам"""
+
+    def __init__(self, window=20, default=25.0):
+        self.default = default
+        self._samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def estimate(self):
+        """Медиана последних замеров (устойчива к редким долгим повторам)"""
+        with self._lock:
+            if not self._samples:
+                return self.default
+            return statistics.median(self._samples)
+
+
+class ProgressReporter:
+    """Фоновый поток, который раз в interval секунд вызывает update(elapsed, remaining).
+
+    remaining - оценка оставшегося времени в секундах (не меньше нуля). Частота
+    обновлений ограничена interval, чтобы не упираться в лимиты Telegram на
+    редактирование сообщений.
+    """
+
+    def __init__(self, update, estimate, interval=4.0):
+        self.update = update
+        self.estimate = estimate
+        self.interval = interval
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            elapsed = time.monotonic() - self.started_at
+            try:
+                self.update(elapsed, max(0.0, self.estimate - elapsed))
+            except Exception as e:
+                logger.debug(f"Не удалось обновить прогресс: {e}")
+
+
+def progress_bar(elapsed, estimate, width=10):
+    """Текстовая полоска прогресса; не доходит до конца, пока результат не готов"""
+    fraction = min(0.95, elapsed / estimate) if estimate > 0 else 0.0
+    filled = int(round(fraction * width))
+    return "▓" * filled + "░" * (width - filled)
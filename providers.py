@@ -0,0 +1,216 @@
+"""Цепочка провайдеров FLUX с автоматическим переключением и circuit breaker"""
+import logging
+import threading
+import time
+
+from huggingface_hub import InferenceClient
+
+import metrics
+from retry import ErrorKind, classify_error
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, которые говорят о состоянии провайдера. Отклоненный промпт или
+# неверный токен - проблема запроса: из-за них breaker не размыкается для всех
+BREAKER_KINDS = {ErrorKind.RATE_LIMIT, ErrorKind.OVERLOADED, ErrorKind.TIMEOUT, ErrorKind.UNKNOWN}
+
+
+class ProviderUnavailableError(Exception):
+    """Ни один провайдер из цепочки не смог сгенерировать изображение"""
+
+    def __init__(self, message, errors=None, retry_after=None):
+        super().__init__(message)
+        self.errors = errors or []
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Размыкатель: после failure_threshold ошибок подряд провайдер пропускается
+    на reset_timeout секунд, затем пропускается одна пробная попытка."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        """Можно ли сейчас отправить запрос этому провайдеру"""
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def release(self):
+        """Запрос завершился ошибкой клиента: состояние не меняется, пробная попытка освобождается"""
+        with self._lock:
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_progress = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+    def remaining_cooldown(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            return max(0.0, self.reset_timeout - (time.time() - self.opened_at))
+
+
+class Provider:
+    """Провайдер инференса с заранее созданным долгоживущим клиентом.
+
+    own_model - модель задана для провайдера явно (FLUX_PROVIDERS="имя:модель"):
+    тогда она важнее модели уровня качества.
+    """
+
+    def __init__(self, name, model, client, timeout, breaker, own_model=False):
+        self.name = name
+        self.model = model
+        self.client = client
+        self.timeout = timeout
+        self.breaker = breaker
+        self.own_model = own_model
+
+    def model_for(self, requested=None):
+        """Модель, которой этот провайдер выполнит запрос модели requested"""
+        if self.own_model or not requested:
+            return self.model
+        return requested
+
+    def __repr__(self):
+        return f"Provider({self.name}, {self.model})"
+
+
+class ProviderChain:
+    """Упорядоченный список провайдеров: первый доступный обрабатывает запрос"""
+
+    def __init__(self, providers):
+        self.providers = providers
+
+    def text_to_image(self, prompt, model=None, **params):
+        """Генерирует изображение, переходя к следующему провайдеру при ошибке.
+
+        Возвращает (image, provider). Провайдеры с разомкнутым breaker
+        пропускаются без запроса. model заменяет модель провайдера по умолчанию,
+        но не модель, заданную провайдеру явно.
+        """
+        errors = []
+        for provider in self.providers:
+            if not provider.breaker.allow():
+                logger.info(f"⏭️ Провайдер {provider.name} пропущен: breaker разомкнут еще "
+                            f"{provider.breaker.remaining_cooldown():.0f} с")
+                continue
+
+            provider_model = provider.model_for(model)
+            start_time = time.time()
+            try:
+                image = provider.client.text_to_image(prompt, model=provider_model, **params)
+            except Exception as e:
+                kind = classify_error(e)[0]
+                if kind in BREAKER_KINDS:
+                    provider.breaker.record_failure()
+                else:
+                    provider.breaker.release()
+                elapsed = time.time() - start_time
+                logger.error(f"❌ Провайдер {provider.name} ошибка за {elapsed:.1f} с: {e}")
+                metrics.PROVIDER_LATENCY.observe(elapsed, provider=provider.name, model=provider_model,
+                                                 outcome="error")
+                metrics.PROVIDER_ERRORS.inc(provider=provider.name, kind=kind)
+                errors.append((provider, e))
+                continue
+
+            metrics.PROVIDER_LATENCY.observe(time.time() - start_time, provider=provider.name,
+                                             model=provider_model, outcome="ok" if image else "empty")
+
+            if not image:
+                provider.breaker.record_failure()
+                errors.append((provider, ValueError("Пустое изображение")))
+                continue
+
+            provider.breaker.record_success()
+            return image, provider
+
+        if not errors:
+            cooldown = min((provider.breaker.remaining_cooldown() for provider in self.providers), default=None)
+            raise ProviderUnavailableError("Все провайдеры временно отключены, попробуйте через минуту",
+                                           retry_after=cooldown)
+        provider, error = errors[-1]
+        raise ProviderUnavailableError(f"{provider.name}: {error}", errors)
+
+    def status(self):
+        """Список (провайдер, состояние breaker) для /status"""
+        return [(provider, provider.breaker.state) for provider in self.providers]
+
+
+def parse_provider_specs(spec, default_timeout):
+    """Разбирает строку вида "nebius,together:модель@90,auto" в список (провайдер, модель, таймаут).
+
+    Модель None - у провайдера нет своей модели, он берет модель из запроса или модель по умолчанию.
+    """
+    result = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        timeout = default_timeout
+        if "@" in item:
+            item, timeout_text = item.rsplit("@", 1)
+            timeout = float(timeout_text)
+        name, _, model = item.partition(":")
+        result.append((name.strip(), model.strip() or None, timeout))
+    return result
+
+
+def build_provider_chain(spec, api_key, default_model, default_timeout=120,
+                         failure_threshold=3, reset_timeout=60, client_factory=InferenceClient):
+    """Создает клиентов для всех провайдеров один раз при старте.
+
+    Провайдер "auto" - маршрутизация Hugging Face по умолчанию (без явного провайдера).
+    """
+    providers = []
+    for name, model, timeout in parse_provider_specs(spec, default_timeout):
+        try:
+            client = client_factory(
+                provider=None if name == "auto" else name,
+                api_key=api_key,
+                timeout=timeout,
+            )
+        except Exception as e:
+            logger.error(f"❌ Не удалось создать клиент провайдера {name}: {e}")
+            continue
+        providers.append(Provider(name, model or default_model, client, timeout,
+                                  CircuitBreaker(failure_threshold, reset_timeout), own_model=bool(model)))
+        logger.info(f"✅ Провайдер {name}: {model or default_model}, таймаут {timeout:.0f} с")
+    return ProviderChain(providers)
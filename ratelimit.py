@@ -0,0 +1,83 @@
+"""Token bucket для ограничения частоты запросов"""
+import threading
+import time
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: rate токенов в секунду, не больше capacity.
+
+    pause(seconds) временно останавливает выдачу токенов всем потокам -
+    например, когда сервер прислал Retry-After.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # Время паузы не накапливает токены
+        elapsed = now - max(self._updated_at, self._paused_until)
+        self._updated_at = now
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    def _wait_time(self, tokens, now):
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._tokens >= tokens:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (tokens - self._tokens) / self.rate
+
+    def try_acquire(self, tokens=1):
+        """Забирает токены, если они есть, не блокируя поток"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._wait_time(tokens, now) > 0:
+                return False
+            self._tokens -= tokens
+            return True
+
+    def time_until_available(self, tokens=1):
+        """Сколько секунд ждать, пока токены станут доступны"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self._wait_time(tokens, now)
+
+    def acquire(self, tokens=1, timeout=None, cancel=None):
+        """Ждет токены не дольше timeout секунд. Возвращает False, если не дождался.
+
+        cancel - токен отмены задачи: ожидание прерывается, если задачу отменили.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(tokens, now)
+                if wait <= 0:
+                    self._tokens -= tokens
+                    return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or wait > remaining:
+                    return False
+            if cancel is None:
+                time.sleep(min(wait, 1.0))
+            elif cancel.wait(min(wait, 1.0)):
+                return False
+
+    def pause(self, seconds):
+        """Не выдавать токены ближайшие seconds секунд и обнулить накопленный запас"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
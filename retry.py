@@ -0,0 +1,170 @@
+"""Повторы запросов к провайдеру: классификация ошибок и экспоненциальная задержка"""
+import email.utils
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorKind:
+    RATE_LIMIT = "rate_limit"
+    OVERLOADED = "overloaded"
+    TIMEOUT = "timeout"
+    BAD_PROMPT = "bad_prompt"
+    AUTH = "auth"
+    UNKNOWN = "unknown"
+
+
+# Временные ошибки, которые имеет смысл повторять
+RETRYABLE_KINDS = {ErrorKind.RATE_LIMIT, ErrorKind.OVERLOADED, ErrorKind.TIMEOUT}
+
+# Порядок важности при объединении ошибок нескольких провайдеров
+_KIND_PRIORITY = [ErrorKind.RATE_LIMIT, ErrorKind.OVERLOADED, ErrorKind.TIMEOUT,
+                  ErrorKind.UNKNOWN, ErrorKind.BAD_PROMPT, ErrorKind.AUTH]
+
+
+def parse_retry_after(value):
+    """Retry-After в секундах: число секунд или HTTP-дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+def _status_and_headers(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return getattr(error, "status_code", None), {}
+    return getattr(response, "status_code", None), getattr(response, "headers", None) or {}
+
+
+def classify_error(error):
+    """Определяет тип ошибки и подсказку Retry-After: (kind, retry_after)"""
+    # Ошибка цепочки провайдеров: объединяем ошибки всех опрошенных провайдеров
+    nested = getattr(error, "errors", None)
+    if nested:
+        results = [classify_error(provider_error) for _, provider_error in nested]
+        kind = min((kind for kind, _ in results), key=_KIND_PRIORITY.index)
+        hints = [retry_after for _, retry_after in results if retry_after is not None]
+        return kind, min(hints) if hints else None
+    if nested is not None:
+        # Все провайдеры отключены breaker'ом - ждем окончания паузы
+        return ErrorKind.OVERLOADED, getattr(error, "retry_after", None)
+
+    status, headers = _status_and_headers(error)
+    retry_after = parse_retry_after(headers.get("Retry-After") if hasattr(headers, "get") else None)
+
+    if status == 429:
+        return ErrorKind.RATE_LIMIT, retry_after
+    if status in (500, 502, 503, 504, 529):
+        return ErrorKind.OVERLOADED, retry_after
+    if status in (401, 402, 403):
+        return ErrorKind.AUTH, None
+    if status in (400, 404, 413, 422):
+        return ErrorKind.BAD_PROMPT, None
+
+    name = type(error).__name__.lower()
+    text = str(error).lower()
+    if isinstance(error, TimeoutError) or "timeout" in name or "timed out" in text:
+        return ErrorKind.TIMEOUT, None
+    if isinstance(error, ConnectionError) or "connection" in name:
+        return ErrorKind.OVERLOADED, None
+    if "rate limit" in text or "too many requests" in text:
+        return ErrorKind.RATE_LIMIT, retry_after
+    if "overloaded" in name or "overloaded" in text or "unavailable" in text:
+        return ErrorKind.OVERLOADED, retry_after
+    return ErrorKind.UNKNOWN, None
+
+
+def server_retry_after(error):
+    """Retry-After, который прислал сам провайдер (заголовок ответа), или None.
+
+    В отличие от classify_error не учитывает паузу breaker'а: она говорит о
+    состоянии цепочки в этом процессе, а не о просьбе провайдера подождать.
+    """
+    nested = getattr(error, "errors", None)
+    if nested is not None:
+        hints = [server_retry_after(provider_error) for _, provider_error in nested]
+        hints = [hint for hint in hints if hint is not None]
+        return min(hints) if hints else None
+    _, headers = _status_and_headers(error)
+    return parse_retry_after(headers.get("Retry-After") if hasattr(headers, "get") else None)
+
+
+class RetryError(Exception):
+    """Запрос не удался после всех повторов (или ошибка не подлежит повтору)"""
+
+    def __init__(self, message, kind, last_error, attempts):
+        super().__init__(message)
+        self.kind = kind
+        self.last_error = last_error
+        self.attempts = attempts
+
+
+class RetryPolicy:
+    """Экспоненциальная задержка с полным джиттером в пределах дедлайна задачи"""
+
+    def __init__(self, max_attempts=4, base_delay=2.0, max_delay=30.0, deadline=180.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt):
+        """Задержка перед попыткой attempt+1 (attempt начинается с 1)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+def call_with_retry(func, policy, bucket=None, deadline=None, sleep=time.sleep, cancel=None):
+    """Вызывает func() с повторами временных ошибок.
+
+    bucket - общий для всех воркеров TokenBucket: каждая попытка забирает токен,
+    а Retry-After из ответа провайдера приостанавливает выдачу токенов всем
+    (не дольше policy.max_delay), чтобы после сбоя воркеры не набросились на
+    провайдера одновременно. Пауза breaker'а общий bucket не останавливает.
+    cancel - токен отмены задачи: проверяется перед каждой попыткой и прерывает
+    ожидание токена и паузу между попытками (сам запрос к провайдеру не прерывается).
+    """
+    if deadline is None:
+        deadline = time.monotonic() + policy.deadline
+
+    attempt = 0
+    while True:
+        attempt += 1
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+        if bucket is not None and not bucket.acquire(timeout=max(0.0, deadline - time.monotonic()), cancel=cancel):
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+            raise RetryError("Превышено время ожидания очереди к провайдеру", ErrorKind.RATE_LIMIT, None, attempt - 1)
+
+        try:
+            return func()
+        except Exception as e:
+            kind, retry_after = classify_error(e)
+            if kind not in RETRYABLE_KINDS:
+                raise RetryError(str(e), kind, e, attempt) from e
+
+            pause = server_retry_after(e)
+            if pause and bucket is not None:
+                bucket.pause(min(pause, policy.max_delay))
+
+            delay = retry_after if retry_after is not None else policy.backoff(attempt)
+            remaining = deadline - time.monotonic()
+            if attempt >= policy.max_attempts or delay >= remaining:
+                raise RetryError(str(e), kind, e, attempt) from e
+
+            logger.warning(f"🔁 Ошибка провайдера ({kind}), попытка {attempt}/{policy.max_attempts}, "
+                           f"повтор через {delay:.1f} с")
+            if cancel is None:
+                sleep(delay)
+            elif cancel.wait(delay):
+                cancel.raise_if_cancelled()
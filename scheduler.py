@@ -0,0 +1,117 @@
+"""Справедливое планирование задач генерации между пользователями"""
+import collections
+import logging
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitedError(Exception):
+    """Пользователь или бот в целом превысил лимит запросов"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class FairScheduler:
+    """Очередь ожидающих задач с круговым обходом пользователей.
+
+    У каждого пользователя своя очередь; задачи выдаются по одной от
+    каждого пользователя по кругу, поэтому тот, кто отправил десять задач,
+    не задерживает остальных. Пользователь не может выполнять больше
+    per_user_concurrency задач одновременно и держать в очереди больше
+    per_user_limit задач. Token bucket'ы ограничивают частоту новых задач
+    от одного пользователя и от всех вместе.
+
+    Класс не потокобезопасен: его защищает блокировка очереди-владельца.
+    """
+
+    def __init__(self, per_user_concurrency=1, per_user_limit=3, user_rate=0.2, user_burst=3,
+                 global_rate=2.0, global_burst=20, max_tracked_users=10000):
+        self.per_user_concurrency = max(1, per_user_concurrency)
+        self.per_user_limit = max(1, per_user_limit)
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_tracked_users = max_tracked_users
+
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self._user_buckets = collections.OrderedDict()
+        self._queues = collections.OrderedDict()  # chat_id -> deque, порядок = порядок обхода
+        self._active = collections.Counter()
+
+    def _user_bucket(self, chat_id):
+        bucket = self._user_buckets.pop(chat_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+        self._user_buckets[chat_id] = bucket
+        while len(self._user_buckets) > self.max_tracked_users:
+            self._user_buckets.popitem(last=False)
+        return bucket
+
+    def admit(self, chat_id, user_jobs=None):
+        """Проверяет лимиты перед постановкой задачи, бросает RateLimitedError.
+
+        user_jobs - сколько задач пользователя уже ждут или выполняются
+        (если не передано, считается по локальной очереди).
+        """
+        if user_jobs is None:
+            user_jobs = self.user_jobs(chat_id)
+        if user_jobs >= self.per_user_limit:
+            raise RateLimitedError(f"У пользователя уже {user_jobs} задач в работе")
+
+        # Сначала проверяем оба bucket'а: отказ по общему лимиту не должен стоить пользователю токена
+        user_bucket = self._user_bucket(chat_id)
+        user_wait = user_bucket.time_until_available()
+        if user_wait > 0:
+            raise RateLimitedError("Слишком часто", retry_after=user_wait)
+        global_wait = self.global_bucket.time_until_available()
+        if global_wait > 0:
+            raise RateLimitedError("Бот перегружен", retry_after=global_wait)
+        user_bucket.try_acquire()
+        self.global_bucket.try_acquire()
+
+    def user_jobs(self, chat_id):
+        return len(self._queues.get(chat_id, ())) + self._active[chat_id]
+
+    def push(self, job):
+        self._queues.setdefault(job.chat_id, collections.deque()).append(job)
+
+    def pop(self):
+        """Следующая задача по кругу среди пользователей, у которых есть свободный слот"""
+        for chat_id in list(self._queues):
+            if self._active[chat_id] >= self.per_user_concurrency:
+                continue
+            queue = self._queues.pop(chat_id)
+            job = queue.popleft()
+            if queue:
+                # Пользователь уходит в конец круга
+                self._queues[chat_id] = queue
+            self._active[chat_id] += 1
+            return job
+        return None
+
+    def remove(self, chat_id):
+        """Убирает все ожидающие задачи пользователя и возвращает их"""
+        return list(self._queues.pop(chat_id, ()))
+
+    def done(self, job):
+        self._active[job.chat_id] -= 1
+        if self._active[job.chat_id] <= 0:
+            del self._active[job.chat_id]
+
+    def ordered(self):
+        """Ожидающие задачи в ожидаемом порядке выдачи (без учета занятых слотов)"""
+        return round_robin([list(queue) for queue in self._queues.values()])
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+
+def round_robin(queues):
+    """Склеивает очереди пользователей по кругу: первые задачи всех, затем вторые и т.д."""
+    result = []
+    for round_index in range(max((len(queue) for queue in queues), default=0)):
+        result.extend(queue[round_index] for queue in queues if round_index < len(queue))
+    return result
@@ -0,0 +1,335 @@
+"""Хранилище сессий пользователей: шаг мастера и собранные параметры эскиза"""
+import abc
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore(abc.ABC):
+    """Базовый интерфейс хранилища сессий.
+
+    Сессия - состояние мастера (UserState) и словарь данных пользователя.
+    get_data возвращает копию: изменения сохраняются только через update_data.
+    """
+
+    default_state = 0
+
+    @abc.abstractmethod
+    def get_state(self, chat_id):
+        """Состояние мастера или default_state, если сессии нет"""
+
+    @abc.abstractmethod
+    def set_state(self, chat_id, state, **values):
+        """Меняет состояние; values дописываются в данные той же записью"""
+
+    def get_session(self, chat_id):
+        """Состояние и данные за одно чтение: (state, data)"""
+        return self.get_state(chat_id), self.get_data(chat_id)
+
+    @abc.abstractmethod
+    def get_data(self, chat_id):
+        """Копия данных сессии"""
+
+    @abc.abstractmethod
+    def update_data(self, chat_id, **values):
+        """Дописывает values в данные сессии"""
+
+    @abc.abstractmethod
+    def count(self):
+        """Количество активных сессий"""
+
+    def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """Сессии в памяти процесса с вытеснением по TTL и LRU"""
+
+    def __init__(self, ttl=7 * 24 * 3600, max_items=10000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, chat_id):
+        session = self._sessions.get(chat_id)
+        if session is None:
+            return None
+        if self.ttl and time.time() - session["touched_at"] > self.ttl:
+            del self._sessions[chat_id]
+            return None
+        return session
+
+    def _touch(self, chat_id):
+        session = self._get(chat_id)
+        if session is None:
+            session = {"state": self.default_state, "data": {}}
+            self._sessions[chat_id] = session
+        session["touched_at"] = time.time()
+        self._sessions.move_to_end(chat_id)
+        while len(self._sessions) > self.max_items:
+            self._sessions.popitem(last=False)
+        return session
+
+    def get_state(self, chat_id):
+        with self._lock:
+            session = self._get(chat_id)
+            return session["state"] if session else self.default_state
+
+    def set_state(self, chat_id, state, **values):
+        with self._lock:
+            session = self._touch(chat_id)
+            session["state"] = state
+            session["data"].update(values)
+
+    def get_data(self, chat_id):
+        with self._lock:
+            session = self._get(chat_id)
+            return dict(session["data"]) if session else {}
+
+    def get_session(self, chat_id):
+        with self._lock:
+            session = self._get(chat_id)
+            if session is None:
+                return self.default_state, {}
+            return session["state"], dict(session["data"])
+
+    def update_data(self, chat_id, **values):
+        with self._lock:
+            self._touch(chat_id)["data"].update(values)
+
+    def count(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+class SqliteSessionStore(SessionStore):
+    """Сессии в SQLite: переживают перезапуск и доступны нескольким процессам бота.
+
+    Устаревшие по TTL сессии удаляются раз в purge_interval, а сверх
+    max_items вытесняются самые давно обновленные (проверка раз в trim_every записей).
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_items=10000, purge_interval=3600, trim_every=100):
+        self.path = path
+        self.ttl = ttl
+        self.max_items = max_items
+        self.purge_interval = purge_interval
+        self.trim_every = max(1, trim_every)
+        self._local = threading.local()
+        self._last_purge = 0
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "chat_id INTEGER PRIMARY KEY, state INTEGER NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        conn.commit()
+        self._purge()
+        self._trim()
+
+    def _conn(self):
+        # У каждого потока свое соединение: sqlite3 не любит общие соединения между потоками
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            self._local.conn = conn
+        return conn
+
+    def _purge(self):
+        now = time.time()
+        if not self.ttl or now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        conn = self._conn()
+        deleted = conn.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,)).rowcount
+        conn.commit()
+        if deleted:
+            logger.info(f"🧹 Удалено устаревших сессий: {deleted}")
+
+    def _trim(self):
+        """Оставляет не больше max_items самых свежих сессий, как LRU у хранилища в памяти"""
+        if not self.max_items:
+            return
+        conn = self._conn()
+        deleted = conn.execute(
+            "DELETE FROM sessions WHERE chat_id IN "
+            "(SELECT chat_id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_items,),
+        ).rowcount
+        conn.commit()
+        if deleted:
+            logger.info(f"🧹 Вытеснено сессий сверх лимита {self.max_items}: {deleted}")
+
+    def _written(self):
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes % self.trim_every == 0
+        self._purge()
+        if due:
+            self._trim()
+
+    def _row(self, chat_id):
+        row = self._conn().execute(
+            "SELECT state, data, updated_at FROM sessions WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if row is None or (self.ttl and time.time() - row[2] > self.ttl):
+            return None
+        return row
+
+    def get_state(self, chat_id):
+        row = self._row(chat_id)
+        return row[0] if row else self.default_state
+
+    def set_state(self, chat_id, state, **values):
+        if values:
+            self._write(chat_id, values, state)
+            return
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO sessions (chat_id, state, data, updated_at) VALUES (?, ?, '{}', ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+            (chat_id, state, time.time()),
+        )
+        conn.commit()
+        self._written()
+
+    def get_data(self, chat_id):
+        row = self._row(chat_id)
+        return json.loads(row[1]) if row else {}
+
+    def get_session(self, chat_id):
+        row = self._row(chat_id)
+        if row is None:
+            return self.default_state, {}
+        return row[0], json.loads(row[1])
+
+    def update_data(self, chat_id, **values):
+        self._write(chat_id, values)
+
+    def _write(self, chat_id, values, state=None):
+        conn = self._conn()
+        # BEGIN IMMEDIATE - чтение и запись данных одной транзакцией, даже если процессов несколько
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._row(chat_id)
+            data = json.loads(row[1]) if row else {}
+            if state is None:
+                state = row[0] if row else self.default_state
+            data.update(values)
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (chat_id, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                (chat_id, state, json.dumps(data, ensure_ascii=False), time.time()),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self._written()
+
+    def count(self):
+        since = time.time() - self.ttl if self.ttl else 0
+        return self._conn().execute("SELECT COUNT(*) FROM sessions WHERE updated_at >= ?", (since,)).fetchone()[0]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisSessionStore(SessionStore):
+    """Сессии в Redis: хэш на чат, поле state и по полю на каждый параметр.
+
+    Запись - один HSET нужных полей (с EXPIRE) в транзакции MULTI/EXEC без
+    предварительного чтения, поэтому процессы, одновременно меняющие один
+    чат, не затирают чужие поля. Живые чаты учитываются в sorted set по
+    времени записи: count() не сканирует пространство ключей.
+
+    От клиента нужны hgetall, hset(key, mapping=...), expire, zadd,
+    zremrangebyscore, zcard и pipeline(transaction=True) - как у redis-py,
+    поэтому вместо Redis можно подставить локальную заглушку.
+    """
+
+    DATA_PREFIX = "d:"
+
+    def __init__(self, client, ttl=7 * 24 * 3600, prefix="tattoo:sessions:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._active_key = f"{prefix}active"
+
+    def _key(self, chat_id):
+        return f"{self.prefix}{chat_id}"
+
+    def _load(self, chat_id):
+        fields = self.client.hgetall(self._key(chat_id))
+        state, data = self.default_state, {}
+        for name, value in fields.items():
+            if isinstance(name, bytes):
+                name = name.decode("utf-8")
+            if isinstance(value, bytes):
+                value = value.decode("utf-8")
+            if name == "state":
+                state = int(value)
+            elif name.startswith(self.DATA_PREFIX):
+                data[name[len(self.DATA_PREFIX):]] = json.loads(value)
+        return state, data
+
+    def _write(self, chat_id, values, state=None):
+        mapping = {f"{self.DATA_PREFIX}{name}": json.dumps(value, ensure_ascii=False) for name, value in values.items()}
+        if state is not None:
+            mapping["state"] = int(state)
+        if not mapping:
+            return
+        key = self._key(chat_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(key, mapping=mapping)
+        if self.ttl:
+            pipe.expire(key, self.ttl)
+        pipe.zadd(self._active_key, {str(chat_id): time.time()})
+        pipe.execute()
+
+    def get_state(self, chat_id):
+        return self._load(chat_id)[0]
+
+    def set_state(self, chat_id, state, **values):
+        self._write(chat_id, values, state)
+
+    def get_data(self, chat_id):
+        return self._load(chat_id)[1]
+
+    def get_session(self, chat_id):
+        return self._load(chat_id)
+
+    def update_data(self, chat_id, **values):
+        self._write(chat_id, values)
+
+    def count(self):
+        pipe = self.client.pipeline(transaction=True)
+        if self.ttl:
+            pipe.zremrangebyscore(self._active_key, "-inf", time.time() - self.ttl)
+        pipe.zcard(self._active_key)
+        return pipe.execute()[-1]
+
+
+def create_session_store(backend, ttl, max_items=10000, sqlite_path="sessions.db", redis_url=None):
+    """Создает хранилище сессий по имени бэкенда: memory, sqlite или redis"""
+    if backend == "memory":
+        return MemorySessionStore(ttl=ttl, max_items=max_items)
+    if backend == "sqlite":
+        return SqliteSessionStore(sqlite_path, ttl=ttl, max_items=max_items)
+    if backend == "redis":
+        # redis - необязательная зависимость, нужна только для этого бэкенда
+        import redis
+        return RedisSessionStore(redis.Redis.from_url(redis_url), ttl=ttl)
+    raise ValueError(f"Неизвестный бэкенд сессий: {backend}")
@@ -0,0 +1,86 @@
+"""Объединение одинаковых запросов, которые выполняются одновременно (single flight).
+
+Если несколько задач просят один и тот же результат, пока первая еще ждет
+провайдера, остальные не отправляют своих запросов: они дожидаются первой
+и получают ее результат. Реестр живет в памяти процесса.
+"""
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Реестр идущих вызовов по ключу.
+
+    private_errors - исключения, которые касаются только первого вызова
+    (например, его задачу отменили): ждущие в этом случае не получают
+    ошибку, а повторяют вызов сами.
+    """
+
+    def __init__(self, private_errors=()):
+        self.private_errors = tuple(private_errors)
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, check=None):
+        """Вызывает function() или присоединяется к уже идущему вызову с тем же key.
+
+        Возвращает (результат, shared): shared=True - результат получен из
+        чужого вызова. Исключение function получают все, кто его ждал.
+        check() вызывается, пока идет ожидание чужого вызова, и может прервать
+        его исключением (например, если задачу ждущего отменили).
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                else:
+                    call.waiters += 1
+            if leader:
+                break
+
+            try:
+                while not call.done.wait(0.2):
+                    if check is not None:
+                        check()
+            finally:
+                with self._lock:
+                    call.waiters -= 1
+            if call.error is None:
+                return call.result, True
+            if not isinstance(call.error, self.private_errors):
+                raise call.error
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # Убираем ключ до пробуждения ждущих: следующий запрос уже найдет результат в кэше
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def in_flight(self):
+        """Сколько уникальных вызовов сейчас выполняется"""
+        with self._lock:
+            return len(self._calls)
+
+    def waiting(self):
+        """Сколько запросов ждут чужой результат"""
+        with self._lock:
+            return sum(call.waiters for call in self._calls.values())
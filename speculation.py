@@ -0,0 +1,148 @@
+"""Спекулятивная генерация: эскиз начинает рисоваться до последних шагов мастера.
+
+Когда пользователь описал изображение, уже известны стиль, место и описание -
+не хватает только цвета и качества. ChoiceStats помнит, что выбирали раньше
+с каждым стилем, а Speculator сразу запускает самый вероятный вариант.
+Результат попадает в кэш результатов: если пользователь выберет то же самое,
+задача возьмет готовый эскиз из кэша или присоединится к идущей генерации.
+Другой выбор отменяет генерацию, если она еще не началась. Число
+спекулятивных генераций ограничено бюджетом (token bucket).
+"""
+import collections
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ChoiceStats:
+    """Частоты выборов пользователей по контексту: {стиль: {поле: {значение: раз}}}.
+
+    Хранится в JSON-файле, чтобы предсказания переживали перезапуск.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._counts = collections.defaultdict(lambda: collections.defaultdict(collections.Counter))
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать {self.path}: {e}")
+            return
+        for context, fields in data.items():
+            for field, counts in fields.items():
+                self._counts[context][field].update(counts)
+
+    def record(self, context, **choices):
+        """Запоминает выбор пользователя, например record("Японский", color="Цветная")"""
+        with self._lock:
+            for field, value in choices.items():
+                self._counts[context][field][value] += 1
+            snapshot = {context: {field: dict(counts) for field, counts in fields.items()}
+                        for context, fields in self._counts.items()}
+        self._save(snapshot)
+
+    def predict(self, context, field, default=None, allowed=None):
+        """Самый частый выбор в контексте; allowed - допустимые сейчас значения"""
+        with self._lock:
+            counts = self._counts.get(context, {}).get(field)
+            ranked = counts.most_common() if counts else []
+        for value, _ in ranked:
+            if allowed is None or value in allowed:
+                return value
+        return default
+
+    def _save(self, snapshot):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить {self.path}: {e}")
+
+
+class Speculator:
+    """Спекулятивные генерации по чатам в отдельном небольшом пуле потоков.
+
+    generate(*args) - сама генерация (результат должен попасть в кэш).
+    budget - token bucket: один токен на генерацию. is_idle() - можно ли
+    сейчас занимать провайдера (например, очередь настоящих задач пуста).
+    """
+
+    def __init__(self, generate, budget, workers=1, is_idle=None):
+        self.generate = generate
+        self.budget = budget
+        self.is_idle = is_idle
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="speculative")
+        self._pending = {}  # chat_id -> (ожидаемые выборы, future)
+        self._lock = threading.Lock()
+
+    def start(self, chat_id, guess, *args):
+        """Запускает генерацию с предположением guess ({поле: значение}).
+
+        Возвращает "started", "busy" (провайдер занят настоящими задачами)
+        или "budget" (бюджет спекулятивных генераций исчерпан).
+        """
+        self.cancel(chat_id)
+        if self.is_idle is not None and not self.is_idle():
+            return "busy"
+        if not self.budget.try_acquire():
+            return "budget"
+        future = self._executor.submit(self.generate, *args)
+        with self._lock:
+            self._pending[chat_id] = (dict(guess), future)
+        return "started"
+
+    def check(self, chat_id, **choices):
+        """Сверяет очередной выбор пользователя с предположением.
+
+        None - спекуляции нет, "match" - пока совпадает, "miss" - не совпало
+        (генерация отменена, если еще не началась; начатая допишет кэш).
+        """
+        with self._lock:
+            entry = self._pending.get(chat_id)
+            if entry is None:
+                return None
+            guess, future = entry
+            if all(guess.get(field) == value for field, value in choices.items()):
+                return "match"
+            del self._pending[chat_id]
+        future.cancel()
+        return "miss"
+
+    def finish(self, chat_id):
+        """Пользователь дошел до конца мастера: забывает спекуляцию, True - она была"""
+        with self._lock:
+            return self._pending.pop(chat_id, None) is not None
+
+    def cancel(self, chat_id):
+        """Отменяет спекуляцию чата (новый мастер, сброс). True - генерация не успела начаться"""
+        with self._lock:
+            entry = self._pending.pop(chat_id, None)
+        return entry is not None and entry[1].cancel()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def shutdown(self):
+        with self._lock:
+            futures = [future for _, future in self._pending.values()]
+            self._pending.clear()
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+
+from archive import ArchiveWriter
+
+
+def archived_files(directory, extension):
+    return [os.path.join(root, name) for root, _, files in os.walk(directory)
+            for name in files if name.endswith(extension)]
+
+
+def test_submit_writes_image_and_metadata_in_background(tmp_path):
+    writer = ArchiveWriter(str(tmp_path))
+    writer.start()
+    writer.submit(lambda: b"png bytes", {"prompt": "wolf"})
+    writer.submit(b"png bytes", {"prompt": "wolf again"})  # тот же файл не пишется дважды
+    writer.stop()
+
+    images = archived_files(tmp_path, ".png")
+    assert len(images) == 1
+    with open(images[0], "rb") as f:
+        assert f.read() == b"png bytes"
+    with open(os.path.splitext(images[0])[0] + ".json", encoding="utf-8") as f:
+        metadata = json.load(f)
+    assert metadata["prompt"] == "wolf" and metadata["bytes"] == len(b"png bytes")
+
+
+def test_retention_by_count(tmp_path):
+    writer = ArchiveWriter(str(tmp_path), max_items=2)
+    writer.start()
+    for index in range(4):
+        writer.submit(f"image {index}".encode())
+    writer.stop()
+    assert len(archived_files(tmp_path, ".png")) == 2
+
+
+def test_full_queue_drops_archive_items_but_not_deferred_tasks(tmp_path):
+    writer = ArchiveWriter(str(tmp_path), queue_size=1)
+    writer._thread = threading.Thread()  # поток "запущен", но очередь никто не разбирает
+    assert writer.submit(b"first")
+    assert not writer.submit(b"second")
+    assert writer.dropped == 1
+
+    done = []
+    for index in range(5):
+        writer.defer(done.append, index)
+    assert done == [] and writer.pending() == 6
+
+    writer._thread = None
+    writer.start()
+    writer.stop()
+    assert done == [0, 1, 2, 3, 4]
+    assert len(archived_files(tmp_path, ".png")) == 1
+
+
+def test_defer_runs_inline_without_thread(tmp_path):
+    writer = ArchiveWriter(str(tmp_path))
+    done = []
+    writer.defer(done.append, "now")
+    assert done == ["now"]
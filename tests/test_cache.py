@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+
+from cache import FileIdStore, ResultCache, make_cache_key
+
+
+def test_cache_key_is_stable_and_order_independent():
+    assert make_cache_key(style="a", seed=1) == make_cache_key(seed=1, style="a")
+    assert make_cache_key(style="a", seed=1) != make_cache_key(style="a", seed=2)
+
+
+def test_put_get_and_reload_from_disk(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put("k1", b"image")
+    assert "k1" in cache
+    assert cache.get("k1") == b"image"
+    assert cache.get("missing") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    # Индекс восстанавливается по файлам после перезапуска
+    reloaded = ResultCache(str(tmp_path))
+    assert reloaded.get("k1") == b"image"
+
+
+def test_evicts_least_recently_used_by_count_and_size(tmp_path):
+    cache = ResultCache(str(tmp_path), max_items=2, max_bytes=100)
+    cache.put("a", b"1" * 10)
+    cache.put("b", b"2" * 10)
+    cache.get("a")
+    cache.put("c", b"3" * 10)
+    assert "b" not in cache and "a" in cache and "c" in cache
+
+    cache.put("big", b"4" * 95)
+    assert cache.stats()["bytes"] <= 100
+    assert "big" in cache
+
+
+def test_expired_entry_is_not_contained(tmp_path):
+    cache = ResultCache(str(tmp_path), max_age=60)
+    cache.put("old", b"image")
+    with cache._lock:
+        size, _ = cache._index["old"]
+        cache._index["old"] = (size, time.time() - 120)
+
+    assert "old" not in cache
+    assert cache.get("old") is None
+    assert not os.path.exists(cache._path("old"))
+
+
+def test_file_id_store_persists_and_evicts(tmp_path):
+    path = str(tmp_path / "file_ids.json")
+    store = FileIdStore(path, max_items=2)
+    store.set("a", "FID_A")
+    store.set("b", "FID_B")
+    store.set("c", "FID_C")
+    store.discard("b")
+
+    reloaded = FileIdStore(path)
+    assert reloaded.get("a") is None
+    assert reloaded.get("b") is None
+    assert reloaded.get("c") == "FID_C"
+
+
+def test_file_id_store_stale_snapshot_does_not_overwrite_newer(tmp_path):
+    path = str(tmp_path / "file_ids.json")
+    store = FileIdStore(path)
+    store.set("a", "FID_A")
+    old_version, old_snapshot = store._version, dict(store._items)
+    store.set("b", "FID_B")
+    # Запоздавшая запись старого снимка из другого потока
+    store._save(old_snapshot, old_version)
+    assert FileIdStore(path).get("b") == "FID_B"
+
+
+def test_file_id_store_concurrent_sets_keep_every_id(tmp_path):
+    path = str(tmp_path / "file_ids.json")
+    store = FileIdStore(path)
+    threads = [threading.Thread(target=store.set, args=(f"k{index}", f"FID{index}")) for index in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    reloaded = FileIdStore(path)
+    assert all(reloaded.get(f"k{index}") == f"FID{index}" for index in range(20))
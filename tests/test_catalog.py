@@ -0,0 +1,48 @@
+import pytest
+
+from catalog import BODY_PARTS, COLORS, STYLES, CatalogError, Section
+
+
+def test_find_is_case_insensitive_and_accepts_prefix():
+    assert STYLES.find("японский") == "Японский"
+    assert STYLES.find("япон") == "Японский"
+    assert BODY_PARTS.find("за_ухом") == "За ухом"
+    # "Б" - начало и "Биомеханики", и "Блэкворка"
+    assert STYLES.find("б") is None
+    assert STYLES.find("  ") is None
+
+
+def test_callback_data_round_trip():
+    for section in (STYLES, BODY_PARTS, COLORS):
+        for index, title in enumerate(section.titles):
+            data = section.callback_data(index)
+            assert len(data.encode("utf-8")) <= 64
+            assert section.from_callback(data) == title
+    assert STYLES.from_callback(COLORS.callback_data(0)) is None
+    assert STYLES.from_callback(STYLES.callback_data(len(STYLES))) is None
+    assert STYLES.from_callback("wsx") is None
+
+
+def test_prompt_falls_back_to_default_or_fallback():
+    assert COLORS.prompt("Цветная").startswith("vibrant colors")
+    assert STYLES.prompt("Неизвестный") == STYLES.prompts["Минимализм"]
+    assert BODY_PARTS.prompt("Локоть") == "tattoo design"
+    assert STYLES.resolve("Неизвестный") == "Минимализм" and STYLES.resolve("Скетч") == "Скетч"
+
+
+def test_shared_tables_are_read_only():
+    with pytest.raises(TypeError):
+        STYLES.prompts["Минимализм"] = "changed"
+
+
+@pytest.mark.parametrize("options, kwargs", [
+    ([], {"fallback_prompt": "x"}),
+    ([("A", "a"), ("A", "b")], {"default": "A"}),
+    ([("A", " ")], {"default": "A"}),
+    ([("Я" * 40, "a")], {"fallback_prompt": "x"}),
+    ([("A", "a")], {"default": "B"}),
+    ([("A", "a")], {}),
+])
+def test_invalid_section_raises(options, kwargs):
+    with pytest.raises(CatalogError):
+        Section("Тест", "t", options, **kwargs)
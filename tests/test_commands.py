@@ -0,0 +1,73 @@
+import pytest
+
+import catalog
+from commands import CommandSyntaxError, parse_batch, parse_generation_request
+
+QUALITIES = {"draft": "draft", "черновик": "draft", "standard": "standard", "high": "high"}
+
+
+def parse(text):
+    return parse_generation_request(text, QUALITIES, "standard")
+
+
+def test_params_anywhere_and_rest_is_subject():
+    request = parse("style=Японский koi fish place=Спина in waves q=draft")
+    assert request == {
+        "style": "Японский",
+        "body_part": "Спина",
+        "color": catalog.COLORS.default,
+        "quality": "draft",
+        "subject": "koi fish in waves",
+    }
+
+
+def test_aliases_prefixes_quotes_and_case():
+    request = parse('СТИЛЬ=реал место=за_ухом c=цвет "wolf with moon light"')
+    assert request["style"] == "Реализм"
+    assert request["body_part"] == "За ухом"
+    assert request["color"] == "Цветная"
+    assert request["subject"] == "wolf with moon light"
+
+
+def test_quoted_value_with_spaces():
+    assert parse('place="за ухом" wolf')["body_part"] == "За ухом"
+
+
+def test_defaults_without_params():
+    request = parse("rose")
+    assert request["style"] == catalog.STYLES.default
+    assert request["body_part"] is None
+    assert request["quality"] == "standard"
+
+
+def test_equals_sign_in_subject_is_not_a_param():
+    request = parse("style=Минимализм E=mc2 formula a=b")
+    assert request["style"] == "Минимализм"
+    assert request["subject"] == "E=mc2 formula a=b"
+
+
+def test_errors_are_collected():
+    with pytest.raises(CommandSyntaxError) as error:
+        parse("style=Несуществующий q=ultra")
+    message = str(error.value)
+    assert "стиль: не найдено «Несуществующий»" in message
+    assert "неизвестное качество «ultra»" in message
+    assert "нет описания изображения" in message
+
+
+def test_parse_batch():
+    requests = parse_batch("wolf\n\n  style=Японский koi  \n", QUALITIES, "standard", max_items=5)
+    assert [request["subject"] for request in requests] == ["wolf", "koi"]
+    assert requests[1]["style"] == "Японский"
+
+
+def test_parse_batch_reports_line_numbers():
+    with pytest.raises(CommandSyntaxError, match="строка 2: нет описания изображения"):
+        parse_batch("wolf\nq=draft", QUALITIES, "standard", max_items=5)
+
+
+def test_parse_batch_limits():
+    with pytest.raises(CommandSyntaxError, match="нет ни одной строки"):
+        parse_batch(" \n ", QUALITIES, "standard", max_items=5)
+    with pytest.raises(CommandSyntaxError, match="слишком много строк: 3, максимум 2"):
+        parse_batch("a\nb\nc", QUALITIES, "standard", max_items=2)
@@ -0,0 +1,145 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from fsm import MESSAGE_ID_KEY, STATE_SINCE_KEY, InvalidTransitionError, WizardRouter
+from sessions import MemorySessionStore
+
+IDLE, STYLE, PLACE = 0, 1, 2
+
+
+def message(chat_id, text=""):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=text)
+
+
+def make_router(**kwargs):
+    """Мастер из двух шагов: стиль -> место -> конец"""
+    sessions = MemorySessionStore()
+    router = WizardRouter(sessions, idle_state=IDLE, **kwargs)
+    seen = []
+
+    @router.step(IDLE, "idle")
+    def idle(update):
+        seen.append(("idle", update.text))
+
+    @router.step(STYLE, "style", next_states=[PLACE])
+    def style(update):
+        seen.append(("style", update.text))
+        router.transition(update.chat.id, PLACE, style=update.text)
+
+    @router.step(PLACE, "place")
+    def place(update):
+        seen.append(("place", update.text))
+        router.transition(update.chat.id, IDLE, body_part=update.text)
+
+    router.validate()
+    return router, sessions, seen
+
+
+def test_dispatch_runs_step_of_current_state():
+    transitions = []
+    router, sessions, seen = make_router(
+        on_transition=lambda from_step, to_step: transitions.append((from_step and from_step.name, to_step.name)))
+    router.transition(1, STYLE)
+    router.dispatch(message(1, "Японский"))
+    router.dispatch(message(1, "Спина"))
+    router.dispatch(message(1, "привет"))
+
+    assert seen == [("style", "Японский"), ("place", "Спина"), ("idle", "привет")]
+    assert transitions == [(None, "style"), ("style", "place"), ("place", "idle")]
+    state, data = sessions.get_session(1)
+    assert state == IDLE and data["style"] == "Японский" and data["body_part"] == "Спина"
+
+
+def test_transition_outside_table_is_rejected():
+    router, sessions, _ = make_router()
+    errors = []
+    router.on_dispatch = lambda step, seconds, error: errors.append(error)
+
+    @router.step(3, "broken")
+    def broken(update):
+        router.transition(update.chat.id, STYLE)
+
+    router.transition(1, 3)
+    router.dispatch(message(1))
+    assert isinstance(errors[0], InvalidTransitionError)
+    assert sessions.get_state(1) == 3
+    with pytest.raises(InvalidTransitionError):
+        router.transition(1, 42)
+
+
+def test_unknown_state_falls_back_to_idle():
+    router, sessions, seen = make_router()
+    sessions.set_state(1, 42)
+    router.dispatch(message(1, "текст"))
+    assert seen == [("idle", "текст")] and sessions.get_state(1) == IDLE
+
+
+def test_abandoned_wizard_is_reset_on_timeout():
+    timeouts = []
+    router, sessions, seen = make_router(timeout=60, on_timeout=lambda update, step: timeouts.append(step.name))
+    router.transition(1, STYLE)
+    sessions.update_data(1, **{STATE_SINCE_KEY: time.time() - 120})
+    router.dispatch(message(1, "Японский"))
+    assert timeouts == ["style"] and seen == []
+    assert sessions.get_state(1) == IDLE
+
+
+def test_validate_rejects_unknown_next_state():
+    router = WizardRouter(MemorySessionStore())
+    router.step(IDLE, "idle", next_states=[STYLE])(lambda update: None)
+    with pytest.raises(ValueError):
+        router.validate()
+
+
+def callback(chat_id, message_id, data):
+    return SimpleNamespace(message=SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=message_id),
+                           data=data)
+
+
+def make_inline_router(**kwargs):
+    stale = []
+    router, sessions, seen = make_router(on_stale=stale.append, **kwargs)
+
+    @router.callback(STYLE)
+    def style_button(call):
+        seen.append(("style button", call.data))
+        router.transition(call.message.chat.id, PLACE, style=call.data)
+
+    return router, sessions, seen, stale
+
+
+def test_callback_of_current_wizard_message_runs_step():
+    router, sessions, seen, stale = make_inline_router()
+    router.transition(1, STYLE, **{MESSAGE_ID_KEY: 10})
+    call = callback(1, 10, "ws10")
+    assert not router.is_stale(call)
+    router.dispatch_callback(call)
+    assert seen == [("style button", "ws10")] and stale == []
+    assert sessions.get_state(1) == PLACE
+
+
+def test_stale_callbacks_are_reported_not_dispatched():
+    router, sessions, seen, stale = make_inline_router(timeout=60)
+    router.transition(1, STYLE, **{MESSAGE_ID_KEY: 10})
+    old_message = callback(1, 9, "ws0")
+    assert router.is_stale(old_message)
+    router.dispatch_callback(old_message)
+
+    # У шага "место" нет обработчика кнопок
+    sessions.set_state(2, PLACE, **{MESSAGE_ID_KEY: 20})
+    no_handler = callback(2, 20, "wb0")
+    router.dispatch_callback(no_handler)
+    assert seen == [] and stale == [old_message, no_handler]
+
+
+def test_is_stale_does_not_reset_expired_wizard():
+    router, sessions, seen, stale = make_inline_router(timeout=60)
+    router.transition(1, STYLE, **{MESSAGE_ID_KEY: 10})
+    sessions.update_data(1, **{STATE_SINCE_KEY: time.time() - 120})
+    call = callback(1, 10, "ws0")
+    assert router.is_stale(call) and sessions.get_state(1) == STYLE
+
+    router.dispatch_callback(call)
+    assert stale == [call] and sessions.get_state(1) == IDLE
@@ -0,0 +1,205 @@
+import threading
+import time
+
+import pytest
+
+from jobs import GenerationJob, JobJournal, JobQueue, QueueFullError, SqliteJobQueue, create_job_queue
+from scheduler import FairScheduler
+
+
+def unlimited_scheduler(**kwargs):
+    options = dict(per_user_concurrency=10, per_user_limit=100, user_rate=1000, user_burst=1000,
+                   global_rate=1000, global_burst=1000)
+    options.update(kwargs)
+    return FairScheduler(**options)
+
+
+def wait_until(predicate, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "не дождались"
+        time.sleep(0.01)
+
+
+class Handler:
+    """handler очереди: запоминает задачи и может задерживать их до release"""
+
+    def __init__(self, block=False):
+        self.done = []
+        self.started = []
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def __call__(self, job):
+        self.started.append(job.job_id)
+        self.release.wait(5)
+        self.done.append(job.job_id)
+
+
+def test_memory_queue_runs_jobs_in_workers():
+    handler = Handler()
+    queue = JobQueue(handler, workers=2, scheduler=unlimited_scheduler())
+    queue.start()
+    jobs = [GenerationJob(chat_id, "tattoo") for chat_id in (1, 2, 3)]
+    for job in jobs:
+        queue.submit(job)
+    wait_until(lambda: len(handler.done) == 3)
+    queue.stop(timeout=2)
+    assert sorted(handler.done) == sorted(job.job_id for job in jobs)
+    assert queue.depth() == 0 and queue.active_count() == 0
+
+
+def test_memory_queue_is_bounded_and_reports_positions():
+    handler = Handler(block=True)
+    positions = []
+    queue = JobQueue(handler, workers=1, max_size=2, scheduler=unlimited_scheduler(),
+                     on_position=lambda job, position: positions.append((job.job_id, position)))
+    queue.start()
+    running = GenerationJob(1, "tattoo", job_id="run")
+    queue.submit(running)
+    wait_until(lambda: handler.started == ["run"])
+
+    assert queue.submit(GenerationJob(2, "tattoo", job_id="a")) == 1
+    assert queue.submit(GenerationJob(3, "tattoo", job_id="b")) == 2
+    with pytest.raises(QueueFullError):
+        queue.submit(GenerationJob(4, "tattoo"))
+    assert queue.position("run") == 0 and queue.position("b") == 2
+
+    handler.release.set()
+    wait_until(lambda: len(handler.done) == 3)
+    queue.stop(timeout=2)
+    # Когда "a" ушла в работу, "b" стала первой
+    assert ("b", 1) in positions
+
+
+def test_memory_queue_needs_a_worker():
+    with pytest.raises(ValueError):
+        JobQueue(Handler(), workers=0)
+    with pytest.raises(ValueError):
+        create_job_queue("memory", Handler(), workers=0, max_size=10)
+
+
+def sqlite_queue(path, handler=None, **kwargs):
+    options = dict(workers=1 if handler else 0, poll_interval=0.02, scheduler=unlimited_scheduler())
+    options.update(kwargs)
+    return SqliteJobQueue(str(path), handler, **options)
+
+
+def test_sqlite_queue_jobs_from_bot_run_in_worker_process(tmp_path):
+    path = tmp_path / "jobs.db"
+    intake = sqlite_queue(path)
+    handler = Handler()
+    worker = sqlite_queue(path, handler)
+    worker.start()
+    assert intake.submit(GenerationJob(1, "tattoo", data={"style": "Японский"}, job_id="a")) == 1
+    wait_until(lambda: handler.done == ["a"])
+    worker.stop(timeout=2)
+    assert intake.depth() == 0 and intake.position("a") is None
+
+
+def test_sqlite_queue_reclaims_expired_lease(tmp_path):
+    path = tmp_path / "jobs.db"
+    crashed = sqlite_queue(path, lease_timeout=0.1)
+    crashed.worker_name = "crashed"
+    crashed.submit(GenerationJob(1, "tattoo", job_id="a"))
+    job, _ = crashed._claim()
+    assert job.job_id == "a" and crashed.active_count() == 1
+
+    other = sqlite_queue(path, lease_timeout=0.1)
+    assert other._claim() == (None, [])
+    time.sleep(0.15)
+    reclaimed, _ = other._claim()
+    assert reclaimed.job_id == "a"
+
+    # Упавший воркер "очнулся": строка уже не его, удалить ее он не может
+    crashed._finish(job)
+    assert other.position("a") == 0
+    other._finish(reclaimed)
+    assert other.position("a") is None
+
+
+def test_sqlite_queue_cancel_reaches_running_job(tmp_path):
+    path = tmp_path / "jobs.db"
+    tokens = []
+
+    def handler(job):
+        tokens.append(job.token)
+        job.token.wait(5)
+
+    worker = sqlite_queue(path, handler)
+    worker.start()
+    intake = sqlite_queue(path)
+    intake.submit(GenerationJob(1, "tattoo", job_id="run"))
+    intake.submit(GenerationJob(2, "tattoo", job_id="queued"))
+    wait_until(lambda: tokens)
+
+    removed, running = intake.cancel(2)
+    assert [job.job_id for job in removed] == ["queued"] and running == []
+    removed, running = intake.cancel(1)
+    assert removed == [] and [job.job_id for job in running] == ["run"]
+    wait_until(lambda: tokens[0].cancelled)
+    worker.stop(timeout=2)
+    assert intake.depth() == 0
+
+
+def test_journal_resumes_unfinished_jobs_and_drops_failing_ones(tmp_path):
+    path = str(tmp_path / "journal.db")
+    journal = JobJournal(path)
+    flaky = GenerationJob(1, "tattoo", job_id="flaky", message_id=10)
+    queued = GenerationJob(2, "tattoo", job_id="queued")
+    journal.queued(flaky)
+    journal.queued(queued)
+    # "flaky" трижды начинали, и процесс каждый раз падал
+    for _ in range(3):
+        journal.running(flaky)
+
+    handler = Handler()
+    queue = JobQueue(handler, workers=1, scheduler=unlimited_scheduler(), journal=JobJournal(path), max_attempts=3)
+    resumed, dropped = queue.resume()
+    assert [job.job_id for job in resumed] == ["queued"]
+    assert [(job.job_id, job.message_id) for job in dropped] == [("flaky", 10)]
+
+    queue.start()
+    wait_until(lambda: handler.done == ["queued"])
+    queue.stop(timeout=2)
+    assert journal.unfinished() == []
+
+
+def test_sqlite_queue_cancels_unfinished_jobs_before_requeue_on_stop(tmp_path):
+    path = tmp_path / "jobs.db"
+    reasons = []
+
+    def handler(job):
+        job.token.wait(5)
+        reasons.append(job.token.reason)
+
+    worker = sqlite_queue(path, handler)
+    worker.start()
+    worker.submit(GenerationJob(1, "tattoo", job_id="a"))
+    wait_until(lambda: worker.active_count() == 1)
+    worker.stop(timeout=0.1)
+
+    # Токен отменен до возврата в очередь: задачу сразу может взять другой воркер
+    wait_until(lambda: reasons == ["shutdown"])
+    assert worker.depth() == 1 and worker.position("a") == 1
+
+
+def test_sqlite_queue_drops_job_after_max_attempts(tmp_path):
+    path = tmp_path / "jobs.db"
+    dropped = []
+    queue = sqlite_queue(path, lease_timeout=0.05, max_attempts=2, on_dropped=dropped.append)
+    queue.submit(GenerationJob(1, "tattoo", job_id="poison", message_id=10))
+    queue.submit(GenerationJob(2, "tattoo", job_id="ok"))
+
+    first, _ = queue._claim()
+    time.sleep(0.06)
+    second, _ = queue._claim()
+    assert first.job_id == second.job_id == "poison"
+
+    # Аренда истекла во второй раз: задача больше не выдается, пользователь узнает об ошибке
+    time.sleep(0.06)
+    job, _ = queue._claim()
+    assert job.job_id == "ok"
+    assert [(job.job_id, job.message_id) for job in dropped] == [("poison", 10)]
+    assert queue.position("poison") is None
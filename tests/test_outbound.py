@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+from outbound import OutboundDispatcher, deferred_edits
+
+
+class FakeApi:
+    """Вместо telebot.apihelper: запоминает запросы, на тексте "boom" - ошибка"""
+
+    def __init__(self, fail_times=0, error=None):
+        self.sent = []
+        self.fail_times = fail_times
+        self.error = error
+        self.lock = threading.Lock()
+
+    def _make_request(self, token, method_name, method="get", params=None, files=None):
+        with self.lock:
+            self.sent.append((method_name, (params or {}).get("text")))
+            if self.fail_times:
+                self.fail_times -= 1
+                raise self.error
+        if (params or {}).get("text") == "boom":
+            raise RuntimeError("boom")
+        return {"ok": True}
+
+
+class TooManyRequests(Exception):
+    error_code = 429
+    result_json = {"parameters": {"retry_after": 0.05}}
+
+
+def dispatcher(api, **kwargs):
+    options = dict(chat_rate=20, chat_burst=3, edit_senders=1)
+    options.update(kwargs)
+    result = OutboundDispatcher(**options)
+    result.install(api)
+    return result
+
+
+def send(api, method_name, chat_id=1, **params):
+    return api._make_request("token", method_name, params=dict(params, chat_id=chat_id))
+
+
+def drain_chat(api, chat_id=1, count=3):
+    for index in range(count):
+        send(api, "sendMessage", chat_id, text=f"msg{index}")
+
+
+def test_deferred_edits_of_one_message_are_coalesced():
+    api = FakeApi()
+    outbound = dispatcher(api)
+    drain_chat(api)
+    with deferred_edits():
+        for text in ("10%", "20%", "30%"):
+            assert send(api, "editMessageText", message_id=7, text=text) is True
+    assert outbound.flush(timeout=2)
+    assert [text for method, text in api.sent if method == "editMessageText"] == ["30%"]
+
+
+def test_edits_of_different_messages_are_not_coalesced():
+    api = FakeApi()
+    outbound = dispatcher(api)
+    with deferred_edits():
+        send(api, "editMessageText", message_id=7, text="a")
+        send(api, "editMessageText", message_id=8, text="b")
+        send(api, "editMessageText", chat_id=2, message_id=7, text="c")
+    assert outbound.flush(timeout=2)
+    assert sorted(text for _, text in api.sent) == ["a", "b", "c"]
+
+
+def test_sync_edit_replaces_pending_deferred_edit():
+    api = FakeApi()
+    outbound = dispatcher(api)
+    drain_chat(api)
+    with deferred_edits():
+        send(api, "editMessageText", message_id=7, text="progress")
+    send(api, "editMessageText", message_id=7, text="final")
+    assert outbound.flush(timeout=2)
+    assert [text for method, text in api.sent if method == "editMessageText"] == ["final"]
+
+
+def test_sync_edit_error_reaches_caller():
+    api = FakeApi()
+    outbound = dispatcher(api)
+    with pytest.raises(RuntimeError):
+        send(api, "editMessageText", message_id=7, text="boom")
+    # Отложенная правка ошибку только пишет в лог
+    with deferred_edits():
+        assert send(api, "editMessageText", message_id=7, text="boom") is True
+    assert outbound.flush(timeout=2)
+
+
+def test_methods_without_chat_pass_through():
+    api = FakeApi()
+    dispatcher(api, chat_rate=0.001, chat_burst=1)
+    drain_chat(api, count=1)
+    assert api._make_request("token", "answerCallbackQuery", params={"callback_query_id": "1"}) == {"ok": True}
+    assert api._make_request("token", "getMe") == {"ok": True}
+
+
+def test_retry_after_429():
+    api = FakeApi(fail_times=1, error=TooManyRequests())
+    dispatcher(api)
+    assert send(api, "sendMessage", text="hello") == {"ok": True}
+    assert api.sent == [("sendMessage", "hello"), ("sendMessage", "hello")]
+
+
+def test_429_is_raised_after_max_retries():
+    api = FakeApi(fail_times=5, error=TooManyRequests())
+    dispatcher(api, max_retries=1)
+    with pytest.raises(TooManyRequests):
+        send(api, "sendMessage", text="hello")
+    assert len(api.sent) == 2
+
+
+def test_install_is_idempotent():
+    api = FakeApi()
+    outbound = dispatcher(api)
+    wrapped = api._make_request
+    outbound.install(api)
+    assert api._make_request is wrapped
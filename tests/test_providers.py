@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from providers import (CircuitBreaker, Provider, ProviderChain, ProviderUnavailableError, build_provider_chain,
+                       parse_provider_specs)
+
+
+class HttpError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.response = type("Response", (), {"status_code": status_code, "headers": {}})()
+
+
+class FakeClient:
+    """Клиент провайдера: отвечает заданными ошибками, потом изображением"""
+
+    def __init__(self, *errors, image="image"):
+        self.errors = list(errors)
+        self.image = image
+        self.calls = []
+
+    def text_to_image(self, prompt, model=None, **params):
+        self.calls.append(model)
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.image
+
+
+def provider(name, client, threshold=1, reset_timeout=60, model="flux-dev", own_model=False):
+    return Provider(name, model, client, 30, CircuitBreaker(threshold, reset_timeout), own_model=own_model)
+
+
+def test_breaker_opens_after_threshold_and_allows_one_trial():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.failures == 0
+
+
+def test_breaker_release_frees_trial_without_closing():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow() and not breaker.allow()
+    breaker.release()
+    assert breaker.state == CircuitBreaker.HALF_OPEN and breaker.allow()
+
+
+def test_chain_opens_breaker_on_503_and_falls_back():
+    first = provider("nebius", FakeClient(HttpError(503)))
+    second = provider("together", FakeClient())
+    chain = ProviderChain([first, second])
+
+    assert chain.text_to_image("koi") == ("image", second)
+    assert first.breaker.state == CircuitBreaker.OPEN
+    # Разомкнутый провайдер пропускается без запроса
+    chain.text_to_image("koi")
+    assert len(first.client.calls) == 1
+
+
+def test_chain_keeps_breaker_closed_on_rejected_prompt():
+    first = provider("nebius", FakeClient(HttpError(422)))
+    chain = ProviderChain([first])
+    with pytest.raises(ProviderUnavailableError) as error:
+        chain.text_to_image("koi")
+    assert first.breaker.state == CircuitBreaker.CLOSED
+    assert [p for p, _ in error.value.errors] == [first]
+    assert chain.text_to_image("koi") == ("image", first)
+
+
+def test_chain_reports_cooldown_when_all_breakers_open():
+    only = provider("nebius", FakeClient(), reset_timeout=30)
+    only.breaker.record_failure()
+    with pytest.raises(ProviderUnavailableError) as error:
+        ProviderChain([only]).text_to_image("koi")
+    assert 0 < error.value.retry_after <= 30
+
+
+def test_provider_own_model_wins_over_requested():
+    shared = provider("auto", FakeClient())
+    pinned = provider("together", FakeClient(), model="flux-schnell", own_model=True)
+    assert shared.model_for("flux-pro") == "flux-pro" and shared.model_for(None) == "flux-dev"
+    assert pinned.model_for("flux-pro") == "flux-schnell"
+
+
+def test_build_chain_from_spec():
+    assert parse_provider_specs("nebius, together:flux-schnell@90,,auto", 120) == [
+        ("nebius", None, 120), ("together", "flux-schnell", 90.0), ("auto", None, 120),
+    ]
+    created = []
+
+    def factory(provider, api_key, timeout):
+        created.append(provider)
+        return FakeClient()
+
+    chain = build_provider_chain("nebius,auto", "token", "flux-dev", client_factory=factory)
+    assert created == ["nebius", None]
+    assert [p.name for p in chain.providers] == ["nebius", "auto"]
@@ -0,0 +1,118 @@
+import pytest
+
+from ratelimit import TokenBucket
+from retry import ErrorKind, RetryError, RetryPolicy, call_with_retry, classify_error
+
+
+class HttpError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.response = type("Response", (), {"status_code": status_code, "headers": headers or {}})()
+
+
+class ChainError(Exception):
+    def __init__(self, errors, retry_after=None):
+        super().__init__("все провайдеры недоступны")
+        self.errors = errors
+        self.retry_after = retry_after
+
+
+@pytest.mark.parametrize("error, kind", [
+    (HttpError(429), ErrorKind.RATE_LIMIT),
+    (HttpError(503), ErrorKind.OVERLOADED),
+    (HttpError(401), ErrorKind.AUTH),
+    (HttpError(422), ErrorKind.BAD_PROMPT),
+    (TimeoutError("read timed out"), ErrorKind.TIMEOUT),
+    (ConnectionError("reset"), ErrorKind.OVERLOADED),
+    (RuntimeError("Too Many Requests"), ErrorKind.RATE_LIMIT),
+    (RuntimeError("что-то странное"), ErrorKind.UNKNOWN),
+])
+def test_classify_error(error, kind):
+    assert classify_error(error)[0] == kind
+
+
+def test_classify_error_reads_retry_after():
+    assert classify_error(HttpError(429, {"Retry-After": "7"})) == (ErrorKind.RATE_LIMIT, 7.0)
+    assert classify_error(HttpError(401, {"Retry-After": "7"})) == (ErrorKind.AUTH, None)
+
+
+def test_classify_chain_error_takes_most_important_kind():
+    error = ChainError([("a", HttpError(422)), ("b", HttpError(503, {"Retry-After": "5"})),
+                        ("c", HttpError(429, {"Retry-After": "3"}))])
+    assert classify_error(error) == (ErrorKind.RATE_LIMIT, 3.0)
+    # Все провайдеры на паузе breaker'а
+    assert classify_error(ChainError([], retry_after=12)) == (ErrorKind.OVERLOADED, 12)
+
+
+def failing(*errors, result="image"):
+    """func для call_with_retry: бросает errors по очереди, затем возвращает result"""
+    calls = []
+
+    def func():
+        calls.append(len(calls))
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return func, calls
+
+
+def test_call_with_retry_retries_temporary_errors():
+    func, calls = failing(HttpError(503), TimeoutError("timed out"))
+    sleeps = []
+    policy = RetryPolicy(max_attempts=4, base_delay=1, max_delay=2)
+    assert call_with_retry(func, policy, sleep=sleeps.append) == "image"
+    assert len(calls) == 3
+    assert len(sleeps) == 2 and all(0 <= delay <= 2 for delay in sleeps)
+
+
+def test_call_with_retry_does_not_retry_bad_prompt():
+    func, calls = failing(HttpError(422))
+    with pytest.raises(RetryError) as error:
+        call_with_retry(func, RetryPolicy(), sleep=lambda delay: None)
+    assert error.value.kind == ErrorKind.BAD_PROMPT
+    assert error.value.attempts == 1 and len(calls) == 1
+
+
+def test_call_with_retry_gives_up_after_max_attempts():
+    func, calls = failing(*[HttpError(503)] * 5)
+    with pytest.raises(RetryError) as error:
+        call_with_retry(func, RetryPolicy(max_attempts=3), sleep=lambda delay: None)
+    assert error.value.kind == ErrorKind.OVERLOADED
+    assert error.value.attempts == 3 and len(calls) == 3
+
+
+class RecordingBucket(TokenBucket):
+    """Bucket без ограничений, который запоминает паузы"""
+
+    def __init__(self):
+        super().__init__(1000, 1000)
+        self.paused = []
+
+    def pause(self, seconds):
+        self.paused.append(seconds)
+
+
+def test_call_with_retry_waits_retry_after_and_pauses_bucket():
+    func, calls = failing(HttpError(429, {"Retry-After": "60"}))
+    sleeps = []
+    bucket = RecordingBucket()
+    policy = RetryPolicy(max_attempts=3, max_delay=5, deadline=120)
+    assert call_with_retry(func, policy, bucket=bucket, sleep=sleeps.append) == "image"
+    assert sleeps == [60.0]
+    # Общий bucket встает не дольше max_delay, даже если провайдер просит больше
+    assert bucket.paused == [5]
+
+
+def test_call_with_retry_does_not_pause_bucket_without_retry_after():
+    func, calls = failing(HttpError(503))
+    bucket = RecordingBucket()
+    assert call_with_retry(func, RetryPolicy(), bucket=bucket, sleep=lambda delay: None) == "image"
+    assert bucket.paused == []
+
+
+def test_call_with_retry_stops_before_deadline():
+    func, calls = failing(HttpError(429, {"Retry-After": "60"}))
+    with pytest.raises(RetryError):
+        call_with_retry(func, RetryPolicy(deadline=10), sleep=lambda delay: None)
+    assert len(calls) == 1
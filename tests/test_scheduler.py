@@ -0,0 +1,83 @@
+import collections
+
+import pytest
+
+from scheduler import FairScheduler, RateLimitedError, round_robin
+
+Job = collections.namedtuple("Job", ["chat_id", "name"])
+
+
+def unlimited(**kwargs):
+    """Планировщик без ограничений частоты: проверяется только порядок и слоты"""
+    options = dict(user_rate=1000, user_burst=1000, global_rate=1000, global_burst=1000)
+    options.update(kwargs)
+    return FairScheduler(**options)
+
+
+def test_pop_goes_round_robin_between_users():
+    scheduler = unlimited(per_user_concurrency=10)
+    for name in ("a1", "a2", "a3"):
+        scheduler.push(Job(1, name))
+    for name in ("b1", "b2"):
+        scheduler.push(Job(2, name))
+    scheduler.push(Job(3, "c1"))
+
+    assert [job.name for job in scheduler.ordered()] == ["a1", "b1", "c1", "a2", "b2", "a3"]
+    assert [scheduler.pop().name for _ in range(6)] == ["a1", "b1", "c1", "a2", "b2", "a3"]
+    assert scheduler.pop() is None
+
+
+def test_pop_skips_users_without_free_slot():
+    scheduler = unlimited(per_user_concurrency=1)
+    scheduler.push(Job(1, "a1"))
+    scheduler.push(Job(1, "a2"))
+    scheduler.push(Job(2, "b1"))
+
+    first = scheduler.pop()
+    assert first.name == "a1"
+    assert scheduler.pop().name == "b1"
+    assert scheduler.pop() is None
+    scheduler.done(first)
+    assert scheduler.pop().name == "a2"
+
+
+def test_admit_limits_jobs_per_user():
+    scheduler = unlimited(per_user_limit=2)
+    scheduler.push(Job(1, "a1"))
+    scheduler.push(Job(1, "a2"))
+    with pytest.raises(RateLimitedError) as error:
+        scheduler.admit(1)
+    assert error.value.retry_after is None
+    scheduler.admit(2)
+
+
+def test_admit_limits_user_rate():
+    scheduler = FairScheduler(user_rate=0.001, user_burst=1, global_rate=1000, global_burst=1000)
+    scheduler.admit(1)
+    with pytest.raises(RateLimitedError) as error:
+        scheduler.admit(1, user_jobs=0)
+    assert error.value.retry_after > 0
+    scheduler.admit(2)
+
+
+def test_global_rejection_keeps_user_token():
+    scheduler = FairScheduler(user_rate=0.001, user_burst=1, global_rate=0.001, global_burst=1)
+    scheduler.admit(1)
+    with pytest.raises(RateLimitedError, match="перегружен"):
+        scheduler.admit(2)
+    # Отказ по общему лимиту не потратил токен пользователя 2
+    assert scheduler._user_bucket(2).time_until_available() == 0
+
+
+def test_remove_returns_pending_jobs():
+    scheduler = unlimited()
+    scheduler.push(Job(1, "a1"))
+    scheduler.push(Job(2, "b1"))
+    assert [job.name for job in scheduler.remove(1)] == ["a1"]
+    assert len(scheduler) == 1
+    assert scheduler.remove(1) == []
+
+
+def test_round_robin():
+    assert round_robin([[1, 2, 3], [4], [5, 6]]) == [1, 4, 5, 2, 6, 3]
+    assert round_robin([]) == []
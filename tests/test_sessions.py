@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+from sessions import MemorySessionStore, RedisSessionStore, SqliteSessionStore
+
+
+class FakeRedis:
+    """Хэши и sorted set'ы Redis в памяти - ровно то, что использует RedisSessionStore"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.zsets = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def hgetall(self, key):
+        with self.lock:
+            return {name.encode(): str(value).encode() for name, value in self.hashes.get(key, {}).items()}
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    def expire(self, key, seconds):
+        self.expires[key] = seconds
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zremrangebyscore(self, key, low, high):
+        zset = self.zsets.get(key, {})
+        for member in [member for member, score in zset.items() if score <= high]:
+            del zset[member]
+
+    def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    def scan_iter(self, match=None):
+        raise AssertionError("count() не должен сканировать ключи")
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        # MULTI/EXEC: команды выполняются разом, без чужих команд между ними
+        with self.client.lock:
+            return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemorySessionStore()
+    if request.param == "sqlite":
+        return SqliteSessionStore(str(tmp_path / "sessions.db"))
+    return RedisSessionStore(FakeRedis())
+
+
+def test_state_and_data_round_trip(store):
+    assert store.get_session(1) == (0, {})
+    store.set_state(1, 3, style="Японский")
+    store.update_data(1, subject="koi")
+    assert store.get_state(1) == 3
+    assert store.get_data(1) == {"style": "Японский", "subject": "koi"}
+    assert store.get_session(1) == (3, {"style": "Японский", "subject": "koi"})
+    assert store.count() == 1
+
+
+def test_get_data_returns_copy(store):
+    store.update_data(1, style="Японский")
+    store.get_data(1)["style"] = "changed"
+    assert store.get_data(1)["style"] == "Японский"
+
+
+def test_memory_store_evicts_least_recently_used_and_expired():
+    store = MemorySessionStore(ttl=60, max_items=2)
+    store.update_data(1, a=1)
+    store.update_data(2, a=2)
+    store.update_data(1, a=3)
+    store.update_data(3, a=4)
+    assert store.get_data(2) == {}
+    assert store.get_data(1) == {"a": 3}
+
+    store._sessions[1]["touched_at"] = time.time() - 120
+    assert store.get_data(1) == {}
+
+
+def test_sqlite_store_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    first = SqliteSessionStore(path)
+    second = SqliteSessionStore(path)
+
+    def update(store, field):
+        for index in range(20):
+            store.update_data(7, **{f"{field}{index}": index})
+
+    threads = [threading.Thread(target=update, args=(first, "a")),
+               threading.Thread(target=update, args=(second, "b"))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # BEGIN IMMEDIATE: чтение и запись одной транзакцией, ни одно поле не потеряно
+    data = SqliteSessionStore(path).get_data(7)
+    assert len(data) == 40
+
+
+def test_sqlite_store_trims_to_max_items(tmp_path):
+    store = SqliteSessionStore(str(tmp_path / "sessions.db"), max_items=5, trim_every=1)
+    for chat_id in range(10):
+        store.set_state(chat_id, 1)
+    assert store.count() == 5
+    assert store.get_state(9) == 1 and store.get_state(0) == 0
+
+
+def test_redis_store_concurrent_updates_keep_all_fields():
+    client = FakeRedis()
+    first, second = RedisSessionStore(client), RedisSessionStore(client)
+    first.set_state(1, 2, style="Японский")
+    second.update_data(1, subject="koi")
+    first.update_data(1, color="Цветная")
+    assert second.get_session(1) == (2, {"style": "Японский", "subject": "koi", "color": "Цветная"})
+    assert client.expires["tattoo:sessions:1"] == 7 * 24 * 3600
+
+
+def test_redis_store_counts_live_sessions_without_scan():
+    client = FakeRedis()
+    store = RedisSessionStore(client, ttl=60)
+    store.set_state(1, 1)
+    store.set_state(2, 1)
+    client.zsets[store._active_key]["1"] = time.time() - 120
+    assert store.count() == 1
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+class Cancelled(Exception):
+    pass
+
+
+def run_waiter(flight, key, function, results):
+    def target():
+        try:
+            results.append(flight.do(key, function))
+        except Exception as e:
+            results.append(e)
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread
+
+
+def wait_for_waiters(flight, count):
+    deadline = time.monotonic() + 2
+    while flight.waiting() < count:
+        assert time.monotonic() < deadline, "ждущие не присоединились"
+        time.sleep(0.01)
+
+
+def test_single_call_is_not_shared():
+    flight = SingleFlight()
+    assert flight.do("key", lambda: 42) == (42, False)
+    assert "key" not in flight
+    assert flight.in_flight() == 0
+
+
+def test_concurrent_calls_share_leader_result():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def leader():
+        calls.append("leader")
+        release.wait(2)
+        return "image"
+
+    results = []
+    first = run_waiter(flight, "key", leader, results)
+    while "key" not in flight:
+        time.sleep(0.01)
+    followers = [run_waiter(flight, "key", lambda: calls.append("follower"), results) for _ in range(3)]
+    wait_for_waiters(flight, 3)
+    release.set()
+    for thread in [first] + followers:
+        thread.join(2)
+
+    assert calls == ["leader"]
+    assert sorted(results, key=lambda result: result[1]) == [("image", False)] + [("image", True)] * 3
+    assert flight.in_flight() == 0 and flight.waiting() == 0
+
+
+def test_leader_error_is_raised_in_waiters():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def leader():
+        release.wait(2)
+        raise ValueError("провайдер недоступен")
+
+    results = []
+    first = run_waiter(flight, "key", leader, results)
+    while "key" not in flight:
+        time.sleep(0.01)
+    follower = run_waiter(flight, "key", lambda: "never", results)
+    wait_for_waiters(flight, 1)
+    release.set()
+    first.join(2)
+    follower.join(2)
+
+    assert len(results) == 2
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_private_error_makes_waiter_call_itself():
+    flight = SingleFlight(private_errors=(Cancelled,))
+    release = threading.Event()
+
+    def leader():
+        release.wait(2)
+        raise Cancelled()
+
+    results = []
+    first = run_waiter(flight, "key", leader, results)
+    while "key" not in flight:
+        time.sleep(0.01)
+    follower = run_waiter(flight, "key", lambda: "own", results)
+    wait_for_waiters(flight, 1)
+    release.set()
+    first.join(2)
+    follower.join(2)
+
+    assert any(isinstance(result, Cancelled) for result in results)
+    assert ("own", False) in results
+
+
+def test_check_interrupts_waiting():
+    flight = SingleFlight()
+    release = threading.Event()
+    first = run_waiter(flight, "key", lambda: release.wait(2), [])
+    while "key" not in flight:
+        time.sleep(0.01)
+
+    def check():
+        raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        flight.do("key", lambda: "never", check=check)
+    assert flight.waiting() == 0
+    release.set()
+    first.join(2)
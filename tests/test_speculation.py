@@ -0,0 +1,74 @@
+import threading
+import time
+
+from ratelimit import TokenBucket
+from speculation import ChoiceStats, Speculator
+
+
+def test_choice_stats_predicts_most_common_allowed_choice(tmp_path):
+    stats = ChoiceStats(str(tmp_path / "stats" / "choices.json"))
+    for color in ("Цветная", "Цветная", "Монохром"):
+        stats.record("Японский", color=color)
+    assert stats.predict("Японский", "color") == "Цветная"
+    assert stats.predict("Японский", "color", allowed={"Монохром"}) == "Монохром"
+    assert stats.predict("Японский", "color", default="Черно-белая", allowed={"Другая"}) == "Черно-белая"
+    assert stats.predict("Скетч", "color", default="Черно-белая") == "Черно-белая"
+
+
+def test_choice_stats_survive_restart_and_broken_file(tmp_path):
+    path = tmp_path / "choices.json"
+    ChoiceStats(str(path)).record("Японский", color="Цветная", quality="high")
+    assert ChoiceStats(str(path)).predict("Японский", "quality") == "high"
+
+    path.write_text("{не json", encoding="utf-8")
+    assert ChoiceStats(str(path)).predict("Японский", "quality") is None
+
+
+class Generation:
+    """generate для Speculator: ждет release, чтобы следующие задачи не успели начаться"""
+
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        self.release.wait(5)
+
+
+def test_speculator_respects_idle_check_and_budget():
+    generation = Generation()
+    idle = [False]
+    speculator = Speculator(generation, TokenBucket(rate=0.001, capacity=1), is_idle=lambda: idle[0])
+    try:
+        assert speculator.start(1, {"color": "Цветная"}, "koi") == "busy"
+        idle[0] = True
+        assert speculator.start(1, {"color": "Цветная"}, "koi") == "started"
+        assert speculator.start(2, {"color": "Цветная"}, "wolf") == "budget"
+        assert speculator.pending_count() == 1
+    finally:
+        generation.release.set()
+        speculator.shutdown()
+
+
+def test_speculator_miss_cancels_generation_that_has_not_started():
+    generation = Generation()
+    speculator = Speculator(generation, TokenBucket(rate=0.001, capacity=3))
+    try:
+        speculator.start(1, {"color": "Цветная"}, "first")
+        deadline = time.monotonic() + 3
+        while not generation.calls and time.monotonic() < deadline:
+            time.sleep(0.01)
+        speculator.start(2, {"color": "Цветная", "quality": "high"}, "second")
+        assert speculator.check(2, color="Цветная") == "match"
+        # Единственный поток занят первой генерацией: вторая еще в очереди и отменяется
+        assert speculator.check(2, quality="draft") == "miss"
+        assert speculator.check(2, quality="draft") is None
+
+        assert speculator.finish(1) and not speculator.finish(1)
+        assert speculator.start(3, {"color": "Монохром"}, "third") == "started"
+        assert speculator.cancel(3) and not speculator.cancel(3)
+    finally:
+        generation.release.set()
+        speculator.shutdown()
+    assert [args[0] for args in generation.calls] == ["first"]
@@ -0,0 +1,395 @@
+"""Трассировка задач генерации: спаны по этапам и их экспорт.
+
+Трасса - одна задача генерации, ее ID совпадает с ID задачи из очереди.
+Внутри трассы спаны этапов: ожидание в очереди, промпт, поиск в кэше,
+запросы к провайдеру, кодирование, отправка в Telegram, запись в архив.
+Текущий спан хранится в contextvars; в другие потоки его передают через
+wrap() или use(). Готовые спаны уходят в экспортеры: JSONL-файл и/или
+коллектор OpenTelemetry по OTLP/HTTP JSON.
+"""
+import collections
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+import uuid
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("tracing_span", default=None)
+
+
+class Span:
+    """Интервал работы одного этапа"""
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, start=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def set_error(self, error):
+        self.error = str(error)[:300]
+
+    def finish(self, end=None):
+        if self.end is None:
+            self.end = time.time() if end is None else end
+            self.tracer._export(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "duration": round(self.duration, 4),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Заглушка, когда трассировка выключена или нет текущей трассы"""
+
+    trace_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def set_error(self, error):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """Создает спаны, хранит последние трассы в памяти и отдает спаны экспортерам"""
+
+    def __init__(self, exporters=(), keep_traces=200, enabled=True):
+        self.exporters = list(exporters)
+        self.keep_traces = keep_traces
+        self.enabled = enabled
+        self._traces = collections.OrderedDict()  # trace_id -> [span dict]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def trace(self, trace_id, name, start=None, **attributes):
+        """Корневой спан трассы; start - если трасса началась раньше (постановка задачи)"""
+        if not self.enabled:
+            yield NOOP_SPAN
+            return
+        with self._activate(Span(self, name, trace_id, start=start, attributes=attributes)) as span:
+            yield span
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Дочерний спан текущего; без текущей трассы ничего не записывает"""
+        parent = _current.get()
+        if not self.enabled or parent is None:
+            yield NOOP_SPAN
+            return
+        with self._activate(Span(self, name, parent.trace_id, parent.span_id, attributes=attributes)) as span:
+            yield span
+
+    def record(self, name, start, end, **attributes):
+        """Уже завершившийся этап с известными границами (например, ожидание в очереди)"""
+        parent = _current.get()
+        if not self.enabled or parent is None:
+            return
+        Span(self, name, parent.trace_id, parent.span_id, start=start, attributes=attributes).finish(end)
+
+    @contextlib.contextmanager
+    def _activate(self, span):
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            _current.reset(token)
+            span.finish()
+
+    def get_trace(self, trace_id):
+        """Спаны трассы: из памяти, иначе из экспортеров (трассы других процессов)"""
+        with self._lock:
+            spans = list(self._traces.get(trace_id, ()))
+        if spans:
+            return spans
+        for exporter in self.exporters:
+            find = getattr(exporter, "find", None)
+            if find:
+                spans = find(trace_id)
+                if spans:
+                    return spans
+        return []
+
+    def recent(self, limit=10):
+        """Корневые спаны последних завершенных трасс, самые долгие первыми"""
+        with self._lock:
+            roots = [span for spans in self._traces.values() for span in spans if span["parent_id"] is None]
+        roots.sort(key=lambda span: span["duration"], reverse=True)
+        return roots[:limit]
+
+    def shutdown(self):
+        for exporter in self.exporters:
+            try:
+                exporter.shutdown()
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось остановить экспортер трасс: {e}")
+
+    def _export(self, span):
+        record = span.to_dict()
+        with self._lock:
+            spans = self._traces.pop(span.trace_id, [])
+            spans.append(record)
+            self._traces[span.trace_id] = spans
+            while len(self._traces) > self.keep_traces:
+                self._traces.popitem(last=False)
+        for exporter in self.exporters:
+            try:
+                exporter.export(record)
+            except Exception as e:
+                logger.debug(f"Не удалось экспортировать спан {span.name}: {e}")
+
+
+class JsonlExporter:
+    """Пишет каждый спан строкой JSON в файл; файл общий для бота и процессов-воркеров.
+
+    Когда файл дорастает до max_bytes, он переименовывается в path.1 (старые - в .2 и дальше),
+    хранится backups таких файлов. max_bytes=0 - без ротации.
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = max(0, backups)
+        self._lock = threading.Lock()
+
+    def export(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                size = f.tell()
+            if self.max_bytes and size >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        """Сдвигает path -> path.1 -> ... -> path.N; самый старый файл удаляется"""
+        try:
+            if self.backups:
+                for index in range(self.backups - 1, 0, -1):
+                    source = f"{self.path}.{index}"
+                    if os.path.exists(source):
+                        os.replace(source, f"{self.path}.{index + 1}")
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+        except FileNotFoundError:
+            # Файл уже сдвинул другой процесс
+            pass
+
+    def files(self):
+        """Текущий файл и ротированные, от новых к старым"""
+        return [self.path] + [f"{self.path}.{index}" for index in range(1, self.backups + 1)]
+
+    def find(self, trace_id):
+        for path in self.files():
+            spans = self._find_in(path, trace_id)
+            if spans:
+                return spans
+        return []
+
+    @staticmethod
+    def _find_in(path, trace_id):
+        spans = []
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    # Быстрая проверка до разбора JSON
+                    if trace_id not in line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("trace_id") == trace_id:
+                        spans.append(record)
+        except FileNotFoundError:
+            pass
+        return spans
+
+    def shutdown(self):
+        pass
+
+
+class OtlpExporter:
+    """Отправляет спаны в коллектор OpenTelemetry (OTLP/HTTP JSON) пачками из фонового потока"""
+
+    def __init__(self, endpoint, service_name="tattoo-bot", batch_size=100, interval=5.0, timeout=10.0):
+        self.url = endpoint.rstrip("/")
+        if not self.url.endswith("/v1/traces"):
+            self.url += "/v1/traces"
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=10000)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="otlp-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            logger.debug("Очередь OTLP переполнена, спан отброшен")
+
+    def shutdown(self):
+        self._stop.set()
+        self._thread.join(self.timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._stop.wait(self.interval)
+            self._flush()
+
+    def _flush(self):
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            try:
+                self._post(batch)
+            except Exception as e:
+                logger.warning(f"⚠️ Коллектор трасс недоступен, спанов потеряно: {len(batch)} ({e})")
+                return
+
+    def _post(self, batch):
+        body = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": "tattoo-bot"}, "spans": [_otlp_span(record) for record in batch]}],
+        }]}).encode("utf-8")
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+def _otlp_id(value, length):
+    """OTLP требует hex фиксированной длины: короткие hex-ID дополняются нулями, прочие хэшируются"""
+    value = str(value)
+    try:
+        int(value, 16)
+    except ValueError:
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()[:length]
+    return value.lower().zfill(length)[-length:]
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _otlp_span(record):
+    span = {
+        "traceId": _otlp_id(record["trace_id"], 32),
+        "spanId": _otlp_id(record["span_id"], 16),
+        "name": record["name"],
+        "kind": 1,
+        "startTimeUnixNano": str(int(record["start"] * 1e9)),
+        "endTimeUnixNano": str(int(record["end"] * 1e9)),
+        "attributes": [_otlp_attribute("job.id", record["trace_id"])]
+                      + [_otlp_attribute(key, value) for key, value in record["attributes"].items()],
+        "status": {"code": 2, "message": record["error"]} if record["error"] else {"code": 1},
+    }
+    if record["parent_id"]:
+        span["parentSpanId"] = _otlp_id(record["parent_id"], 16)
+    return span
+
+
+TRACER = Tracer(enabled=False)
+
+
+def configure(enabled=True, jsonl_path="", otlp_endpoint="", service_name="tattoo-bot", keep_traces=200,
+              jsonl_max_bytes=50 * 1024 * 1024, jsonl_backups=3):
+    """Настраивает общий трассировщик модуля"""
+    exporters = []
+    if jsonl_path:
+        exporters.append(JsonlExporter(jsonl_path, max_bytes=jsonl_max_bytes, backups=jsonl_backups))
+    if otlp_endpoint:
+        exporters.append(OtlpExporter(otlp_endpoint, service_name))
+    TRACER.shutdown()
+    TRACER.exporters = exporters
+    TRACER.keep_traces = keep_traces
+    TRACER.enabled = enabled
+    return TRACER
+
+
+def trace(trace_id, name, start=None, **attributes):
+    return TRACER.trace(trace_id, name, start=start, **attributes)
+
+
+def span(name, **attributes):
+    return TRACER.span(name, **attributes)
+
+
+def record(name, start, end, **attributes):
+    TRACER.record(name, start, end, **attributes)
+
+
+def current():
+    """Текущий спан или заглушка"""
+    return _current.get() or NOOP_SPAN
+
+
+@contextlib.contextmanager
+def use(parent):
+    """Делает parent текущим спаном в этом потоке (parent - результат current())"""
+    token = _current.set(parent if isinstance(parent, Span) else None)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def wrap(function):
+    """Привязывает function к текущему спану, чтобы вызвать ее в другом потоке"""
+    parent = _current.get()
+
+    def run(*args, **kwargs):
+        with use(parent):
+            return function(*args, **kwargs)
+
+    return run
@@ -0,0 +1,107 @@
+"""Легкий приемник webhook-обновлений Telegram на стандартном http.server"""
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """HTTP-сервер, который принимает обновления и передает их боту.
+
+    Обработка в TeleBot асинхронная (пул потоков), поэтому Telegram получает
+    ответ сразу, а тяжелая работа уходит в очередь генерации.
+
+    При answer_callbacks=True на нажатие inline-кнопки отвечается прямо в
+    ответе на webhook (answerCallbackQuery в теле ответа) - без отдельного
+    запроса к Bot API. Такой callback помечается атрибутом answered, и ответить
+    на него еще раз уже нельзя - поэтому текст всплывающего уведомления задает
+    callback_text(callback_query) до ответа (None - без текста).
+    """
+
+    def __init__(self, bot, host="0.0.0.0", port=8443, path="/webhook", secret_token=None, answer_callbacks=True,
+                 callback_text=None):
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.answer_callbacks = answer_callbacks
+        self.callback_text = callback_text
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                logger.debug(f"webhook: {format % args}")
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+
+    def _handle(self, request):
+        if request.path != self.path:
+            request.send_error(404)
+            return
+
+        if self.secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            logger.warning("⚠️ Webhook: запрос с неверным секретом")
+            request.send_error(403)
+            return
+
+        try:
+            length = int(request.headers.get("Content-Length", 0))
+            payload = json.loads(request.rfile.read(length).decode("utf-8"))
+            update = types.Update.de_json(payload)
+        except (ValueError, UnicodeDecodeError) as e:
+            logger.warning(f"⚠️ Webhook: не удалось разобрать обновление: {e}")
+            request.send_error(400)
+            return
+
+        body = b""
+        if self.answer_callbacks and update.callback_query is not None:
+            answer = {"method": "answerCallbackQuery", "callback_query_id": update.callback_query.id}
+            text = self._callback_text(update.callback_query)
+            if text:
+                answer["text"] = text
+            body = json.dumps(answer).encode("utf-8")
+            update.callback_query.answered = True
+
+        request.send_response(200)
+        if body:
+            request.send_header("Content-Type", "application/json")
+            request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        if body:
+            request.wfile.write(body)
+
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"❌ Webhook: ошибка обработки обновления: {e}")
+
+    def _callback_text(self, callback_query):
+        if self.callback_text is None:
+            return None
+        try:
+            return self.callback_text(callback_query)
+        except Exception as e:
+            logger.debug(f"Webhook: не удалось подготовить текст ответа на кнопку: {e}")
+            return None
+
+    def serve_forever(self):
+        host, port = self._httpd.server_address[:2]
+        logger.info(f"🌐 Webhook-приемник слушает {host}:{port}{self.path}")
+        self._httpd.serve_forever()
+
+    def start(self):
+        """Запускает сервер в фоновом потоке"""
+        thread = threading.Thread(target=self.serve_forever, name="webhook-server", daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
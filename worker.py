@@ -0,0 +1,93 @@
+"""Процессы-воркеры генерации для режима горизонтального масштабирования.
+
+Бот (polling или webhook) ставит задачи в общую очередь SQLite, а этот скрипт
+запускает процессы, которые разбирают задачи, вызывают FLUX и отправляют
+результат пользователю:
+
+    JOB_QUEUE_BACKEND=sqlite GENERATION_WORKERS=0 python main.py   # прием обновлений
+    JOB_QUEUE_BACKEND=sqlite python worker.py --processes 4       # генерация
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker_process(threads, metrics_port=0):
+    """Один процесс-воркер: пул потоков поверх общей очереди SQLite"""
+    # main импортируется внутри процесса: у каждого воркера свой бот, клиент FLUX и кэш
+    import main
+    from jobs import SqliteJobQueue
+
+    if main.JOB_QUEUE_BACKEND != "sqlite":
+        logger.warning("⚠️ JOB_QUEUE_BACKEND не sqlite: бот ставит задачи в свою очередь в памяти, воркер их не получит")
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    queue = SqliteJobQueue(
+        main.JOB_QUEUE_PATH,
+        main.run_generation_job,
+        workers=threads,
+        max_size=main.GENERATION_QUEUE_SIZE,
+        on_position=main.update_queue_position,
+        scheduler=main.job_scheduler,
+        lease_timeout=main.JOB_LEASE_SECONDS,
+        max_attempts=main.JOB_MAX_ATTEMPTS,
+        on_dropped=main.report_dropped_job,
+    )
+    main.archive_writer.start()
+    queue.start()
+    main.start_metrics_server(metrics_port)
+
+    stop_event.wait()
+    logger.info("🛑 Воркер останавливается, дожидаюсь текущих задач...")
+    # Новые задачи не берутся; не успевшие завершиться возвращаются в общую очередь
+    queue.stop(timeout=main.SHUTDOWN_DRAIN_SECONDS, finish_pending=False)
+    main.archive_writer.stop()
+    main.tracing.TRACER.shutdown()
+
+
+def main_entry():
+    parser = argparse.ArgumentParser(description="Воркеры генерации TattooKaterokBot")
+    parser.add_argument("--processes", type=int, default=1, help="количество процессов-воркеров")
+    parser.add_argument("--threads", type=int, default=2, help="параллельных генераций в каждом процессе")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="порт /metrics первого процесса, у следующих +1, +2... (0 - без метрик)")
+    args = parser.parse_args()
+    # Лимиты Telegram делятся между ботом и всеми процессами-воркерами (см. TELEGRAM_PROCESSES в main.py)
+    os.environ.setdefault("TELEGRAM_PROCESSES", str(args.processes + 1))
+
+    if args.processes <= 1:
+        run_worker_process(args.threads, args.metrics_port)
+        return
+
+    processes = [
+        multiprocessing.Process(
+            target=run_worker_process,
+            args=(args.threads, args.metrics_port + i if args.metrics_port else 0),
+            name=f"generation-worker-{i + 1}",
+        )
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main_entry()